@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Combine many actions sharing a start time
+
+Like an all-building schedule turning every channel on at 07:00, each
+event of a group is on another channel. Compares parser.combine_actions
+with folding each group with Action.__add__, which copies the args and
+labels accumulated so far for every action.
+
+Run from the repository root: python -m benchmarks.bench_combine
+"""
+
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import attrgetter
+
+from lantop.gcal.parser import Action, combine_actions
+
+SIZES = (1000, 2000, 4000, 8000)
+DAYS = 5
+
+
+def make_actions(size):
+    """size actions at 07:00 of each of DAYS days"""
+    origin = datetime(2026, 1, 5, 7)
+    return [Action(origin + timedelta(days=day), {channel: "on"},
+                   "room {:d} opening".format(channel))
+            for day in range(DAYS) for channel in range(size)]
+
+
+def fold_actions(actions):
+    actions = sorted(actions, key=attrgetter('time'))
+    return [sum(group, Action.NONE)
+            for _, group in groupby(actions, key=attrgetter('time'))]
+
+
+def measure(func, actions):
+    start = time.perf_counter()
+    func(actions)
+    return time.perf_counter() - start
+
+
+def main():
+    print("{:>6s} {:>10s} {:>10s}".format("group", "fold", "combine"))
+    for size in SIZES:
+        actions = make_actions(size)
+        print("{:6d} {:9.3f}s {:9.3f}s".format(
+            size, measure(fold_actions, actions),
+            measure(combine_actions, actions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Cost of polling an iCalendar file: first sync and unchanged polls
+
+The file holds daily recurring events (RRULE) of several channels. The
+first sync parses and expands it, the following polls only stat it.
+The events are then compiled to a timeline like the scheduler does.
+
+Run from the repository root: python -m benchmarks.bench_ics
+"""
+
+import os
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+from dateutil.tz import UTC
+
+from lantop.gcal.ics import IcsSource
+from lantop.gcal.parser import Action
+from lantop.gcal.store import EventStore
+from lantop.gcal.timeline import get_timeline_actions
+
+EVENTS = 500
+DAYS = 30
+POLLS = 100
+
+
+def write_ics(filename, start):
+    with open(filename, "w") as fp:
+        fp.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\n")
+        for index in range(EVENTS):
+            dtstart = start + timedelta(minutes=index * 7)
+            fp.write("BEGIN:VEVENT\r\nUID:event{:d}\r\n"
+                     "DTSTART:{:%Y%m%dT%H%M%SZ}\r\nDURATION:PT1H\r\n"
+                     "RRULE:FREQ=DAILY;INTERVAL={:d}\r\n"
+                     "SUMMARY:ch{:d} event {:d}\r\nEND:VEVENT\r\n"
+                     "".format(index, dtstart, index % 3 + 1, index % 4,
+                               index))
+        fp.write("END:VCALENDAR\r\n")
+
+
+def main():
+    Action.set_defaults(["ch{:d}".format(ch) for ch in range(4)])
+    start = datetime(2026, 1, 1, tzinfo=UTC)
+    end = start + timedelta(days=DAYS)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "cal.ics")
+        write_ics(filename, start)
+        source = IcsSource(filename)
+        store = EventStore()
+
+        begin = time.perf_counter()
+        changed = source.sync(store, start, end)
+        first = time.perf_counter() - begin
+        begin = time.perf_counter()
+        for _ in range(POLLS):
+            source.sync(store, start, end)
+        poll = (time.perf_counter() - begin) / POLLS
+        begin = time.perf_counter()
+        actions = get_timeline_actions(store.get_events(start, end))
+        timeline = time.perf_counter() - begin
+
+    print("first sync:     {:8.2f} ms ({:d} occurrences)"
+          "".format(first * 1000, changed))
+    print("unchanged poll: {:8.3f} ms".format(poll * 1000))
+    print("timeline:       {:8.2f} ms ({:d} actions)"
+          "".format(timeline * 1000, len(actions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Parse the times of 50k calendar events as returned by the Google API
+
+Compares client.parse_event with parsing start, end, created and updated
+of every event with dateutil.
+
+Run from the repository root: python -m benchmarks.bench_parse
+"""
+
+import copy
+import time
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse as dateutil_parse
+from dateutil.tz import tzoffset
+
+from lantop.gcal.client import parse_event
+
+EVENTS = 50000
+
+
+def make_events(count):
+    origin = datetime(2026, 1, 1, 7, tzinfo=tzoffset(None, 3600))
+    return [{"id": "event{:d}".format(index),
+             "summary": "ch{:d} meeting".format(index % 4),
+             "start": {"dateTime": (origin + timedelta(hours=index))
+                       .isoformat()},
+             "end": {"dateTime": (origin + timedelta(hours=index, minutes=45))
+                     .isoformat()},
+             "created": "2025-12-01T10:15:30.000Z",
+             "updated": "2025-12-02T08:00:12.123Z"}
+            for index in range(count)]
+
+
+def dateutil_parse_event(event):
+    event['start'] = dateutil_parse(event['start']["dateTime"])
+    event['end'] = dateutil_parse(event['end']["dateTime"])
+    event['created'] = dateutil_parse(event['created'])
+    event['updated'] = dateutil_parse(event['updated'])
+    return event
+
+
+def main():
+    events = make_events(EVENTS)
+    for name, func in (("dateutil", dateutil_parse_event),
+                       ("parse_event", parse_event)):
+        batch = copy.deepcopy(events)
+        start = time.perf_counter()
+        for event in batch:
+            func(event)
+        print("{:12s} {:d} events in {:.2f}s".format(
+            name, EVENTS, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
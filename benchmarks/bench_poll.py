@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Cost of a calendar poll with a new or a kept EventImporter
+
+A new importer per poll builds the API service from the discovery document
+(fetched over the network unless cached) before it can sync. The document
+is read from the copy shipped with googleapiclient, so the network time
+is not included. The Calendar API is the fake of lantop.testing.
+
+Run from the repository root: python -m benchmarks.bench_poll
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+import googleapiclient
+from googleapiclient import discovery
+from dateutil.tz import tzlocal
+
+from lantop.gcal.client import EventImporter
+from lantop.gcal.store import EventStore
+from lantop.testing import ApiEvent, FakeCalendarService
+
+EVENTS = 2000
+POLLS = 50
+DOCUMENT = os.path.join(os.path.dirname(googleapiclient.__file__),
+                        "discovery_cache", "documents", "calendar.v3.json")
+
+
+def poll(make_importer, service, store, now):
+    importer = make_importer()
+    importer.select_calendar("cal")
+    importer.sync(store, now)
+
+
+def measure(make_importer, service):
+    now = datetime.now(tzlocal())
+    store = EventStore()
+    poll(make_importer, service, store, now)  # the initial full sync
+    requests = len(service.requests)
+    start = time.perf_counter()
+    for _ in range(POLLS):
+        poll(make_importer, service, store, now)
+    duration = time.perf_counter() - start
+    return duration / POLLS, (len(service.requests) - requests) / POLLS
+
+
+def main():
+    with open(DOCUMENT) as fp:
+        document = fp.read()
+    now = datetime.now(tzlocal())
+    service = FakeCalendarService({"cal": [
+        ApiEvent(index, now + timedelta(hours=index))
+        for index in range(EVENTS)]})
+
+    def new_importer():
+        discovery.build_from_document(document, developerKey="key")
+        return EventImporter(None, None, service=service)
+
+    kept = EventImporter(None, None, service=service)
+    for name, make_importer in (("new", new_importer),
+                                ("kept", lambda: kept)):
+        duration, requests = measure(make_importer, service)
+        print("{:5s} importer: {:7.2f} ms, {:.1f} API requests per poll"
+              "".format(name, duration * 1000, requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Cost of expanding recurring events on each poll: from DTSTART or lazily
+
+The recurring events started a year ago and repeat every few hours. Each
+poll moves the scheduled time range a bit further, like the scheduler
+does. Expanding from DTSTART walks the whole series on every poll, the
+kept Occurrences only generate the start times beyond the last range.
+
+Run from the repository root: python -m benchmarks.bench_recurring
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from dateutil.tz import UTC
+
+from lantop.gcal.recurrence import Occurrences, expand, recurrence_set
+
+EVENTS = 50
+POLLS = 50
+SPAN = timedelta(days=7)
+POLL_INTERVAL = timedelta(minutes=5)
+DURATION = timedelta(hours=1)
+
+
+def rule_sets(now):
+    return [recurrence_set(now - timedelta(days=365, minutes=index),
+                           ["FREQ=HOURLY;INTERVAL={:d}".format(index % 6 + 2)])
+            for index in range(EVENTS)]
+
+
+def measure(poll, now):
+    start = time.perf_counter()
+    count = 0
+    for index in range(POLLS):
+        begin = now + POLL_INTERVAL * index
+        count += poll(begin, begin + SPAN)
+    return (time.perf_counter() - start) / POLLS, count // POLLS
+
+
+def main():
+    now = datetime(2026, 1, 1, tzinfo=UTC)
+    rulesets = rule_sets(now)
+    kept = [Occurrences(occurrences, DURATION)
+            for occurrences in rule_sets(now)]
+
+    def from_dtstart(start, end):
+        return sum(len(expand(occurrences, DURATION, start, end))
+                   for occurrences in rulesets)
+
+    def lazily(start, end):
+        return sum(len(occurrences.expand(start, end))
+                   for occurrences in kept)
+
+    for name, poll in (("from DTSTART", from_dtstart), ("lazily", lazily)):
+        duration, count = measure(poll, now)
+        print("{:12s}: {:8.2f} ms per poll ({:d} occurrences)"
+              "".format(name, duration * 1000, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Cost of rescheduling after one event changed, with a long time span
+
+Compares JobUpdater.schedule, which only cancels and enters the changed
+actions, with cancelling every scheduled action (sched.scheduler.cancel
+searches the queue and heapifies it each time) and entering all again.
+
+Run from the repository root: python -m benchmarks.bench_reschedule
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzlocal
+
+from lantop.gcal.parser import Action
+from lantop.gcal.scheduler import JobUpdater, Scheduler
+from lantop.testing import ApiEvent, FakeCalendarService
+
+EVENTS = (500, 1000, 2000, 4000)
+POLLS = 5
+
+
+def noop(*_):
+    pass
+
+
+def reschedule_all(updater, scheduler):
+    for event in scheduler.queue:
+        if event.action == noop:
+            scheduler.cancel(event)
+    updater.jobs = {}
+    updater.schedule(scheduler, noop)
+
+
+def measure(reschedule, size):
+    now = datetime.now(tzlocal())
+    events = [ApiEvent(index, now + timedelta(minutes=90 * index))
+              for index in range(size)]
+    service = FakeCalendarService({"cal": events})
+    scheduler = Scheduler(timefunc=lambda: now)
+    updater = JobUpdater({"credentials_storage_path": None, "dev_key": None,
+                          "service": service}, "cal",
+                         {"minutes": 90 * size + 60})
+    updater.update(scheduler, noop)
+    duration = 0
+    for poll in range(POLLS):
+        event = dict(events[size // 2], summary="ch{:d} moved".format(poll))
+        service.put_event("cal", event)
+        updater.calendars[0].sync(now, now)
+        start = time.perf_counter()
+        reschedule(updater, scheduler)
+        duration += time.perf_counter() - start
+    return duration / POLLS
+
+
+def main():
+    Action.set_defaults(["ch{:d}".format(ch) for ch in range(4)])
+    print("{:>6s} {:>10s} {:>10s}".format("events", "all", "diff"))
+    for size in EVENTS:
+        print("{:6d} {:9.1f}ms {:9.1f}ms".format(
+            size, measure(reschedule_all, size) * 1000,
+            measure(lambda updater, scheduler: updater.schedule(
+                scheduler, noop), size) * 1000))
+
+
+if __name__ == "__main__":
+    main()
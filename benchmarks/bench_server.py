@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Load test of lantop serve against the device emulator
+
+Run from the repository root: python -m benchmarks.bench_server
+"""
+
+import time
+import asyncio
+
+from lantop.server import DeviceSession, Server
+from lantop.testing import LantopEmulator, http_request
+
+CONNECTIONS = 20
+REQUESTS = 250  # per connection
+TTL = 0.5
+# device info and channel states, the only requests of the test
+RESPONSES = {b'T02624C': (b'626C0690502F082D',),
+             b'T02624B': (b'626B8C0209020202020200000015',)}
+
+
+async def client(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for _ in range(REQUESTS):
+        status, _, _ = await http_request(reader, writer, "GET",
+                                          "/devices/0/states")
+        assert status == 200
+    writer.close()
+
+
+async def load_test(server):
+    listener = await server.start("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port) for _ in range(CONNECTIONS)))
+    duration = time.perf_counter() - start
+    listener.close()
+    await listener.wait_closed()
+    return duration
+
+
+def main():
+    emulator = LantopEmulator(resp_dict=RESPONSES)
+    emulator.start()
+    session = DeviceSession(*emulator.server_address, ttl=TTL)
+    loop = asyncio.new_event_loop()
+    duration = loop.run_until_complete(load_test(Server({"0": session})))
+    session.close()
+    loop.close()
+    emulator.stop()
+
+    total = CONNECTIONS * REQUESTS
+    print("{} requests on {} connections in {:.2f}s: {:.0f} requests/s, "
+          "{} device requests".format(total, CONNECTIONS, duration,
+                                      total / duration,
+                                      emulator.num_requests))
+
+
+if __name__ == "__main__":
+    main()
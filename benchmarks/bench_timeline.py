@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Compile 100k synthetic calendar events to channel state transitions
+
+Compares the timeline compiler with the per-event actions of
+parser.get_combined_actions.
+
+Run from the repository root: python -m benchmarks.bench_timeline
+"""
+
+import time
+import random
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzlocal
+
+from lantop.gcal.parser import Action, get_combined_actions
+from lantop.gcal.timeline import get_timeline_actions
+
+EVENTS = 100000
+CHANNELS = 4
+DAYS = 3650
+
+
+def make_events(count, seed=1):
+    """Random events of 15 min to 4 h, on any channel, over ten years"""
+    rng = random.Random(seed)
+    origin = datetime(2026, 1, 1, tzinfo=tzlocal())
+    events = []
+    for index in range(count):
+        start = origin + timedelta(minutes=rng.randrange(DAYS * 24 * 4) * 15)
+        end = start + timedelta(minutes=rng.randrange(1, 17) * 15)
+        events.append({"id": "event{:d}".format(index),
+                       "summary": "ch{:d} meeting {:d}".format(
+                           rng.randrange(CHANNELS), index % 50),
+                       "start": start, "end": end, "description": ""})
+    return events
+
+
+def measure(func, events):
+    start = time.perf_counter()
+    actions = func(events)
+    duration = time.perf_counter() - start
+    commands = sum(len(action.args) for action in actions)
+    return duration, len(actions), commands
+
+
+def main():
+    Action.set_defaults(["ch{:d}".format(ch) for ch in range(CHANNELS)])
+    events = make_events(EVENTS)
+    for name, func in (("per event", get_combined_actions),
+                       ("timeline", get_timeline_actions)):
+        duration, actions, commands = measure(func, events)
+        print("{:10s} {:d} events in {:.2f}s: {:d} actions, "
+              "{:d} channel commands".format(name, EVENTS, duration,
+                                             actions, commands))
+
+
+if __name__ == "__main__":
+    main()
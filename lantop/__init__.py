@@ -6,8 +6,9 @@ with a yearly program (TR 64* top2 connected using a EM LAN top2 module)
 
 from .lantop import Lantop, LantopError
 from .consts import (
-    LANTOP_CONF_PATHS, LOCK_COUNTERS_FILE, DEFAULT_PORT, DEVICE_TYPES,
-    STATE_REASONS, CONTROL_MODES, TIMED_STATE_LABELS, ERROR_NAMES
+    LANTOP_CONF_PATHS, LOCK_COUNTERS_FILE, LOCK_SOCKET, HISTORY_PATH,
+    STATS_PATH, EVENTS_PATH, DEFAULT_PORT, DEVICE_TYPES, STATE_REASONS,
+    CONTROL_MODES, TIMED_STATE_LABELS, ERROR_NAMES
 )
 
 __author__ = "Sebastian Koslowski"
@@ -6,9 +6,18 @@ import logging
 import logging.config
 import sys
 
+from dateutil.parser import parse as dateutil_parse
+
 from . import __version__, utils, LOCK_COUNTERS_FILE
+from . errors import LantopTransportError
+from . history import HistoryLog, HistoryRecorder
+from . stats import StatsStore, StatsSampler, rates, export_csv
+from . server import serve
 from . lantop import Lantop, LantopError, CONTROL_MODES, TIMED_STATE_LABELS
-from . lock_counts import LockCounts
+from . lock_counts import BACKENDS as LOCK_BACKENDS, LockLeases, device_key
+from . lock_audit import LockAudit
+from . lock_service import LockClient
+from . watch import StateWatcher, format_change, format_change_json
 
 
 logger = logging.getLogger(__name__)
@@ -54,16 +63,34 @@ def dev_addr_type(value):
         raise argparse.ArgumentTypeError("Error parsing device address")
 
 
-def parse_args(args, config):
-    """Define and parse command line options"""
-    parser = argparse.ArgumentParser(description="Get and set LANtop2 state, "
-                                                 "settings and statistics")
+def datetime_type(value):
+    """Parse a date and time argument"""
+    try:
+        return dateutil_parse(value)
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError("Error parsing date/time argument")
+
 
+def add_device_arguments(parser, config, required=True):
+    """Add the device address and retries options to a parser"""
     dev_addr = config.device.address
-    extra_args = {"nargs": "?", "default": dev_addr} if dev_addr else {}
+    extra_args = {"nargs": "?", "default": dev_addr} \
+        if dev_addr or not required else {}
     parser.add_argument(metavar="host[:port]", dest="dev_addr",
                         type=dev_addr_type,
                         help="Device host name or IP (and port)", **extra_args)
+    parser.add_argument("-y", "--retries", dest="retries", action="store",
+                        type=int, metavar="COUNT", default=config.device.retries,
+                        help="How often to retry connecting (random delay)")
+
+
+def parse_args(args, config):
+    """Define and parse command line options"""
+    parser = argparse.ArgumentParser(description="Get and set LANtop2 state, "
+                                                 "settings and statistics",
+                                     epilog="Further commands: " +
+                                            ", ".join(sorted(COMMANDS)))
+    add_device_arguments(parser, config)
 
     parser.add_argument("-t", "--time", dest="set_time", action="store_true",
                         help="Set the time on device")
@@ -82,9 +109,6 @@ def parse_args(args, config):
                         help="Turn off after or turn on for a defined time")
     parser.add_argument("-e", "--extra", dest="extra_info",
                         action="store_true", help="Show extra info")
-    parser.add_argument("-y", "--retries", dest="retries", action="store",
-                        type=int, metavar="COUNT", default=config.device.retries,
-                        help="How often to retry connecting (random delay)")
     parser.add_argument("-q", "--quiet", dest="be_quiet", action="store_true",
                         help="Suppress output")
     parser.add_argument("-v", "--version", dest="show_version",
@@ -98,6 +122,18 @@ def parse_args(args, config):
     return options
 
 
+def open_lock_counts(config, serial):
+    """Use the lock service of the scheduler if running, else the file"""
+    try:
+        return LockClient(config.locks.socket, serial, logger)
+    except OSError:
+        locks = LOCK_BACKENDS[config.device.lock_backend](
+            LOCK_COUNTERS_FILE, logger, device=serial)
+        if config.locks.audit:
+            locks.audit = LockAudit()
+        return locks
+
+
 def change_device_states_or_time(device, options, locks):
     """Change the state of a channel, the time, ... if requested"""
     add_spacer = False
@@ -128,40 +164,32 @@ def change_device_states_or_time(device, options, locks):
 
     # set state
     if options.set_states:
+        changes = {}
         for channel, state in options.set_states:
             # handle temporary states (finite duration)
             duration = options.duration if state in TIMED_STATE_LABELS \
                 else None
 
             if duration is not None:
-                device.set_state(channel. state, duration)
+                device.set_state(channel, state, duration)
                 log_str = "Set channel {} to state {} for {}".format(
                     channel, state, str(duration))
+                logger.info(log_str)
+                if not options.be_quiet:
+                    add_spacer = True
+                    print(log_str)
+            else:
+                changes[channel] = state
+
+        # indefinite state changes with locks, sent as one batch
+        for decision in locks.apply_many(device.set_states, changes,
+                                         source="cli"):
+            if decision.applied:
+                log_str = "Set channel {} to state {}.".format(
+                    decision.channel, decision.state)
             else:
-                # indefinite state changes with locks
-                # ...flat is better than nested...ups...
-                locks[channel] += 1 if state == "on" else -1
-
-                if locks[channel] == 1 and state == "on":
-                    device.set_state(channel, "on")
-                    log_str = "Set channel {} to state on.".format(channel)
-                elif locks[channel] <= 0 and state == "auto":
-                    device.set_state(channel, "auto")
-                    log_str = "Set channel {} to state auto.".format(channel)
-                elif state == "off":
-                    device.set_state(channel, "off")
-                    locks[channel] = 0
-                    log_str = "Set channel {} to state off.".format(channel)
-                else:
-                    log_str = "Channel {} unchanged due to locks.".format(channel)
-
-                if locks[channel] < 0:
-                    locks[channel] = 0
-                    logger.warning("Negative count on channel %d", channel)
-
-                logger.info("Lock counters changed {}".format(locks))
-
-            logger.info(log_str)
+                log_str = "Channel {} unchanged due to locks ({:d}).".format(
+                    decision.channel, decision.locks)
             if not options.be_quiet:
                 add_spacer = True
                 print(log_str)
@@ -205,7 +233,273 @@ def get_and_print_overview(device, options, locks):
         fmt = "{index:1d}  {:13} {:5s} {:5d} {reason:10s} {:6.1f}h {:6.1f}h {:8d}"
         if options.extra_info:
             fmt += " {:%d.%m.%Y}"
-        print(fmt.format(name, state, locks[channel], *stats, **states[channel]))
+        print(fmt.format(name, state, locks.count(channel), *stats,
+                         **states[channel]))
+
+
+def watch_main(args, config):
+    """Keep connected and print channel state changes"""
+    parser = argparse.ArgumentParser(prog="lantop watch",
+                                     description="Watch LANtop2 channel "
+                                                 "states for changes")
+    add_device_arguments(parser, config)
+    parser.add_argument("-j", "--json", dest="as_json", action="store_true",
+                        help="Print changes as JSON lines")
+    parser.add_argument("--min-interval", dest="min_interval", type=float,
+                        metavar="SEC", default=config.watch.min_interval,
+                        help="Poll interval after a change")
+    parser.add_argument("--max-interval", dest="max_interval", type=float,
+                        metavar="SEC", default=config.watch.max_interval,
+                        help="Poll interval when idle")
+    parser.add_argument("-r", "--record", dest="record", action="store_true",
+                        help="Record states in the history log")
+    options = parser.parse_args(args)
+
+    formatter = format_change_json if options.as_json else format_change
+    device = Lantop()
+    watcher = StateWatcher(device, options.min_interval, options.max_interval,
+                           config.watch.backoff)
+    try:
+        device.connect(*options.dev_addr, retries=options.retries)
+        if options.record:
+            log = HistoryLog(config.history.path,
+                             config.history.segment_records)
+            watcher.recorder = HistoryRecorder(log, device.get_info()[1],
+                                               config.history.heartbeat)
+        while True:
+            try:
+                for changes in watcher:
+                    for change in changes:
+                        print(formatter(change), flush=True)
+            except LantopTransportError as err:
+                logger.warning("Lost connection (%s), reconnecting", err)
+                device.connect(*options.dev_addr, retries=options.retries)
+
+    except LantopError as err:
+        logger.error(err)
+        print(err, file=sys.stderr)
+        return 1
+
+    except KeyboardInterrupt:
+        return 0
+
+    finally:
+        device.close()
+
+
+def history_main(args, config):
+    """Print on-time intervals and duty cycles from the history log"""
+    parser = argparse.ArgumentParser(prog="lantop history",
+                                     description="Show when channels were on")
+    now = datetime.now()
+    parser.add_argument("-f", "--from", dest="start", type=datetime_type,
+                        metavar="DATETIME", default=now - timedelta(days=1),
+                        help="Start of the time range (default: a day ago)")
+    parser.add_argument("-t", "--to", dest="end", type=datetime_type,
+                        metavar="DATETIME", default=now,
+                        help="End of the time range (default: now)")
+    parser.add_argument("-c", "--channel", dest="channels", type=int,
+                        metavar="CH", nargs="+", default=list(range(8)),
+                        help="Channel(s) to show (default: all)")
+    parser.add_argument("-d", "--device", dest="device", type=int,
+                        metavar="SERIAL", help="Device serial number")
+    parser.add_argument("-p", "--path", dest="path", metavar="DIR",
+                        default=config.history.path, help="History log path")
+    options = parser.parse_args(args)
+
+    log = HistoryLog(options.path)
+    range_hours = (options.end - options.start).total_seconds() / 3600
+    for channel in options.channels:
+        intervals = log.on_intervals(channel, options.start, options.end,
+                                     options.device)
+        if not intervals and len(options.channels) > 1:
+            continue
+        on_hours = sum((until - since).total_seconds()
+                       for since, until in intervals) / 3600
+        print("CH {:d}  on {:.1f}h of {:.1f}h ({:.1%})".format(
+            channel, on_hours, range_hours,
+            on_hours / range_hours if range_hours > 0 else 0.0))
+        for since, until in intervals:
+            print("    {:%d.%m.%Y %H:%M:%S} - {:%d.%m.%Y %H:%M:%S}  ({})".format(
+                since, until, until - since))
+
+
+def stats_main(args, config):
+    """Sample channel statistics or report usage from the samples"""
+    parser = argparse.ArgumentParser(prog="lantop stats",
+                                     description="Channel usage from "
+                                                 "sampled statistics")
+    add_device_arguments(parser, config, required=False)
+    parser.add_argument("-s", "--sample", dest="sample", action="store_true",
+                        help="Take a sample from the device first")
+    parser.add_argument("-f", "--since", dest="since", type=datetime_type,
+                        metavar="DATETIME",
+                        help="Only use samples since (default: all)")
+    parser.add_argument("-c", "--channel", dest="channels", type=int,
+                        metavar="CH", nargs="+", default=list(range(8)),
+                        help="Channel(s) to show (default: all)")
+    parser.add_argument("-d", "--device", dest="device", type=int,
+                        metavar="SERIAL", help="Device serial number")
+    parser.add_argument("-x", "--export", dest="export", metavar="FILE",
+                        type=argparse.FileType("w"),
+                        help="Write samples and deltas as CSV ('-' stdout)")
+    parser.add_argument("-p", "--path", dest="path", metavar="DIR",
+                        default=config.stats.path, help="Stats store path")
+    options = parser.parse_args(args)
+
+    store = StatsStore(options.path)
+    if options.sample:
+        if not options.dev_addr:
+            parser.error("Need a device address to take a sample.")
+        try:
+            with Lantop(*options.dev_addr, retries=options.retries) as device:
+                StatsSampler(store).sample(device)
+        except LantopError as err:
+            logger.error(err)
+            print(err, file=sys.stderr)
+            return 1
+
+    exported = False
+    columns = store.load()
+    for channel in options.channels:
+        samples = store.samples(channel, options.device, options.since,
+                                columns)
+        if not samples:
+            continue
+        if options.export:
+            export_csv(samples, options.export, header=not exported)
+            exported = True
+            continue
+        usage = rates(samples)
+        if usage is None:
+            print("CH {:d}  only one sample".format(channel))
+            continue
+        print("CH {:d}  {:6.1f}h active {:6.1f}h service {:6d} switches "
+              "in {:.1f} days".format(channel, usage.active, usage.service,
+                                      usage.switches, usage.days))
+        print("      {:6.1f}h per day, {:.1f} switches per week, "
+              "{:d} reset(s)".format(usage.active_per_day,
+                                     usage.switches_per_week, usage.resets))
+
+
+def serve_main(args, config):
+    """Serve device states over HTTP"""
+    parser = argparse.ArgumentParser(prog="lantop serve",
+                                     description="HTTP/JSON API for LANtop2 "
+                                                 "devices")
+    dev_addr = config.device.address
+    parser.add_argument(metavar="host[:port]", dest="dev_addrs",
+                        type=dev_addr_type, nargs="*" if dev_addr else "+",
+                        default=[dev_addr] if dev_addr else None,
+                        help="Device host name(s) or IP(s) (and port), "
+                             "their position is the device id")
+    parser.add_argument("-y", "--retries", dest="retries", action="store",
+                        type=int, metavar="COUNT", default=config.device.retries,
+                        help="How often to retry connecting (random delay)")
+    parser.add_argument("-b", "--bind", dest="bind", metavar="ADDR",
+                        default=config.server.bind, help="Address to listen on")
+    parser.add_argument("-p", "--port", dest="port", type=int, metavar="PORT",
+                        default=config.server.port, help="Port to listen on")
+    parser.add_argument("--ttl", dest="ttl", type=float, metavar="SEC",
+                        default=config.server.ttl,
+                        help="Serve states from cache for this long")
+    options = parser.parse_args(args)
+
+    try:
+        serve(options.dev_addrs, options.bind, options.port, options.ttl,
+              options.retries, **config.watch)
+    except KeyboardInterrupt:
+        return 0
+    except OSError as err:
+        logger.error(err)
+        print(err, file=sys.stderr)
+        return 1
+
+
+def locks_main(args, config):
+    """List lock counters and the leases held by events"""
+    parser = argparse.ArgumentParser(prog="lantop locks",
+                                     description="Show channel locks")
+    parser.add_argument("command", nargs="?", default="list",
+                        choices=("list", "replay"),
+                        help="Show the current locks or replay the audit "
+                             "journal")
+    parser.add_argument("-d", "--device", dest="device", type=int,
+                        metavar="SERIAL", help="Device serial number")
+    parser.add_argument("-a", "--at", dest="at", type=datetime_type,
+                        metavar="DATETIME", default=datetime.now(),
+                        help="Replay: point in time (default: now)")
+    parser.add_argument("-f", "--since", dest="since", type=datetime_type,
+                        metavar="DATETIME",
+                        help="Replay: also print the changes since")
+    options = parser.parse_args(args)
+
+    if options.command == "replay":
+        return replay_locks(options)
+
+    try:
+        client = LockClient(config.locks.socket, logger=logger)
+        response = client.list()
+        client.close()
+        devices = {int(key): counts
+                   for key, counts in response["devices"].items()}
+        leases = response["leases"]
+    except OSError:
+        # scheduler not running, read the files
+        devices = {}
+        leases = LockLeases(LOCK_COUNTERS_FILE, logger).items()
+        if options.device is not None:
+            counts = LOCK_BACKENDS[config.device.lock_backend](
+                LOCK_COUNTERS_FILE, logger, device=options.device)
+            devices[device_key(options.device)] = \
+                [counts[channel] for channel in range(counts.max_channels)]
+
+    keys = set(devices) | {lease[0] for lease in leases}
+    if options.device is not None:
+        keys &= {device_key(options.device)}
+    for key in sorted(keys):
+        print("Device #{:d}".format(key))
+        counts = devices.get(key, [0] * 8)
+        for channel, count in enumerate(counts):
+            owners = [(owner, expires) for k, ch, owner, expires in leases
+                      if k == key and ch == channel]
+            if not count and not owners:
+                continue
+            print("  CH {:d}  {:d} lock(s), {:d} anonymous".format(
+                channel, count + len(owners), count))
+            for owner, expires in owners:
+                until = "until {:%d.%m.%Y %H:%M}".format(
+                    datetime.fromtimestamp(expires)) \
+                    if expires is not None else "no expiry"
+                print("        {:30s} {}".format(owner, until))
+
+
+def replay_locks(options):
+    """Print the lock counts at a point in time from the audit journal"""
+    audit = LockAudit()
+    device = None if options.device is None else device_key(options.device)
+    at = options.at.timestamp()
+    if options.since:
+        for record in audit.records(options.since.timestamp(), at, device):
+            print("{:%d.%m.%Y %H:%M:%S}  #{:d} CH {:d}  {:+d} -> {:d}  "
+                  "{}".format(datetime.fromtimestamp(record.timestamp),
+                              record.device, record.channel, record.delta,
+                              record.locks, record.source))
+        print("")
+
+    print("Locks at {:%d.%m.%Y %H:%M:%S}".format(options.at))
+    for (key, channel), count in sorted(audit.counts_at(at, device).items()):
+        if count:
+            print("  #{:d} CH {:d}  {:d} lock(s)".format(key, channel, count))
+
+
+COMMANDS = {
+    "watch": watch_main,
+    "history": history_main,
+    "stats": stats_main,
+    "serve": serve_main,
+    "locks": locks_main,
+}
 
 
 def main(args=None):
@@ -213,7 +507,11 @@ def main(args=None):
     config = utils.load_config()
     logging.config.dictConfig(config.get('logging', {}))
 
-    options = parse_args(args or sys.argv[1:], config)
+    args = args or sys.argv[1:]
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:], config)
+
+    options = parse_args(args, config)
 
     if options.show_version:
         print("Version: {}".format(__version__))
@@ -222,14 +520,22 @@ def main(args=None):
     device = None
     try:
         device = Lantop(*options.dev_addr, retries=options.retries)
-        locks = LockCounts(LOCK_COUNTERS_FILE, logger)
+        locks = open_lock_counts(config, device.get_info()[1])
 
         if not options.be_quiet:
             get_and_print_device_info(device, options)
             print("")
 
         # set stuff
-        change_device_states_or_time(device, options, locks)
+        if options.set_states:
+            with locks.transaction():
+                change_device_states_or_time(device, options, locks)
+        else:
+            change_device_states_or_time(device, options, locks)
+        if options.reset_ch is not None:
+            stats_store = StatsStore(config.stats.path)
+            if stats_store.exists():
+                stats_store.mark_reset(options.reset_ch, device.get_info()[1])
 
         # print overview
         if not options.be_quiet:
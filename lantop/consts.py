@@ -7,6 +7,14 @@ LANTOP_CONF_PATHS = [
 
 LOCK_COUNTERS_FILE = "/var/lib/lantop/state"
 
+LOCK_SOCKET = "/run/lantop/locks.sock"
+
+HISTORY_PATH = "/var/lib/lantop/history"
+
+STATS_PATH = "/var/lib/lantop/stats"
+
+EVENTS_PATH = "/var/lib/lantop/events.sqlite"
+
 ############################################################
 # The following are rather consts than configurable values
 # Change the Labels freely, but keep the lengths the same
@@ -1,18 +1,39 @@
 """Handles Google API client stuff"""
 
+import os
+import json
+import time
+import heapq
+import hashlib
+import threading
 import logging.config
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
 
 import httplib2
 
 import apiclient
 from oauth2client.file import Storage
-from oauth2client.client import flow_from_clientsecrets
+from oauth2client.client import flow_from_clientsecrets, \
+    AccessTokenRefreshError
 
 from dateutil.parser import parse as dateutil_parse
 
 from .. import utils
+from .source import EventSource
+
+logger = logging.getLogger(__name__)
 
 Error = apiclient.errors.Error
+HttpError = apiclient.errors.HttpError
+AuthError = AccessTokenRefreshError
+
+PAGE_SIZE = 250
+# only the event fields the parser uses
+EVENT_FIELDS = "nextPageToken,items(id,summary,description,start,end,updated)"
+SYNC_FIELDS = ("etag,nextPageToken,nextSyncToken,"
+               "items(id,status,summary,description,start,end,updated,"
+               "recurrence,recurringEventId,originalStartTime)")
 
 
 class EventImporterError(Error):
@@ -23,15 +44,86 @@ class AuthorizationMissing(EventImporterError):
     """Missing or outdated authorization token"""
 
 
-class EventImporter(object):
+class DiscoveryCache(object):
+    """Keep the API discovery documents in files of a directory
+
+    Implements the get and set methods discovery.build expects of a cache.
+
+    """
+
+    def __init__(self, path, max_age=24 * 3600):
+        self.path = path
+        self.max_age = max_age
+
+    def _filename(self, url):
+        return os.path.join(self.path, hashlib.sha1(
+            url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        filename = self._filename(url)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.max_age:
+                return None
+            with open(filename) as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        if isinstance(content, str):
+            content = content.encode()
+        try:
+            utils.write_atomic(self._filename(url), content)
+        except OSError as error:  # e.g. no permission, still works
+            logger.warning("Cannot cache the discovery document: %s", error)
+
+
+class EventImporter(EventSource):
     """Class for retrieving a list of calendar entries from Google"""
 
     calendar_name_id_cache = {}
+    # importers of several calendars select them concurrently
+    _cache_lock = threading.Lock()
+
+    def __init__(self, credentials_storage_path, dev_key, calendar_name=None,
+                 page_size=PAGE_SIZE, cache_path=None, single_events=True,
+                 service=None, **_):
+        """Connect to and authenticate with Google API
 
-    def __init__(self, credentials_storage_path, dev_key, calendar_name=None, **_):
-        """Connect to and authenticate with Google API"""
+        The importer is meant to be kept: its HTTP connection is reused and
+        the access token is refreshed as needed.
+
+        :param page_size: number of events requested per page
+        :param cache_path: directory to keep the API discovery document and
+                           the calendar ids in (no file cache if None)
+        :param single_events: sync the occurrences of recurring events
+                              instead of the recurring events (see sync)
+        :param service: calendar API service to use instead of connecting
+
+        """
         self._calendar_id = ""
+        self.calendar_name = None
+        self.page_size = page_size
+        self.single_events = single_events
+        # per request kind, the parameters and ETag of the last response
+        self._etags = {}
+        self._calendar_list = None
+        self.not_modified = 0  # responses skipped as 304 Not Modified
+        self.calendar_cache_filename = cache_path and \
+            os.path.join(cache_path, "calendars.json")
+        self._load_calendar_cache()
+
+        if service is not None:
+            self.service = service
+        else:
+            self.service = self._build_service(credentials_storage_path,
+                                               dev_key, cache_path)
 
+        if calendar_name:
+            self.select_calendar(calendar_name)
+
+    @staticmethod
+    def _build_service(credentials_storage_path, dev_key, cache_path=None):
         if dev_key == 'YOUR_DEV_KEY_HERE':
             raise ValueError('Missing developer key in settings')
 
@@ -40,60 +132,271 @@ class EventImporter(object):
             raise AuthorizationMissing('Missing or invalid credentials')
 
         try:
-            self.service = apiclient.discovery.build(
+            return apiclient.discovery.build(
                 serviceName="calendar",
                 version="v3",
                 http=credentials.authorize(httplib2.Http()),
-                developerKey=dev_key
+                developerKey=dev_key,
+                cache=DiscoveryCache(cache_path) if cache_path else None
             )
         except httplib2.HttpLib2Error:
             raise EventImporterError("Can't connect to Google API")
 
-        if calendar_name:
-            self.select_calendar(calendar_name)
+    def _load_calendar_cache(self):
+        if not self.calendar_cache_filename:
+            return
+        try:
+            with open(self.calendar_cache_filename) as fp:
+                calendar_ids = json.load(fp)
+            with self._cache_lock:
+                self.calendar_name_id_cache.update(calendar_ids)
+        except (OSError, ValueError):
+            pass
+
+    def _save_calendar_cache(self):
+        if self.calendar_cache_filename:
+            # a later write never replaces the file with older ids
+            with self._cache_lock:
+                try:
+                    utils.write_atomic(
+                        self.calendar_cache_filename,
+                        json.dumps(self.calendar_name_id_cache).encode())
+                except OSError as error:
+                    logger.warning("Cannot cache the calendar ids: %s", error)
 
     def select_calendar(self, name, use_cache=True):
         """Select a calendar to be used for entry retrieval"""
-        if use_cache and name in self.calendar_name_id_cache:
-            self._calendar_id = self.calendar_name_id_cache[name]
+        with self._cache_lock:
+            calendar_id = self.calendar_name_id_cache.get(name)
+        if use_cache and calendar_id:
+            self._calendar_id = calendar_id
+            self.calendar_name = name
             return
 
-        response = self.service.calendarList().list().execute()
-        for calendar_list_entry in response["items"]:
-            if calendar_list_entry["summary"] == name:
-                id_ = calendar_list_entry["id"]
-                self._calendar_id = id_
-                self.calendar_name_id_cache[name] = id_
-                break
-        else:
+        response = self._execute(self.service.calendarList().list(),
+                                 ("calendarList",)) or self._calendar_list
+        self._calendar_list = response
+        # keep the ids of all calendars, others are likely selected next
+        calendar_ids = {entry["summary"]: entry["id"]
+                        for entry in reversed(response["items"])}
+        if name not in calendar_ids:
             raise EventImporterError("Calendar {!r} not found"
                                      "".format(name))
+        self._calendar_id = calendar_ids[name]
+        self.calendar_name = name
+        with self._cache_lock:
+            self.calendar_name_id_cache.update(calendar_ids)
+        self._save_calendar_cache()
+
+    def forget_calendar(self, name):
+        """Drop the cached id of a calendar, e.g. after an error"""
+        with self._cache_lock:
+            forgotten = self.calendar_name_id_cache.pop(name, None)
+        if forgotten is not None:
+            self._save_calendar_cache()
+
+    def reset(self):
+        """Look up the selected calendar again on the next select"""
+        if self.calendar_name:
+            self.forget_calendar(self.calendar_name)
+
+    def _execute(self, request, key):
+        """Execute a request conditional on the ETag of the last response
+
+        :param key: tuple of the request kind and parameters, the ETag of
+                    the last response of each kind is kept
+        :returns: the response body, None if it was not modified (304)
+
+        """
+        last_key, etag = self._etags.get(key[0], (None, None))
+        if etag and last_key == key:
+            request.headers["If-None-Match"] = etag
+        try:
+            response = request.execute()
+        except apiclient.errors.HttpError as error:
+            if error.resp.status == 304:
+                self.not_modified += 1
+                return None
+            raise
+        if response.get("etag"):
+            self._etags[key[0]] = (key, response["etag"])
+        return response
+
+    def iter_events(self, start, end, page_size=None):
+        """Iterate over the events in the time between start and end
+
+        Pages are requested as the events are consumed.
+
+        :param page_size: number of events per page (default self.page_size)
+
+        """
+        if not self._calendar_id:
+            raise EventImporterError("No calendar has been selected")
+
+        page_token = None
+        while True:
+            response = self.service.events().list(
+                calendarId=self._calendar_id,
+                orderBy="startTime",
+                singleEvents=True,
+                timeMin=start.isoformat(),
+                timeMax=end.isoformat(),
+                maxResults=page_size or self.page_size,
+                fields=EVENT_FIELDS,
+                pageToken=page_token
+            ).execute()
+
+            for event in map(parse_event, response.get("items", [])):
+                if event.get("status") != "cancelled":
+                    yield event
+
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return
 
     def get_events(self, start, end):
         """Retrieve a list of event in the time between start and stop"""
+        return list(self.iter_events(start, end))
+
+    def sync(self, store, start, end=None):
+        """Update an EventStore with the events changed since its last sync
+
+        The first sync, and any after the sync token expired (410 Gone),
+        is a full one of the events ending after start (end is not used,
+        the sync token covers all later events).
+
+        An incremental sync is skipped if the server reports the changes
+        since the sync token as not modified.
+
+        Without single_events, a recurring event is synced once instead of
+        each occurrence; the store expands it together with its modified
+        and cancelled occurrences (exceptions).
+
+        :param store: EventStore of the selected calendar
+        :returns: number of changed events, None if not modified
+
+        """
         if not self._calendar_id:
             raise EventImporterError("No calendar has been selected")
 
-        response = self.service.events().list(
-            calendarId=self._calendar_id,
-            orderBy="startTime",
-            singleEvents=True,
-            timeMin=start.isoformat(),
-            timeMax=end.isoformat()
-        ).execute()
-
-        events = response["items"]
-        for event in events:
-            event['start'] = dateutil_parse(event['start']["dateTime"])
-            event['end'] = dateutil_parse(event['end']["dateTime"])
-            event['created'] = dateutil_parse(event['created'])
-            event['updated'] = dateutil_parse(event['updated'])
-
-        # check if there were more results
-        if response.get("nextPageToken"):
-            raise EventImporterError("There were more")
-
-        return events
+        if store.sync_token:
+            try:
+                return self._sync(store, syncToken=store.sync_token)
+            except apiclient.errors.HttpError as error:
+                if error.resp.status != 410:
+                    raise
+        store.clear()
+        return self._sync(store, timeMin=start.isoformat())
+
+    def _sync(self, store, **params):
+        """Apply all pages of a sync request, then keep its sync token"""
+        changed, page_token = 0, None
+        while True:
+            request = self.service.events().list(
+                calendarId=self._calendar_id,
+                singleEvents=self.single_events,
+                maxResults=self.page_size,
+                fields=SYNC_FIELDS,
+                pageToken=page_token,
+                **params
+            )
+            if page_token is None and "syncToken" in params:
+                response = self._execute(request, (
+                    "events", self._calendar_id, params["syncToken"]))
+                if response is None:
+                    return None  # nothing changed since the sync token
+            else:
+                response = request.execute()
+
+            changed += store.apply(parse_event(event)
+                                   for event in response.get("items", []))
+
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                store.sync_token = response.get("nextSyncToken")
+                return changed
+
+
+_TIMEZONES = {}  # tzinfo per UTC offset, shared by all time stamps
+
+
+def parse_time(text):
+    """Parse an RFC 3339 time stamp as returned by the Google API
+
+    Uses datetime.fromisoformat, dateutil only for anything it rejects.
+
+    """
+    try:
+        if text[-1] in "zZ":
+            local, offset = text[:-1], "+00:00"
+        elif text[-6] in "+-" and text[-3] == ":":
+            local, offset = text[:-6], text[-6:]
+        else:
+            raise ValueError("no UTC offset")
+        tzinfo = _TIMEZONES.get(offset)
+        if tzinfo is None:
+            minutes = int(offset[1:3]) * 60 + int(offset[4:])
+            tzinfo = _TIMEZONES[offset] = timezone(timedelta(
+                minutes=-minutes if offset[0] == "-" else minutes))
+        return datetime.fromisoformat(local).replace(tzinfo=tzinfo)
+    except (ValueError, IndexError):
+        return dateutil_parse(text)
+
+
+class Event(dict):
+    """Event dict of the Google API, created and updated parsed on first use
+
+    Only item access parses them, get() and "in" do not see them before.
+
+    """
+    LAZY_TIMES = ('created', 'updated')
+
+    def __init__(self, event, raw_times):
+        dict.__init__(self, event)
+        self.raw_times = raw_times
+
+    def __missing__(self, key):
+        if key not in self.raw_times:
+            raise KeyError(key)
+        self[key] = value = parse_time(self.raw_times.pop(key))
+        return value
+
+
+def parse_event(event):
+    """Parse the times of an event dict returned by the Google API
+
+    A cancelled occurrence of a recurring event starts and ends at its
+    originalStartTime, of other cancelled events only the id is known.
+
+    All day events (a start date, no dateTime) do not switch channels,
+    they are returned as cancelled, to be removed from the store.
+
+    """
+    if "originalStartTime" in event:
+        if "dateTime" in event["originalStartTime"]:
+            event["originalStartTime"] = parse_time(
+                event["originalStartTime"]["dateTime"])
+        else:
+            del event["originalStartTime"]  # of an all day recurring event
+    if "dateTime" not in event.get("start", {}):
+        event["status"] = "cancelled"
+    if event.get("status") == "cancelled":
+        if "originalStartTime" in event:
+            event["start"] = event["end"] = event["originalStartTime"]
+        return event
+    if "recurrence" in event:
+        # the time zone the rules repeat in
+        event.setdefault("timeZone", event["start"].get("timeZone"))
+    event = Event(event, {key: event.pop(key) for key in Event.LAZY_TIMES
+                          if key in event})
+    event['start'] = parse_time(event['start']["dateTime"])
+    event['end'] = parse_time(event['end']["dateTime"])
+    return event
+
+
+def merge_events(event_streams):
+    """Merge event iterators sorted by start into one sorted by start"""
+    return heapq.merge(*event_streams, key=itemgetter("start"))
 
 
 def authorize():
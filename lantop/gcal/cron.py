@@ -6,30 +6,38 @@ from dateutil.tz import tzlocal
 
 from .. import utils
 
-from . client import EventImporter, EventImporterError
-from . parser import get_combined_actions, remove_duplicate_comments, Action
+from . client import EventImporter, EventImporterError, merge_events
+from . parser import remove_duplicate_comments, Action
+from . timeline import get_timeline_actions
 
 
 def main():
     """get event and generate crontab"""
     config = utils.load_config()
-    Action.set_defaults(config.devices.channel_names, **config.cron)
+    Action.set_defaults(config.device.channel_names, **config.cron)
     logger = logging.getLogger(__name__)
 
     # get events from Google Calendar
     now = datetime.now(tzlocal())
     try:
         gcal = EventImporter(**config.googleapi)
-        gcal.select_calendar(config.scheduler.calendar_name)
-        events = gcal.get_events(now - timedelta(days=1),
-                                 now + timedelta(**config.scheduler.time_span))
+        importers = []
+        for name in config.scheduler.calendar_names or \
+                [config.scheduler.calendar_name]:
+            importer = EventImporter(service=gcal.service, **config.googleapi)
+            importer.select_calendar(name)
+            importers.append(importer)
     except EventImporterError as err:
         logger.exception(err)
         return 1
 
-    # build cron file with data found in events
+    # build cron file with data found in events, fetched page by page
     try:
-        actions = remove_duplicate_comments(get_combined_actions(events))
+        start = now - timedelta(days=1)
+        end = now + timedelta(**config.scheduler.time_span)
+        events = merge_events(importer.iter_events(start, end)
+                              for importer in importers)
+        actions = remove_duplicate_comments(get_timeline_actions(events))
         entries = [str(action) for action in actions if action.time > now]
         logger.info("Imported %d actions from Google Calendar", len(entries))
 
@@ -0,0 +1,298 @@
+"""Import events from local iCalendar (.ics) files"""
+
+import os
+import re
+import logging
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+from dateutil.tz import gettz, tzlocal, UTC
+
+from . import recurrence
+from .client import merge_events
+from .source import EventSource
+
+logger = logging.getLogger(__name__)
+
+DURATION = re.compile(r"([-+])?P(?:(\d+)W)?(?:(\d+)D)?"
+                      r"(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+TEXT_ESCAPES = re.compile(r"\\([\\;,nN])")
+# recurring events are expanded this far beyond the end asked for, so
+# the next polls find them in the cache
+EXPAND_AHEAD = timedelta(days=7)
+
+
+def unfold(lines):
+    """Join the continuation lines of a content line"""
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def parse_line(line):
+    """Split a content line into name, parameters dict and value"""
+    quoted, colon = False, None
+    for index, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ":" and not quoted:
+            colon = index
+            break
+    if colon is None:
+        raise ValueError("Invalid content line {!r}".format(line))
+    name, *params = line[:colon].split(";")
+    params = {key.upper(): value.strip('"') for key, _, value
+              in (param.partition("=") for param in params)}
+    return name.upper(), params, line[colon + 1:]
+
+
+def iter_components(lines, component="VEVENT"):
+    """Yield the properties of each component as a dict of lists of
+    (parameters, value), one component in memory at a time"""
+    properties = None
+    for line in unfold(lines):
+        try:
+            name, params, value = parse_line(line)
+        except ValueError as error:
+            logger.warning("%s", error)
+            continue
+        if name == "BEGIN" and value.upper() == component:
+            properties = {}
+        elif name == "END" and value.upper() == component:
+            yield properties
+            properties = None
+        elif properties is not None:
+            properties.setdefault(name, []).append((params, value))
+
+
+def unescape(text):
+    return TEXT_ESCAPES.sub(lambda match: "\n" if match.group(1) in "nN"
+                            else match.group(1), text)
+
+
+def parse_datetime(value, params, default_tz=None):
+    """Parse a DATE-TIME value, None for a DATE"""
+    if params.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+        return None
+    time = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith(("Z", "z")):
+        return time.replace(tzinfo=UTC)
+    tzinfo = gettz(params["TZID"]) if "TZID" in params else None
+    return time.replace(tzinfo=tzinfo or default_tz or tzlocal())
+
+
+def parse_dates(properties, name, dtstart):
+    """Parse the DATE-TIME lists of a property (RDATE, EXDATE); a DATE is
+    the time of dtstart on that day"""
+    dates = []
+    for params, values in properties.get(name, ()):
+        for value in values.split(","):
+            if len(value) == 8 or params.get("VALUE", "").upper() == "DATE":
+                dates.append(datetime.strptime(value[:8], "%Y%m%d").replace(
+                    hour=dtstart.hour, minute=dtstart.minute,
+                    second=dtstart.second, tzinfo=dtstart.tzinfo))
+            elif params.get("VALUE", "").upper() != "PERIOD":
+                dates.append(parse_datetime(value, params, dtstart.tzinfo))
+    return dates
+
+
+def parse_duration(value):
+    match = DURATION.match(value)
+    if not match:
+        raise ValueError("Invalid duration {!r}".format(value))
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0),
+                         hours=int(hours or 0), minutes=int(minutes or 0),
+                         seconds=int(seconds or 0))
+    return -duration if sign == "-" else duration
+
+
+def parse_properties(lines):
+    """Get the properties of content lines (like the recurrence of a Google
+    event) as dict of lists of (parameters, value)"""
+    properties = {}
+    for line in lines:
+        name, params, value = parse_line(line)
+        properties.setdefault(name, []).append((params, value))
+    return properties
+
+
+def parse_recurrence(properties, dtstart):
+    """Get the occurrences of a recurring event as rruleset
+
+    :param properties: dict of RRULE, RDATE and EXDATE properties
+    :returns: None if there is no RRULE
+
+    """
+    rules = [value for _, value in properties.get("RRULE", ())]
+    if not rules:
+        return None
+    return recurrence.recurrence_set(
+        dtstart, rules, parse_dates(properties, "RDATE", dtstart),
+        parse_dates(properties, "EXDATE", dtstart))
+
+
+class IcsEvent(object):
+    """A VEVENT, with the occurrences of a recurring one"""
+
+    def __init__(self, properties):
+        def first(name, default=None):
+            return properties[name][0] if name in properties else default
+
+        self.uid = first("UID", ({}, ""))[1]
+        self.summary = unescape(first("SUMMARY", ({}, ""))[1])
+        self.description = unescape(first("DESCRIPTION", ({}, ""))[1])
+        self.cancelled = first("STATUS", ({}, ""))[1].upper() == "CANCELLED"
+        params, value = first("DTSTART", ({}, ""))
+        # all day events (and broken ones) do not switch channels
+        self.start = parse_datetime(value, params) if value else None
+        if self.start is None:
+            return
+        if "DTEND" in properties:
+            params, value = first("DTEND")
+            self.duration = parse_datetime(value, params) - self.start
+        elif "DURATION" in properties:
+            self.duration = parse_duration(first("DURATION")[1])
+        else:
+            self.duration = timedelta()
+        recurrence_id = first("RECURRENCE-ID")
+        self.recurrence_id = recurrence_id and parse_datetime(
+            recurrence_id[1], recurrence_id[0], self.start.tzinfo)
+        self.occurrences = parse_recurrence(properties, self.start)
+
+    def instance_id(self, start):
+        """Id of an occurrence, like Google's ids of event instances"""
+        return "{}_{:%Y%m%dT%H%M%SZ}".format(self.uid, start.astimezone(UTC))
+
+    def event(self, event_id, start):
+        return {"id": event_id, "summary": self.summary,
+                "description": self.description, "start": start,
+                "end": start + self.duration}
+
+    def events(self, start, end):
+        """Get the (occurrences as) event dicts overlapping a time range"""
+        if self.start is None or self.cancelled and not self.recurrence_id:
+            return []
+        if not self.occurrences:
+            if self.start < end and self.start + self.duration > start:
+                return [self.event(self.instance_id(self.recurrence_id)
+                                   if self.recurrence_id else self.uid,
+                                   self.start)]
+            return []
+        return [self.event(self.instance_id(occurrence), occurrence)
+                for occurrence in recurrence.expand(
+                    self.occurrences, self.duration, start, end)]
+
+
+def read_events(filename):
+    """Read the VEVENTs of an .ics file, skip (and log) invalid ones"""
+    ics_events = []
+    with open(filename, encoding="utf-8", errors="replace") as fp:
+        for properties in iter_components(fp):
+            try:
+                ics_events.append(IcsEvent(properties))
+            except (ValueError, KeyError, TypeError) as error:
+                uid = properties.get("UID", [({}, "")])[0][1]
+                logger.warning("%s: skipping event %r: %s", filename, uid,
+                               error)
+    return ics_events
+
+
+def expand_events(ics_events, start, end):
+    """Get the events overlapping a time range, sorted by start
+
+    Modified or cancelled occurrences (RECURRENCE-ID) replace the ones
+    of the recurring event.
+
+    """
+    events, overrides = {}, set()
+    for ics_event in ics_events:
+        if ics_event.start is None:
+            continue
+        if ics_event.recurrence_id:
+            event_id = ics_event.instance_id(ics_event.recurrence_id)
+            overrides.add(event_id)
+            events.pop(event_id, None)
+            if ics_event.cancelled:
+                continue
+        for event in ics_event.events(start, end):
+            if event["id"] not in overrides or ics_event.recurrence_id:
+                events[event["id"]] = event
+    return sorted(events.values(), key=itemgetter("start"))
+
+
+class IcsSource(EventSource):
+    """Events of an .ics file or of all .ics files of a directory
+
+    The files are only parsed again when they change, and the expansion
+    of a time range (plus EXPAND_AHEAD) is kept until they do.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._files = {}  # filename: (mtime, size, IcsEvents)
+        self._expanded = {}  # filename: (mtime, size, start, end, events)
+        self._synced = None  # file states and end of the last sync
+
+    def filenames(self):
+        if os.path.isdir(self.path):
+            return sorted(os.path.join(self.path, name)
+                          for name in os.listdir(self.path)
+                          if name.lower().endswith(".ics"))
+        return [self.path]
+
+    def _state(self, filename):
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self, filename, state):
+        cached = self._files.get(filename)
+        if cached and cached[:2] == state:
+            return cached[2]
+        logger.debug("Reading %s", filename)
+        ics_events = read_events(filename)
+        self._files[filename] = state + (ics_events,)
+        return ics_events
+
+    def _expand(self, filename, start, end):
+        state = self._state(filename)
+        cached = self._expanded.get(filename)
+        if cached and cached[:2] == state and \
+           cached[2] <= start and end <= cached[3]:
+            return [event for event in cached[4]
+                    if event["start"] < end and event["end"] > start]
+        events = expand_events(self._read(filename, state), start,
+                               end + EXPAND_AHEAD)
+        self._expanded[filename] = state + (start, end + EXPAND_AHEAD, events)
+        return [event for event in events if event["start"] < end]
+
+    def iter_events(self, start, end):
+        return merge_events(self._expand(filename, start, end)
+                            for filename in self.filenames())
+
+    def sync(self, store, start, end):
+        """Replace the events of a store if a file changed or the time
+        range goes beyond the last sync"""
+        filenames = self.filenames()
+        states = [(filename, self._state(filename)) for filename in filenames]
+        if self._synced and self._synced[0] == states and \
+           end <= self._synced[1]:
+            return None
+        store.clear()
+        changed = store.apply(self.iter_events(start, end + EXPAND_AHEAD))
+        self._synced = states, end + EXPAND_AHEAD
+        return changed
+
+    def reset(self):
+        self._files.clear()
+        self._expanded.clear()
+        self._synced = None
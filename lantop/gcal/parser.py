@@ -4,27 +4,78 @@ import re
 from datetime import timedelta
 from operator import attrgetter
 from itertools import groupby
+from collections import namedtuple
+
+
+class ChannelMatcher(object):
+    """Find channel names in event texts, compiled once for all events"""
+
+    def __init__(self, channel_names):
+        """Compile an alternation of the lowercased channel names
+
+        :param channel_names: list of channel names, the index in it is the
+                              channel number
+
+        """
+        self.index = {}
+        for index, name in enumerate(channel_names):
+            self.index.setdefault(name.lower(), index)
+        # texts are lowercased once, a case sensitive match is much faster
+        names = "|".join(map(re.escape, self.index)) or "(?!)"
+        # a lookahead matches at every position, so names within or
+        # overlapping others are found too; the alternation is in channel
+        # order, at each position the lowest numbered name wins
+        self.lowercase = re.compile("(?=(" + names + "))")
+        self.offsets = re.compile("(" + names + ")" +
+                                  "([+-][0-9]+)?([+-][0-9]+)?")  # offsets
+        self.names = re.compile(names, re.I | re.U)
+
+    def first(self, text):
+        """Get the lowest channel number whose name is in text, or None"""
+        names = self.lowercase.findall(text.lower())
+        return min(map(self.index.__getitem__, names)) if names else None
+
+    def find_offsets(self, text):
+        """Yield (channel, start offset, end offset) for names in text"""
+        for name, offset_start, offset_end in \
+                self.offsets.findall(text.lower()):
+            yield (self.index[name], int(offset_start or 0),
+                   int(offset_end or 0))
+
+    def remove(self, text):
+        """Remove all channel names from text"""
+        return self.names.sub('', text)
 
 
 class Action(object):
     """A crontab entry for lantop commands"""
+    __slots__ = ('time', 'label', 'args', 'owners', 'expires')
     channel_names = []
+    matcher = ChannelMatcher([])
     cron_user = cron_cmd = cron_arg = ''
 
     @classmethod
     def set_defaults(cls, channel_names, user='root', cmd='', arg='', **_):
         cls.channel_names = channel_names
+        cls.matcher = ChannelMatcher(channel_names)
         cls.cron_user = user
         cls.cron_cmd = cmd
         cls.cron_arg = arg
 
     NONE = object()  # sentinel value to seed sum of Actions
 
-    def __init__(self, time, args, label=""):
-        """Set parameters and format args for CronEvent"""
+    def __init__(self, time, args, label="", owners=None, expires=None):
+        """Set parameters and format args for CronEvent
+
+        :param owners: lock owner (event id) per channel
+        :param expires: when the lock of the owner is stale, per channel
+
+        """
         self.time = time
         self.label = label
         self.args = args
+        self.owners = owners or {}
+        self.expires = expires or {}
 
     def __str__(self):
         """Format entry for crontab"""
@@ -48,11 +99,14 @@ class Action(object):
         if self.time != other.time or self.cron_user != other.cron_user:
             return NotImplemented
         args, label = self.args.copy(), self.label
+        owners, expires = self.owners.copy(), self.expires.copy()
 
         args.update(other.args)
+        owners.update(other.owners)
+        expires.update(other.expires)
         if label != other.label:
             label += " + " + other.label
-        return type(self)(self.time, args, label)
+        return type(self)(self.time, args, label, owners, expires)
 
     def __radd__(self, other):
         """Radd to NoAction returns self"""
@@ -64,8 +118,26 @@ class Action(object):
             self.args == other.args and self.cron_user == other.cron_user
 
 
-def extract_actions_from_desc(event):
-    """Get triggers from event description
+# a channel is to be on from start to end for owner (an event id)
+Span = namedtuple('Span', 'channel start end owner label')
+
+
+def event_span(event, channel, start, end):
+    """Get the span of a channel turned on by an event"""
+    return Span(channel, start, end, event.get("id") or event["summary"],
+                event["summary"])
+
+
+def span_actions(span):
+    """Get the actions to lock a channel for a span"""
+    yield Action(span.start, {span.channel: "on"}, span.label,
+                 {span.channel: span.owner}, {span.channel: span.end})
+    yield Action(span.end, {span.channel: "auto"}, span.label,
+                 {span.channel: span.owner})
+
+
+def extract_spans_from_desc(event):
+    """Get spans from event description
 
     Mentioning a channel label in the description will turn this channel on for
     the duration of the event. Optionally start and end time offsets can be
@@ -75,69 +147,95 @@ def extract_actions_from_desc(event):
     :param event: event dict to examine
 
     """
-    prog = re.compile("(" + "|".join(list(Action.channel_names)) + ")" +
-                      "([+-][0-9]+)?([+-][0-9]+)?",           # offsets
-                      re.I | re.U)
-
-    for match in prog.findall(event.get("description", '')):
-        name = match[0].lower()
-        index = Action.channel_names.index(name)
-        offset_start = int(match[1]) \
-            if len(match) > 1 and len(match[1]) > 0 else 0
-        offset_end = int(match[2]) \
-            if len(match) > 2 and len(match[2]) > 0 else 0
-
+    for index, offset_start, offset_end in Action.matcher.find_offsets(
+            event.get("description", '')):
         start = event["start"] + timedelta(minutes=offset_start)
         end = event["end"] + timedelta(minutes=offset_end)
         if start < end:
-            yield Action(start, {index: "on"}, event["summary"])
-            yield Action(end, {index: "auto"}, event["summary"])
+            yield event_span(event, index, start, end)
 
 
-def extract_actions(events):
-    """Extract actions from events based on the summary
+def extract_spans(events):
+    """Extract the spans channels are on from events
 
-    Yields a LantopCronAction object for extracted action. Each event summary
-    is searched for the channel labels (one action per event). If none are
-    found the event description is parsed (can contain multiple action per
-    event)
+    Each event summary is searched for the channel labels (one channel per
+    event). If none are found the event description is parsed (can contain
+    multiple channels per event)
 
     :param events: list of event dicts return by Google API
 
     """
+    matcher = Action.matcher
     for event in events:
-        for index, name in enumerate(Action.channel_names):
-            # Check if the channel name is in the event title
-            if name.lower() in event["summary"].lower():
-                yield Action(event["start"], {index: "on"}, event["summary"])
-                yield Action(event["end"], {index: "auto"}, event["summary"])
-                break  # only one channel per event
+        # Check if a channel name is in the event title
+        index = matcher.first(event["summary"])
+        if index is not None:
+            yield event_span(event, index, event["start"], event["end"])
         else:
-            yield from extract_actions_from_desc(event)
+            yield from extract_spans_from_desc(event)
 
 
-def get_combined_actions(events):
+def extract_actions_from_desc(event):
+    """Get triggers from event description (see extract_spans_from_desc)"""
+    for span in extract_spans_from_desc(event):
+        yield from span_actions(span)
+
+
+def extract_actions(events):
+    """Extract actions from events based on the summary
+
+    Yields a LantopCronAction object for extracted action, an "on" and an
+    "auto" for each span (see extract_spans).
+
+    :param events: list of event dicts return by Google API
+
+    """
+    for span in extract_spans(events):
+        yield from span_actions(span)
+
+
+def combine_group(time, actions):
+    """Combine actions of the same time into one in a single pass
+
+    Later actions override the args of earlier ones for the same channel,
+    labels are joined in order of their first appearance.
+
+    """
+    args, owners, expires, labels = {}, {}, {}, {}
+    for action in actions:
+        args.update(action.args)
+        owners.update(action.owners)
+        expires.update(action.expires)
+        labels[action.label] = None
+    return Action(time, args, " + ".join(labels), owners, expires)
+
+
+def combine_actions(actions):
     """Combine actions triggered at the same time"""
-    actions = sorted(extract_actions(events), key=attrgetter('time'))
-    return [sum(action_group, Action.NONE)
-            for _, action_group in groupby(actions, key=attrgetter('time'))]
+    actions = sorted(actions, key=attrgetter('time'))
+    return [combine_group(time, action_group)
+            for time, action_group in groupby(actions, key=attrgetter('time'))]
+
+
+def get_combined_actions(events):
+    """Get the actions of events, combined by time"""
+    return combine_actions(extract_actions(events))
 
 
 def remove_duplicate_comments(actions):
     """Remove same comments in consecutive actions to get nicer crontab file"""
     last_comment = None
     for action in actions:
-        if action.comment == last_comment:
-            action.comment = None
+        if action.label == last_comment:
+            action.label = None
         else:
-            last_comment = action.comment
+            last_comment = action.label
     return actions
 
 
 def simplify_label(action):
     """Get a nice title of an action"""
-    names = re.compile('(' + '|'.join(action.channel_names) + ')', re.I)
-    labels = {names.sub('', label).strip(' :(),-')
+    labels = {action.matcher.remove(label).strip(' :(),-')
               for label in action.label.split(' + ')}
     labels.discard('')
     return ' + '.join(labels) or action.label
@@ -0,0 +1,93 @@
+"""Expansion of recurring events (RFC 5545 RRULE, RDATE and EXDATE)"""
+
+import re
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from dateutil.rrule import rruleset, rrulestr
+from dateutil.tz import UTC
+
+UNTIL = re.compile(r"UNTIL=(\d{8}(?:T\d{6})?)(Z?)", re.I)
+
+
+def _until_utc(rule, tzinfo):
+    """Make a floating UNTIL of a rule UTC (dateutil requires it for an
+    aware DTSTART)"""
+    def replace(match):
+        if match.group(2):
+            return match.group(0)
+        if "T" in match.group(1):
+            until = datetime.strptime(match.group(1), "%Y%m%dT%H%M%S")
+        else:  # the whole day
+            until = datetime.strptime(match.group(1) + "235959",
+                                      "%Y%m%d%H%M%S")
+        return "UNTIL=" + until.replace(tzinfo=tzinfo).astimezone(
+            UTC).strftime("%Y%m%dT%H%M%SZ")
+    return UNTIL.sub(replace, rule)
+
+
+def recurrence_set(dtstart, rules, rdates=(), exdates=()):
+    """Get the occurrences of a recurring event as a dateutil rruleset
+
+    As RFC 5545 requires, DTSTART is always the first occurrence.
+
+    :param dtstart: aware start time of the first occurrence
+    :param rules: RRULE values, like "FREQ=WEEKLY;BYDAY=MO,WE"
+
+    """
+    occurrences = rruleset()
+    for rule in rules:
+        occurrences.rrule(rrulestr(_until_utc(rule, dtstart.tzinfo),
+                                   dtstart=dtstart))
+    occurrences.rdate(dtstart)
+    for rdate in rdates:
+        occurrences.rdate(rdate)
+    for exdate in exdates:
+        occurrences.exdate(exdate)
+    return occurrences
+
+
+def expand(occurrences, duration, start, end):
+    """Get the start times of the occurrences overlapping a time range
+
+    :param occurrences: rruleset (see recurrence_set)
+    :param duration: timedelta of each occurrence
+
+    """
+    return occurrences.between(start - duration, end)
+
+
+class Occurrences(object):
+    """Occurrences of a recurring event, expanded lazily as time passes
+
+    The start times are generated up to the end of the time range asked
+    for and kept; a later (moving) time range only generates the ones
+    beyond, instead of expanding the rules from DTSTART again.
+
+    """
+
+    def __init__(self, occurrences, duration):
+        """:param occurrences: rruleset (see recurrence_set)
+        :param duration: timedelta of each occurrence"""
+        self.occurrences = occurrences
+        self.duration = duration
+        self._restart()
+
+    def _restart(self):
+        self._iter = iter(self.occurrences)
+        self._next = next(self._iter, None)
+        self.starts = []  # generated start times before self._next
+        self.begin = None  # earlier start times are dropped
+
+    def expand(self, start, end):
+        """Get the start times of the occurrences overlapping a time range"""
+        begin = start - self.duration
+        if self.begin is not None and begin < self.begin:
+            self._restart()  # dropped already
+        while self._next is not None and self._next < end:
+            if self._next > begin:
+                self.starts.append(self._next)
+            self._next = next(self._iter, None)
+        del self.starts[:bisect_right(self.starts, begin)]
+        self.begin = begin
+        return self.starts[:bisect_left(self.starts, end)]
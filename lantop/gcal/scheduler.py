@@ -1,17 +1,26 @@
 """Crond like scheduler"""
 
 import time
+import heapq
 import sched
 from datetime import datetime, timedelta
 from dateutil.tz import tzlocal
 import logging
 import logging.config
 import functools
+from concurrent.futures import ThreadPoolExecutor
 
-from . import parser, client, authenticator, __version__
+import httplib2
+
+from . import parser, timeline, client, authenticator, __version__
+from .ics import IcsSource
+from .store import EventStore, SqliteEventStore
 
 from .. import Lantop, utils
-from ..lock_counts import LockCounts
+from ..history import HistoryLog
+from ..lock_counts import BACKENDS as LOCK_BACKENDS, device_key
+from ..lock_service import LockService
+from ..stats import StatsStore, StatsSampler
 
 
 class NeedAuthError(Exception):
@@ -20,83 +29,369 @@ class NeedAuthError(Exception):
 logger = logging.getLogger(__name__)
 
 
+def job_key(time, argument):
+    """Hashable key of a scheduled call of lantop_updater"""
+    args, label, owners, expires = argument
+    return (time, label, tuple(sorted(args.items())),
+            tuple(sorted(owners.items())), tuple(sorted(expires.items())))
+
+
+def google_calendar(importer_kwargs, name):
+    """Connect to Google and select a calendar"""
+    importer = client.EventImporter(**importer_kwargs)
+    importer.select_calendar(name)
+    return importer
+
+
+class CalendarImport(object):
+    """Sync state of one calendar: its event source and store"""
+
+    def __init__(self, name, store, make_source):
+        """:param make_source: function returning the EventSource"""
+        self.name = name
+        self.store = store
+        self.make_source = make_source
+        self.source = None  # kept across polls until an error
+        self.need_auth = False
+
+    def sync(self, since, end):
+        """Sync the store, connect on first use
+
+        :returns: number of changed events, None if not modified
+
+        """
+        if self.source is None:
+            self.source = self.make_source()
+        return self.source.sync(self.store, since, end)
+
+    def reset(self):
+        """Reconnect (and look up the calendar again) on the next sync"""
+        if self.source:
+            self.source.reset()
+        self.source = None
+
+
 class JobUpdater:
-    def __init__(self, googleapi, calendar_name, time_span, **_):
+    def __init__(self, googleapi, calendar_name, time_span,
+                 calendar_names=None, ics_paths=None, store=EventStore, **_):
+        """Set up the import of calendars
+
+        :param calendar_names: Google calendars to merge (instead of
+                               calendar_name)
+        :param ics_paths: iCalendar files or directories to merge, without
+                          calendar_names the Google calendar_name is not used
+        :param store: EventStore class (or factory) to keep the events of
+                      a calendar in, called with the calendar name
+
+        """
         self.event_importer_kwargs = googleapi
-        self.calendar_name = calendar_name
+        ics_paths = ics_paths or []
+        self.calendar_names = calendar_names or \
+            ([] if ics_paths else [calendar_name])
         self.time_span = timedelta(**time_span)
+        # synchronized incrementally across polls
+        self.calendars = [
+            CalendarImport(name, store(calendar=name), functools.partial(
+                google_calendar, googleapi, name))
+            for name in self.calendar_names
+        ] + [
+            CalendarImport(path, store(calendar=path), functools.partial(
+                IcsSource, path))
+            for path in ics_paths
+        ]
+        self.pool = ThreadPoolExecutor(len(self.calendars))
 
         self.logger = logger.getChild('update_jobs')
 
         self.wait_for_auth = False
+        self.jobs = {}  # job_key: scheduler event of the scheduled actions
+        self.scheduled_at = None  # time of the last (re)scheduling
+        self.skipped_polls = 0  # polls without changes, nothing rescheduled
 
-    def run(self, scheduler, lantop_updater):
+    def run(self, scheduler, lantop_updater, lease_renewer=None):
         if self.wait_for_auth:
             return
+        self.update(scheduler, lantop_updater, lease_renewer)
+
+    def sync_calendar(self, calendar, since, end):
+        """Sync a calendar, errors only stop the sync of this calendar
+
+        :returns: number of changed events, None if none or on error
+
+        """
         try:
-            self.update(scheduler, lantop_updater)
-        except client.Error as error:
-            self.logger.error(error)
+            return calendar.sync(since, end)
+        except (client.AuthorizationMissing, client.AuthError) as error:
+            self.logger.error("Calendar %r: %s", calendar.name, error)
+            calendar.source = None  # reconnect with the new credentials
+            calendar.need_auth = True
+        except (client.Error, httplib2.HttpLib2Error, OSError,
+                ValueError) as error:
+            # actions scheduled from the stored events are kept
+            self.logger.error("Calendar %r not synchronized: %s",
+                              calendar.name, error)
+            calendar.reset()
+            calendar.need_auth = isinstance(error, client.HttpError) and \
+                error.resp.status == 401
+        except Exception:
+            # an unexpected error must not stop the other calendars either
+            self.logger.exception("Calendar %r not synchronized",
+                                  calendar.name)
+            calendar.reset()
+        return None
+
+    def update(self, scheduler, lantop_updater, lease_renewer=None):
+        start = scheduler.timefunc()
+        # look back, so events merged with ended ones keep their lock owner
+        since = start - timedelta(days=1)
+        end = start + self.time_span
+        for calendar in self.calendars:
+            calendar.need_auth = False
+        # calendars are fetched concurrently, each with its own connection
+        changed = list(self.pool.map(self.sync_calendar, self.calendars,
+                                     [since] * len(self.calendars),
+                                     [end] * len(self.calendars)))
+
+        # unchanged events need no rescheduling, until the end of the time
+        # span scheduled last approaches
+        if not any(changed) and self.scheduled_at is not None and \
+           start < self.scheduled_at + self.time_span / 2:
+            self.skipped_polls += 1
+            self.logger.debug("No changes (%d polls skipped, %d not "
+                              "modified)", self.skipped_polls,
+                              sum(getattr(calendar.source, "not_modified", 0)
+                                  for calendar in self.calendars))
+        else:
+            self.schedule(scheduler, lantop_updater, lease_renewer,
+                          sum(filter(None, changed)))
+
+        if any(calendar.need_auth for calendar in self.calendars):
             raise NeedAuthError()
 
-    def update(self, scheduler, lantop_updater):
-        gcal = client.EventImporter(**self.event_importer_kwargs)
-        gcal.select_calendar(self.calendar_name)
+    def schedule(self, scheduler, lantop_updater, lease_renewer=None,
+                 changed=0):
+        """(Re)schedule the actions of the stored events
 
+        Called without a sync at startup, to schedule from the events
+        stored before. Only the actions that changed since the last call
+        are cancelled and entered, the others keep their scheduler events.
+
+        """
         start = scheduler.timefunc()
         end = start + self.time_span
-        events = gcal.get_events(start, end)
-        actions = [action for action in parser.get_combined_actions(events)
+        since = start - timedelta(days=1)
+        self.scheduled_at = start
+        event_lists = []
+        for calendar in self.calendars:
+            calendar.store.prune(since)
+            event_lists.append(calendar.store.get_events(since, end))
+        events = client.merge_events(event_lists)
+        spans = timeline.compile_timeline(parser.extract_spans(events))
+        actions = [action for action in timeline.timeline_actions(spans)
                    if start < action.time < end]
 
-        self.logger.info("Scheduling %d actions from %d Google Calender events",
-                         len(actions), len(events))
-
-        for event in scheduler.queue:
-            if event.action == lantop_updater:
-                scheduler.cancel(event)
+        jobs, added = {}, 0
         for action in actions:
-            scheduler.enterabs(
-                time=action.time,
-                priority=1,
-                action=lantop_updater,
-                argument=(action.args, parser.simplify_label(action))
-            )
-            self.logger.debug('Adding {0.label!r:50} '
-                              'at {0.time} with {0.args}'.format(action))
+            argument = (action.args, parser.simplify_label(action),
+                        action.owners, action.expires)
+            key = job_key(action.time, argument)
+            job = self.jobs.pop(key, None)
+            if job is None:
+                job = scheduler.enterabs(
+                    time=action.time,
+                    priority=1,
+                    action=lantop_updater,
+                    argument=argument
+                )
+                self.logger.debug('Adding {0.label!r:50} '
+                                  'at {0.time} with {0.args}'.format(action))
+                added += 1
+            jobs[key] = job
+        # the ones that have run already are no longer cancelled
+        removed = sum(map(scheduler.cancel_lazily, self.jobs.values()))
+        self.jobs = jobs
+
+        self.logger.info("Scheduled %d actions from %d calendar events "
+                         "(%d added, %d cancelled; %d events changed, %d "
+                         "polls skipped so far)", len(actions),
+                         sum(map(len, event_lists)), added, removed,
+                         changed, self.skipped_polls)
+
+        # spans in progress may have grown since their "on"
+        if lease_renewer:
+            lease_renewer([span for span in spans
+                           if span.start <= start < span.end])
 
 
 class LantopStateChanger:
-    def __init__(self, address, channel_names, retries=5, **_):
+    def __init__(self, address, channel_names, retries=5, history=None,
+                 stats=None, locks=None, lock_backend='json', **_):
         if not address:
             raise ValueError('Missing device address setting')
         self.lantop_args = address + [retries]
         self.channel_names = channel_names
-
-    def update_states(self, change_list, label):
+        # in-memory lock counters, written behind to the lock backend
+        self.locks = locks or LockService(
+            backend=LOCK_BACKENDS[lock_backend])
+        self.history = history  # a HistoryLog to record new states
+        self.stats = stats  # a StatsSampler
+        self.serial = None  # of the device, known after the first change
+
+    def update_states(self, change_list, label, owners=None, expires=None):
         logger.getChild('update_states').info(
             'Setting %r for event %r', change_list, label)
+        owners, expires = owners or {}, expires or {}
 
-        device = Lantop(*self.lantop_args)
-        with device, LockCounts() as with_locks:
-            for channel, state in change_list.items():
-                with_locks.apply(device.set_state, channel, state)
+        with Lantop(*self.lantop_args) as device:
+            self.serial = device.get_info()[1]
+            with self.locks.counts(self.serial).transaction() as with_locks:
+                decisions = with_locks.apply_many(
+                    device.set_states, change_list, owners,
+                    {channel: end.timestamp()
+                     for channel, end in expires.items()})
 
             time.sleep(5.0)  # else, the reported states can be outdated
-            new_states = ['{active:d}'.format(**ch) for ch in device.get_states()]
+            raw_states = device.get_raw_states()
+            states = device.decode_states(raw_states)
+            if self.history:
+                self.history.append(states, device=device.get_info()[1],
+                                    raw_states=raw_states)
+            new_states = ['{active:d}'.format(**ch) for ch in states]
             logger.getChild('monitor').info(
                 'Event: %r\n%s\nStates: %s', label or '(no label)',
-                '\n'.join('{}: {}'.format(self.channel_names[ch], state)
-                          for ch, state in sorted(change_list.items())),
+                '\n'.join('{}: {}{}'.format(
+                    self.channel_names[decision.channel], decision.state,
+                    '' if decision.applied else
+                    ' (locked {:d}x)'.format(decision.locks))
+                    for decision in decisions),
                 ' '.join(new_states))
 
+    def renew_leases(self, spans):
+        """Extend the leases of spans in progress to their (new) end"""
+        if not spans:
+            return
+        if self.serial is None:
+            with Lantop(*self.lantop_args) as device:
+                self.serial = device.get_info()[1]
+        key = device_key(self.serial)
+        for span in spans:
+            if self.locks.renew(key, span.channel, span.owner,
+                                span.end.timestamp()):
+                logger.getChild('renew_leases').info(
+                    'Extended lock of %r on %s until %s', span.label,
+                    self.channel_names[span.channel], span.end)
+
+    def expire_locks(self):
+        """Release stale leases, set channels left without locks to auto
+
+        The leases are only released once the channels are set, if the
+        device can't be reached they expire again with the next call.
+
+        """
+        if not self.locks.leases.due():
+            return
+        with Lantop(*self.lantop_args) as device:
+            key = device_key(device.get_info()[1])
+
+            def unlock(unlocked):
+                for channel in sorted(ch for k, ch in unlocked if k == key):
+                    device.set_state(channel, 'auto')
+                    logger.getChild('expire_locks').warning(
+                        'Set %s to auto after its lock expired',
+                        self.channel_names[channel])
+            self.locks.expire(unlock=unlock)
+
     def sync_time(self):
         with Lantop(*self.lantop_args) as device:
             device.set_time()
         logger.getChild('sync_time').info('Updated time on device')
 
+    def sample_stats(self):
+        with Lantop(*self.lantop_args) as device:
+            self.stats.sample(device)
+        logger.getChild('sample_stats').debug('Sampled channel statistics')
+
 
 class Scheduler(sched.scheduler):
+    """sched.scheduler that can also cancel events without a queue search
+
+    The events not run or cancelled yet are known by id (Event.sequence
+    only exists since Python 3.10); a pending event is in the heap, so its
+    id can't be reused. Lazily cancelled events stay in the heap and are
+    skipped when due; once they are the majority, the heap is rebuilt
+    without them.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = set()  # ids of the upcoming events
+        self._stale = 0  # lazily cancelled events left in the heap
+
+    def enterabs(self, *args, **kwargs):
+        event = super().enterabs(*args, **kwargs)
+        with self._lock:
+            self._pending.add(id(event))
+        return event
+
+    def cancel(self, event):
+        # by identity, before 3.10 events of the same time compare equal
+        if not self.cancel_lazily(event):
+            raise ValueError(event)
+
+    def cancel_lazily(self, event):
+        """Cancel an event (as returned by enter) in O(1)
+
+        :returns: False if it has run or was cancelled already
+
+        """
+        with self._lock:
+            if id(event) not in self._pending:
+                return False
+            self._pending.remove(id(event))
+            self._stale += 1
+            if 2 * self._stale > len(self._queue):
+                # in place, run() holds on to the list
+                self._queue[:] = [event for event in self._queue
+                                  if id(event) in self._pending]
+                heapq.heapify(self._queue)
+                self._stale = 0
+            return True
+
+    def empty(self):
+        with self._lock:
+            return not self._pending
+
+    @property
+    def queue(self):
+        """Sorted list of the upcoming events"""
+        with self._lock:
+            return sorted(event for event in self._queue
+                          if id(event) in self._pending)
+
+    def run(self, blocking=True):
+        """Execute events like sched.scheduler.run, skip the cancelled ones"""
+        queue = self._queue
+        while True:
+            with self._lock:
+                if not queue:
+                    break
+                event = queue[0]
+                now = self.timefunc()
+                delay = event.time > now
+                if not delay:
+                    heapq.heappop(queue)
+                    if id(event) not in self._pending:
+                        self._stale -= 1
+                        continue
+                    self._pending.remove(id(event))
+            if delay:
+                if not blocking:
+                    return event.time - now
+                self.delayfunc(event.time - now)
+            else:
+                event.action(*event.argument, **event.kwargs)
+                self.delayfunc(0)  # let other threads run
 
     def enter_per(self, delay, priority, action, argument=(), kwargs=None):
         """Enter an action to be executed now and then periodically"""
@@ -122,8 +417,17 @@ def main():
     logging.config.dictConfig(config.get('logging', {}))
     parser.Action.set_defaults(config.device.channel_names, **config.cron)
 
-    job_updater = JobUpdater(config.googleapi, **config.scheduler)
-    lantop_worker = LantopStateChanger(**config.device)
+    job_updater = JobUpdater(config.googleapi, store=functools.partial(
+        SqliteEventStore, config.scheduler.store_path), **config.scheduler)
+    history = HistoryLog(config.history.path, config.history.segment_records) \
+        if config.history.scheduler else None
+    stats = StatsSampler(StatsStore(config.stats.path)) \
+        if config.stats.sample_interval else None
+    locks = LockService(backend=LOCK_BACKENDS[config.device.lock_backend],
+                        **config.locks)
+    locks.serve(config.locks.socket)
+    lantop_worker = LantopStateChanger(history=history, stats=stats,
+                                       locks=locks, **config.device)
     try:
         auth_flow = authenticator.Flow(config.googleapi, **config.pb_authenticator)
     except ValueError:
@@ -134,11 +438,14 @@ def main():
         timefunc=lambda: datetime.now(tzlocal()),
         delayfunc=Scheduler.sleep_with_timedelta
     )
+    # schedule from the stored events at once, the first poll updates them
+    job_updater.schedule(scheduler, lantop_worker.update_states)
     scheduler.enter_per(
         delay=timedelta(**config.scheduler.poll_interval),
         priority=1,
         action=job_updater.run,
-        argument=(scheduler, lantop_worker.update_states),
+        argument=(scheduler, lantop_worker.update_states,
+                  lantop_worker.renew_leases),
     )
     if config.device.time_sync_interval:
         scheduler.enter_per(
@@ -146,6 +453,23 @@ def main():
             priority=2,
             action=lantop_worker.sync_time
         )
+    if stats:
+        scheduler.enter_per(
+            delay=timedelta(**config.stats.sample_interval),
+            priority=2,
+            action=lantop_worker.sample_stats
+        )
+    scheduler.enter_per(
+        delay=timedelta(seconds=config.locks.expire_interval),
+        priority=2,
+        action=lantop_worker.expire_locks
+    )
+    if config.locks.fsync_interval:
+        scheduler.enter_per(
+            delay=timedelta(seconds=config.locks.fsync_interval),
+            priority=2,
+            action=locks.sync
+        )
     if auth_flow:
         scheduler.enter_per(
             delay=timedelta(**config.pb_authenticator.poll_interval),
@@ -171,3 +495,7 @@ def main():
 
         except KeyboardInterrupt:
             break
+
+    locks.close()
+    for calendar in job_updater.calendars:
+        calendar.store.close()
@@ -0,0 +1,28 @@
+"""Interface of the sources the scheduler imports events from"""
+
+
+class EventSource(object):
+    """Source of calendar events, e.g. Google Calendar or iCalendar files
+
+    Events are dicts with at least id, summary, start and end (aware
+    datetimes) and optionally description and updated.
+
+    """
+
+    def iter_events(self, start, end):
+        """Iterate over the events overlapping a time range, by start"""
+        raise NotImplementedError
+
+    def sync(self, store, start, end):
+        """Update an EventStore with the events of a time range
+
+        Sources without incremental sync replace all events of the store.
+
+        :returns: number of changed events, None if not modified
+
+        """
+        store.clear()
+        return store.apply(self.iter_events(start, end))
+
+    def reset(self):
+        """Drop connections and cached state after an error"""
@@ -0,0 +1,288 @@
+"""Local copy of the events of a calendar, kept up to date incrementally"""
+
+import os
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from operator import itemgetter
+
+from dateutil.tz import gettz
+
+from ..consts import EVENTS_PATH
+from .client import parse_event
+from .ics import parse_properties, parse_recurrence
+from .recurrence import Occurrences
+
+logger = logging.getLogger(__name__)
+
+# the end of recurring events, they are kept until deleted
+FOREVER = datetime.max.replace(tzinfo=timezone.utc)
+
+
+def time_bounds(event):
+    """Get the time range a store finds an event in
+
+    A recurring event is found from its start on. A modified or cancelled
+    occurrence (exception) is also found at the time it replaces.
+
+    """
+    if "recurrence" in event:
+        return event["start"], FOREVER
+    if "originalStartTime" in event:
+        original = event["originalStartTime"]
+        return min(event["start"], original), max(event["end"], original)
+    return event["start"], event["end"]
+
+
+def instance_id(event_id, start):
+    """Id of an occurrence of a recurring event, as Google's"""
+    return "{}_{:%Y%m%dT%H%M%SZ}".format(event_id,
+                                        start.astimezone(timezone.utc))
+
+
+def recurring_occurrences(event):
+    """Get the Occurrences of a recurring event dict, None if not"""
+    start = event["start"]
+    tzinfo = event.get("timeZone") and gettz(event["timeZone"])
+    occurrences = parse_recurrence(
+        parse_properties(event["recurrence"]),
+        start.astimezone(tzinfo) if tzinfo else start)
+    return occurrences and Occurrences(occurrences,
+                                       event["end"] - event["start"])
+
+
+class EventStore(object):
+    """Events by id and the sync token of the last synchronization"""
+
+    def __init__(self, calendar=""):
+        """:param calendar: name of the calendar the events are of"""
+        self.calendar = calendar
+        self.events = {}
+        self.sync_token = None
+        # recurring event id: (its rules, Occurrences)
+        self.recurring = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def clear(self):
+        """Forget all events, the next sync is a full one"""
+        self.events.clear()
+        self.sync_token = None
+
+    def apply(self, events):
+        """Add, replace or (if cancelled) remove events
+
+        Cancelled occurrences of recurring events are kept, to be left out
+        when the recurring event is expanded.
+
+        :param events: parsed event dicts of a (full or incremental) sync
+        :returns: number of changed events
+
+        """
+        changed = 0
+        for event in events:
+            if event.get("status") == "cancelled" and \
+               "originalStartTime" not in event:
+                changed += self.events.pop(event["id"], None) is not None
+            else:
+                self.events[event["id"]] = event
+                changed += 1
+        return changed
+
+    def prune(self, before):
+        """Remove the events that ended before a time"""
+        for event_id in [event_id for event_id, event in self.events.items()
+                         if time_bounds(event)[1] < before]:
+            del self.events[event_id]
+
+    def get_events(self, start, end):
+        """Get the events overlapping a time range, sorted by start
+
+        Recurring events are replaced by their occurrences (see expand).
+
+        """
+        return self.expand(sorted(
+            (event for event in self.events.values()
+             if time_bounds(event)[1] > start and time_bounds(event)[0] < end),
+            key=itemgetter("start")), start, end)
+
+    def expand(self, events, start, end):
+        """Replace recurring events by their occurrences in a time range
+
+        The expansion of each recurring event is kept until its rules
+        change, later time ranges only expand the occurrences beyond.
+        Exceptions replace the occurrences at their originalStartTime.
+
+        :param events: events in the time range sorted by start, with the
+                       recurring events and exceptions (see time_bounds)
+
+        """
+        result = [event for event in events
+                  if "recurrence" not in event and
+                  event.get("status") != "cancelled" and
+                  event["end"] > start and event["start"] < end]
+        recurring = [event for event in events if "recurrence" in event]
+        expansions = {}
+        if not recurring:
+            self.recurring = expansions
+            return result
+        replaced = {(event["recurringEventId"], event["originalStartTime"])
+                    for event in events if "originalStartTime" in event}
+        for event in recurring:
+            rules = (event["start"], event["end"], event.get("timeZone"),
+                     tuple(event["recurrence"]))
+            cached_rules, occurrences = self.recurring.get(
+                event["id"], (None, None))
+            if cached_rules != rules:
+                try:
+                    occurrences = recurring_occurrences(event)
+                except (ValueError, KeyError) as error:
+                    logger.warning("Skipping recurring event %r: %s",
+                                   event["id"], error)
+                    continue
+            expansions[event["id"]] = rules, occurrences
+            if occurrences is None:  # no RRULE, just the event
+                occurrence_starts = [event["start"]] \
+                    if event["end"] > start else []
+            else:
+                occurrence_starts = occurrences.expand(start, end)
+            duration = event["end"] - event["start"]
+            for occurrence_start in occurrence_starts:
+                if (event["id"], occurrence_start) not in replaced:
+                    result.append(self.occurrence(event, occurrence_start,
+                                                  occurrence_start + duration))
+        self.recurring = expansions  # of the events still recurring
+        return sorted(result, key=itemgetter("start"))
+
+    @staticmethod
+    def occurrence(event, start, end):
+        occurrence = dict(event, id=instance_id(event["id"], start),
+                          start=start, end=end, recurringEventId=event["id"],
+                          originalStartTime=start)
+        del occurrence["recurrence"]
+        return occurrence
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    calendar TEXT NOT NULL,
+    id TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    event TEXT NOT NULL,
+    PRIMARY KEY (calendar, id)
+);
+CREATE INDEX IF NOT EXISTS events_start ON events (calendar, start_time);
+CREATE INDEX IF NOT EXISTS events_end ON events (calendar, end_time);
+CREATE TABLE IF NOT EXISTS sync_tokens (
+    calendar TEXT PRIMARY KEY,
+    token TEXT
+);
+"""
+
+
+def dump_event(event):
+    """Serialize a parsed event dict in the form the Google API returns it"""
+    data = dict(getattr(event, "raw_times", {}))
+    for key, value in event.items():
+        if isinstance(value, datetime):
+            value = value.isoformat()
+            if key in ("start", "end", "originalStartTime"):
+                value = {"dateTime": value}
+        data[key] = value
+    return json.dumps(data)
+
+
+class SqliteEventStore(EventStore):
+    """EventStore kept in an SQLite database, to schedule from at startup
+
+    The events of several calendars can be kept in one database, each
+    calendar has its own store object (and connection).
+
+    """
+
+    def __init__(self, path=None, calendar=""):
+        """Open or create the database
+
+        :param path: database file (default consts.EVENTS_PATH)
+        :param calendar: name of the calendar the events are of
+
+        """
+        self.path = path or EVENTS_PATH
+        self.calendar = calendar
+        self.recurring = {}
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # synced in a worker thread, read in the scheduler's
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM events "
+                               "WHERE calendar = ?",
+                               (self.calendar,)).fetchone()[0]
+
+    @property
+    def sync_token(self):
+        row = self.db.execute("SELECT token FROM sync_tokens "
+                              "WHERE calendar = ?",
+                              (self.calendar,)).fetchone()
+        return row and row[0]
+
+    @sync_token.setter
+    def sync_token(self, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_tokens "
+                            "VALUES (?, ?)", (self.calendar, value))
+
+    @property
+    def events(self):
+        return {event["id"]: event for event in self._select("")}
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM events WHERE calendar = ?",
+                            (self.calendar,))
+            self.db.execute("DELETE FROM sync_tokens WHERE calendar = ?",
+                            (self.calendar,))
+
+    def apply(self, events):
+        changed = 0
+        with self.db:
+            for event in events:
+                if event.get("status") == "cancelled" and \
+                   "originalStartTime" not in event:
+                    changed += self.db.execute(
+                        "DELETE FROM events WHERE calendar = ? AND id = ?",
+                        (self.calendar, event["id"])).rowcount
+                else:
+                    start, end = time_bounds(event)
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO events "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (self.calendar, event["id"], start.timestamp(),
+                         end.timestamp(), dump_event(event)))
+                    changed += 1
+        return changed
+
+    def prune(self, before):
+        with self.db:
+            self.db.execute("DELETE FROM events "
+                            "WHERE calendar = ? AND end_time < ?",
+                            (self.calendar, before.timestamp()))
+
+    def _select(self, where, *args):
+        return [parse_event(json.loads(row[0])) for row in self.db.execute(
+            "SELECT event FROM events WHERE calendar = ? " + where +
+            " ORDER BY start_time", (self.calendar,) + args)]
+
+    def get_events(self, start, end):
+        return self.expand(self._select("AND end_time > ? AND start_time < ?",
+                                        start.timestamp(), end.timestamp()),
+                           start, end)
+
+    def close(self):
+        self.db.close()
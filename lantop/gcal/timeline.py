@@ -0,0 +1,59 @@
+"""Compile calendar events to the minimal channel state transitions"""
+
+from . parser import Span, extract_spans, span_actions, combine_actions
+
+START, END = 0, 1  # starts sort before ends, so abutting spans merge
+
+
+def compile_timeline(spans):
+    """Merge overlapping or abutting spans per channel
+
+    Runs a sweep line over the sorted start and end points of the spans of
+    each channel: a merged span starts where the number of active spans
+    rises from zero and ends where it falls back to zero. It keeps the
+    owner of its earliest span, the labels of all of them.
+
+    :param spans: iterable of Span
+    :returns: list of merged Span, sorted by channel and start
+
+    """
+    spans = list(spans)
+    points = [(span.channel, span.start, START, index)
+              for index, span in enumerate(spans)]
+    points += [(span.channel, span.end, END, index)
+               for index, span in enumerate(spans)]
+    points.sort()
+
+    timeline = []
+    active, members = 0, []
+    for channel, time, kind, index in points:
+        if kind == START:
+            if not active:
+                start, members = time, []
+            active += 1
+            members.append(spans[index])
+        else:
+            active -= 1
+            if not active:
+                labels = dict.fromkeys(span.label for span in members)
+                timeline.append(Span(channel, start, time, members[0].owner,
+                                     " + ".join(labels)))
+    return timeline
+
+
+def timeline_actions(timeline):
+    """Get the actions of a compiled timeline, combined by time"""
+    return combine_actions(action for span in timeline
+                           for action in span_actions(span))
+
+
+def get_timeline_actions(events):
+    """Get the actions to turn channels on and back to auto for events
+
+    Unlike parser.get_combined_actions, overlapping events of a channel
+    result in a single "on" and "auto" only.
+
+    :param events: list of event dicts return by Google API
+
+    """
+    return timeline_actions(compile_timeline(extract_spans(events)))
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Append-only log of channel states with time range queries
+
+The log is a directory of segment files. Each segment holds fixed-width
+records and is named after the (integer) time stamp of its first record.
+A sparse index next to each segment stores the time stamp of every
+INDEX_STRIDE-th record, so queries can jump into the memory-mapped segment
+instead of scanning it from the start.
+"""
+
+import os
+import mmap
+import time
+import struct
+import logging
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime
+
+from .consts import HISTORY_PATH, STATE_REASONS
+
+
+logger = logging.getLogger(__name__)
+
+# time stamp, device id, active mask, reason code per channel
+RECORD = struct.Struct("<dIB8s3x")
+INDEX_STRIDE = 256
+CHUNK_RECORDS = 4096
+
+HistoryRecord = namedtuple('HistoryRecord', 'timestamp device mask reasons')
+
+
+def encode_states(states, raw_states=None):
+    """Pack a list of state dicts (see Lantop.get_states) into mask, reasons
+
+    Several reason codes share a label, without the payload the states
+    were decoded from the first code of a label is stored.
+
+    :param raw_states: payload of Lantop.get_raw_states, to take the
+                       reason codes from
+    :returns: the 8-bit active mask and the reason codes (bytes)
+
+    """
+    mask, reasons = 0, bytearray(8)
+    for channel in states:
+        index = channel["index"]
+        if channel["active"]:
+            mask |= 1 << index
+        if raw_states is not None:
+            reasons[index] = raw_states[index] & 0x7F
+        else:
+            reasons[index] = STATE_REASONS.index(channel["reason"])
+    return mask, bytes(reasons)
+
+
+def _timestamp(value):
+    """Convert a datetime (or None) to a POSIX time stamp"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value.timestamp()
+
+
+class HistoryLog(object):
+    """Segmented, memory-mappable channel state log"""
+
+    def __init__(self, path=None, segment_records=65536, max_gap=None):
+        """Open (or create on first append) a history log
+
+        :param path: directory holding the segments
+        :param segment_records: records per segment before starting a new one
+        :param max_gap: seconds a record stays valid without a successor
+                        (default: until the next record)
+
+        """
+        self.path = path or HISTORY_PATH
+        self.segment_records = segment_records
+        self.max_gap = max_gap
+
+        self._segment = None  # name of the segment being appended to
+        self._segment_count = 0
+
+    def _segment_names(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return sorted(int(name[:-4]) for name in names
+                      if name.endswith(".seg") and name[:-4].isdigit())
+
+    def _file(self, name, ext):
+        return os.path.join(self.path, "{:010d}.{}".format(name, ext))
+
+    def _open_segment(self, timestamp):
+        """Find the segment to append to, start a new one if required"""
+        if self._segment is None:
+            names = self._segment_names()
+            if names:
+                self._segment = names[-1]
+                filename = self._file(self._segment, "seg")
+                size = os.path.getsize(filename)
+                self._segment_count = size // RECORD.size
+                if size % RECORD.size:
+                    logger.warning("Truncating partial record in %s",
+                                   filename)
+                    with open(filename, "r+b") as fp:
+                        fp.truncate(self._segment_count * RECORD.size)
+
+        if self._segment is None or \
+           self._segment_count >= self.segment_records:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self._segment = max(int(timestamp), (self._segment or 0) + 1)
+            self._segment_count = 0
+
+    def append_record(self, timestamp, device, mask, reasons):
+        """Append a single record (see encode_states)"""
+        self._open_segment(timestamp)
+        with open(self._file(self._segment, "seg"), "ab") as fp:
+            fp.write(RECORD.pack(timestamp, device, mask, reasons))
+        if self._segment_count % INDEX_STRIDE == 0:
+            with open(self._file(self._segment, "idx"), "ab") as fp:
+                array("d", [timestamp]).tofile(fp)
+        self._segment_count += 1
+
+    def append(self, states, device=0, timestamp=None, raw_states=None):
+        """Append the channel states of a device
+
+        :param states: list of state dicts as returned by Lantop.get_states
+        :param device: device id (serial number)
+        :param timestamp: time of the reading (default: now)
+        :param raw_states: the payload the states were decoded from
+
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self.append_record(_timestamp(timestamp), device,
+                           *encode_states(states, raw_states))
+
+    def _load_index(self, name):
+        index = array("d")
+        try:
+            with open(self._file(name, "idx"), "rb") as fp:
+                index.frombytes(fp.read())
+        except OSError:
+            pass
+        return index
+
+    def _scan_segment(self, name, start=None, reverse=False):
+        """Yield records of a segment, from the block containing start"""
+        with open(self._file(name, "seg"), "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size // RECORD.size * RECORD.size
+            if not size:
+                return
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                # forward: first position to read, reverse: last position
+                offset = size if reverse else 0
+                index = self._load_index(name) if start is not None else None
+                if index:
+                    block = bisect_right(index, start)
+                    if not reverse:
+                        block = max(block - 1, 0)
+                    offset = min(block * INDEX_STRIDE * RECORD.size, size)
+                chunk = CHUNK_RECORDS * RECORD.size
+                if not reverse:
+                    for pos in range(offset, size, chunk):
+                        yield from RECORD.iter_unpack(buf[pos:pos + chunk])
+                else:
+                    for pos in range(offset, 0, -chunk):
+                        data = buf[max(pos - chunk, 0):pos]
+                        yield from reversed(list(RECORD.iter_unpack(data)))
+
+    def records(self, start=None, end=None, device=None):
+        """Iterate over the records in a time range
+
+        :param start: datetime or time stamp of the first record (inclusive)
+        :param end: datetime or time stamp of the last record (exclusive)
+        :param device: only records of this device id
+
+        """
+        start, end = _timestamp(start), _timestamp(end)
+        names = self._segment_names()
+        first = max(bisect_right(names, start) - 1, 0) \
+            if start is not None else 0
+        for name in names[first:]:
+            if end is not None and name >= end:
+                break
+            for record in self._scan_segment(name, start):
+                if start is not None and record[0] < start:
+                    continue
+                if end is not None and record[0] >= end:
+                    return
+                if device is None or record[1] == device:
+                    yield HistoryRecord(*record)
+
+    def last_before(self, timestamp, device=None):
+        """Get the last record before a time stamp (or None)"""
+        timestamp = _timestamp(timestamp)
+        names = self._segment_names()
+        last = bisect_right(names, timestamp)
+        for name in reversed(names[:last]):
+            for record in self._scan_segment(name, timestamp, reverse=True):
+                if record[0] < timestamp and \
+                   (device is None or record[1] == device):
+                    return HistoryRecord(*record)
+        return None
+
+    def _devices_before(self, timestamp):
+        """Get the devices recorded in the segment before a time stamp"""
+        names = self._segment_names()
+        last = bisect_right(names, timestamp)
+        if not last:
+            return set()
+        return {record[1] for record in self._scan_segment(names[last - 1])
+                if record[0] < timestamp}
+
+    def on_intervals(self, channel, start, end, device=None):
+        """Get the intervals in which a channel was on
+
+        A record is valid until the next record of the same device (but at
+        most max_gap seconds). Intervals are clipped to the range. Without
+        a device, the intervals of all devices are merged (a device is
+        included if recorded in the range or in the segment before it).
+
+        :returns: a list of (start, end) datetime tuples
+
+        """
+        start = _timestamp(start)
+        end = min(_timestamp(end), time.time())
+        bit = 1 << channel
+        intervals = []
+
+        def add(since, until):
+            if self.max_gap is not None:
+                until = min(until, since + self.max_gap)
+            since, until = max(since, start), min(until, end)
+            if since < until:
+                intervals.append((since, until))
+
+        previous = {}  # last record per device
+
+        def last(device_id):
+            if device_id not in previous:
+                previous[device_id] = self.last_before(start, device_id)
+            return previous[device_id]
+
+        for record in self.records(start, end, device):
+            before = last(record.device)
+            if before is not None and before.mask & bit:
+                add(before.timestamp, record.timestamp)
+            previous[record.device] = record
+        for device_id in (self._devices_before(start) if device is None
+                          else [device]):
+            last(device_id)
+        for record in previous.values():
+            if record is not None and record.mask & bit:
+                add(record.timestamp, end)
+
+        merged = []
+        for since, until in sorted(intervals):
+            if merged and since <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], until)
+            else:
+                merged.append([since, until])
+        return [(datetime.fromtimestamp(since), datetime.fromtimestamp(until))
+                for since, until in merged]
+
+    def duty_cycle(self, channel, start, end, device=None):
+        """Get the fraction of a time range a channel was on"""
+        length = _timestamp(end) - _timestamp(start)
+        if length <= 0:
+            return 0.0
+        on_time = sum((until - since).total_seconds() for since, until in
+                      self.on_intervals(channel, start, end, device))
+        return on_time / length
+
+
+class HistoryRecorder(object):
+    """Record the states of a device, at least every heartbeat seconds"""
+
+    def __init__(self, log, device=0, heartbeat=None):
+        self.log = log
+        self.device = device
+        self.heartbeat = heartbeat
+        self._last_record = None
+
+    def record(self, states, changed=True, timestamp=None, raw_states=None):
+        """Add states to the log if changed or the heartbeat is due"""
+        timestamp = _timestamp(timestamp) or time.time()
+        if not changed and (self.heartbeat is None or
+                            self._last_record is not None and
+                            timestamp - self._last_record < self.heartbeat):
+            return
+        self.log.append(states, self.device, timestamp, raw_states)
+        self._last_record = timestamp
@@ -3,15 +3,17 @@
 
 import time
 import struct
+import threading
 import base64
 from datetime import datetime, date
 
 from . consts import (
     DEVICE_TYPES, CONTROL_MODES, TIMED_STATE_LABELS,
-    STATE_REASONS
+    STATE_REASONS, DEFAULT_PORT
 )
 from .transport import Transport
 from .errors import LantopError, LantopTransportError
+from .watch import StatePoller
 
 
 class Lantop(object):
@@ -21,7 +23,11 @@ class Lantop(object):
 
     def __init__(self, *args, **kwargs):
         self._dev_type = None  # will be set by get_info
+        self._poller = None  # will be set by subscribe
+        self._address = None  # will be set by connect
         self.tp = None
+        # held to (re)connect or to check tp and use it, by the poller too
+        self.connection_lock = threading.RLock()
         if args or kwargs:
             self.connect(*args, **kwargs)
 
@@ -33,24 +39,66 @@ class Lantop(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def connect(self, host, port, retries=0):
-        if self.tp:
-            self.close()
-        for failed in range(1 + retries):
-            try:
-                self.tp = self.Transport(host, port)
-            except LantopTransportError:
-                if failed < retries:
-                    time.sleep(5)
+    def connect(self, host, port=DEFAULT_PORT, retries=0):
+        """Open the connection, subscriptions stay (see close)"""
+        with self.connection_lock:
+            self.disconnect()
+            self._address = (host, port)
+            for failed in range(1 + retries):
+                try:
+                    self.tp = self.Transport(host, port)
+                except LantopTransportError:
+                    if failed < retries:
+                        time.sleep(5)
+                    else:
+                        raise
                 else:
-                    raise
-            else:
-                break
+                    break
 
     def close(self):
-        if self.tp:
-            self.tp.close()
-            self.tp = None
+        """Stop the poller (cancel all subscriptions) and disconnect"""
+        if self._poller:
+            self._poller.stop()
+            self._poller.join(5.0)
+            self._poller = None
+        self.disconnect()
+
+    def disconnect(self):
+        """Close the connection only, subscriptions stay (see reconnect)"""
+        with self.connection_lock:
+            if self.tp:
+                self.tp.close()
+                self.tp = None
+
+    def reconnect(self):
+        """Connect again to the device of the last connect"""
+        with self.connection_lock:
+            self.disconnect()
+            self.tp = self.Transport(*self._address)
+
+    def subscribe(self, callback=None, queue_size=100, policy="drop",
+                  **poll_args):
+        """Get notified about channel state changes
+
+        A single background thread per device polls the states (see
+        watch.StatePoller) and fans the changes out to all subscribers.
+        It stops when the last subscription is cancelled.
+
+        :param callback: called (in a thread of its own) with each list of
+                         changes. Without, iterate over the subscription.
+        :param queue_size: max. number of pending change lists
+        :param policy: if the queue is full: "drop" oldest, "drop_new" or
+                       "block" the poller
+        :param poll_args: passed to watch.StateWatcher on first subscribe
+        :returns: a watch.Subscription (call cancel() to unsubscribe)
+
+        """
+        if not self.tp:
+            raise RuntimeError('Not connected to device')
+        if self._poller is None or self._poller.stopped:
+            self._poller = StatePoller(self, **poll_args)
+            self._poller.start()
+        return self._poller.subscribe(callback, queue_size, policy)
 
     def get_info(self):
         """Get device Info (type, serial number)
@@ -189,9 +237,21 @@ class Lantop(object):
         args = b''.join((base64.b16encode(bytes([c])) for c in args))
         self.tp.command("T08615A", "a\x7A", args=args)
 
-    def get_states(self):
-        """Get current channel states and reasons
+    def get_raw_states(self):
+        """Get current channel states as undecoded payload
 
+        Cheap to compare between two polls, use decode_states() to get the
+        same result as get_states().
+
+        :returns: the raw state payload (bytes)
+
+        """
+        return self.tp.request("T02624B", "bk")
+
+    def decode_states(self, msg):
+        """Decode a payload returned by get_raw_states()
+
+        :param msg: the raw state payload
         :returns: a list of dicts. Each channel has a active and reason entry
 
         """
@@ -199,8 +259,6 @@ class Lantop(object):
         if self._dev_type is None:
             self.get_info()
         num_channels = DEVICE_TYPES[self._dev_type][1]
-        # now, get the state
-        msg = self.tp.request("T02624B", "bk")
         try:
             channels = struct.unpack_from("B" * 8, msg)
             has_extension_module = ord(msg[8:9]) == 1
@@ -215,6 +273,16 @@ class Lantop(object):
 
         return states
 
+    def get_states(self):
+        """Get current channel states and reasons
+
+        :returns: a list of dicts. Each channel has a active and reason entry
+
+        """
+        if self._dev_type is None:
+            self.get_info()
+        return self.decode_states(self.get_raw_states())
+
     def set_state(self, channel, state, duration=None):
         """Set state of a channel
 
@@ -246,6 +314,24 @@ class Lantop(object):
             args = b''.join((base64.b16encode(bytes([c])) for c in args))
             self.tp.command("T08614B", "ak", channel, args)
 
+    def set_states(self, states):
+        """Set the (indefinite) states of several channels in one batch
+
+        :param states: dict of zero-based channel index to state (on, off,
+                       auto, manual)
+
+        """
+        try:
+            codes = {channel: CONTROL_MODES[state]
+                     for channel, state in states.items()}
+        except KeyError:
+            raise LantopError("Cannot parse state")
+        # one command per channel, sent back-to-back on the connection
+        with self.tp.batch():
+            for channel, state_code in sorted(codes.items()):
+                args = base64.b16encode(bytes([state_code]))
+                self.tp.command("T04614B", "ak", channel, args)
+
     def get_channel_name(self, channel):
         """Get name of a certain channel
 
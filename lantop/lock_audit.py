@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Append-only journal of lock count transitions for auditing
+
+Each change of the lock count of a channel is appended as a fixed-width
+record (time, device, channel, delta, resulting count, source). Every
+CHECKPOINT_STRIDE records, the counts of all channels are written to a
+checkpoint file and an index entry (time, journal offset, checkpoint
+offset) is added, so the counts at any time are reconstructed from the
+last checkpoint before it plus at most CHECKPOINT_STRIDE records.
+"""
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .consts import LOCK_COUNTERS_FILE
+
+
+# time stamp, device key, channel, delta, resulting count, source
+RECORD = struct.Struct("<dIBii24s3x")
+SOURCE_SIZE = 24
+# time stamp of the last record covered, journal offset, checkpoint offset
+INDEX = struct.Struct("<dQQ")
+CHECKPOINT_STRIDE = 256
+
+AuditRecord = namedtuple('AuditRecord',
+                         'timestamp device channel delta locks source')
+
+
+class LockAudit(object):
+    """Journal of lock count transitions with a checkpoint index"""
+
+    def __init__(self, filename=None):
+        """Open (or create on first record) an audit journal
+
+        :param filename: journal file, checkpoints and index are kept in
+                         filename.ckp and filename.idx
+
+        """
+        self.filename = filename or LOCK_COUNTERS_FILE + ".audit"
+        self.checkpoint_filename = self.filename + ".ckp"
+        self.index_filename = self.filename + ".idx"
+
+    @contextmanager
+    def _locked(self):
+        """Serialize appends of several processes"""
+        directory = os.path.dirname(self.filename) or "."
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open(self.filename, "ab") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield fp
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def record(self, device, channel, delta, locks, source="",
+               timestamp=None):
+        """Append a transition
+
+        :param device: device key (see lock_counts.device_key)
+        :param delta: change of the lock count
+        :param locks: lock count after the change
+        :param source: who caused it (owner id, "cli", ...)
+
+        """
+        self.record_many([(device, channel, delta, locks, source)],
+                         timestamp)
+
+    def record_many(self, transitions, timestamp=None):
+        """Append (device, channel, delta, locks, source) transitions"""
+        if not transitions:
+            return
+        with self._locked() as fp:
+            if timestamp is None:
+                timestamp = time.time()
+            fp.seek(0, os.SEEK_END)
+            offset = fp.tell() // RECORD.size * RECORD.size
+            if offset != fp.tell():
+                fp.truncate(offset)  # partial record of a crashed writer
+            fp.write(b"".join(
+                RECORD.pack(timestamp, device, channel, delta, locks,
+                            str(source).encode()[:SOURCE_SIZE])
+                for device, channel, delta, locks, source in transitions))
+            fp.flush()
+            count = offset // RECORD.size + len(transitions)
+            if count // CHECKPOINT_STRIDE > \
+               offset // RECORD.size // CHECKPOINT_STRIDE:
+                self._checkpoint(count * RECORD.size)
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename, "rb") as fp:
+                data = fp.read()
+        except OSError:
+            return []
+        return list(INDEX.iter_unpack(data[:len(data) // INDEX.size *
+                                           INDEX.size]))
+
+    def _read_checkpoint(self, offset):
+        with open(self.checkpoint_filename, "rb") as fp:
+            fp.seek(offset)
+            return {(device, channel): locks for device, channel, locks
+                    in json.loads(fp.readline().decode())}
+
+    def _checkpoint(self, end):
+        """Save the counts at journal offset end (held by _locked)"""
+        index = self._load_index()
+        if index:
+            _, start, checkpoint_offset = index[-1]
+            counts = self._read_checkpoint(checkpoint_offset)
+        else:
+            start, counts = 0, {}
+        timestamp = 0.0
+        for record in self._scan(start, end):
+            counts[record.device, record.channel] = record.locks
+            timestamp = record.timestamp
+
+        with open(self.checkpoint_filename, "ab") as fp:
+            checkpoint_offset = fp.seek(0, os.SEEK_END)
+            fp.write(json.dumps(sorted([device, channel, locks] for
+                                       (device, channel), locks
+                                       in counts.items())).encode() + b"\n")
+        with open(self.index_filename, "ab") as fp:
+            fp.write(INDEX.pack(timestamp, end, checkpoint_offset))
+
+    def _scan(self, start=0, end=None):
+        """Yield the records between two journal offsets"""
+        try:
+            fp = open(self.filename, "rb")
+        except OSError:
+            return
+        with fp:
+            size = os.fstat(fp.fileno()).st_size // RECORD.size * RECORD.size
+            if end is not None:
+                size = min(size, end)
+            if start >= size:
+                return
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                for pos in range(start, size, RECORD.size):
+                    timestamp, device, channel, delta, locks, source = \
+                        RECORD.unpack_from(buf, pos)
+                    yield AuditRecord(timestamp, device, channel, delta,
+                                      locks, source.rstrip(b"\0").decode(
+                                          errors="replace"))
+
+    def records(self, start=None, end=None, device=None):
+        """Iterate over the transitions in a time range
+
+        :param start: time stamp of the first record (inclusive)
+        :param end: time stamp of the last record (exclusive)
+
+        """
+        offset = 0
+        if start is not None:
+            index = self._load_index()
+            # records up to a checkpoint before start can be skipped
+            position = bisect_left([entry[0] for entry in index], start)
+            if position:
+                offset = index[position - 1][1]
+        for record in self._scan(offset):
+            if end is not None and record.timestamp >= end:
+                return
+            if (start is None or record.timestamp >= start) and \
+               (device is None or record.device == device):
+                yield record
+
+    def counts_at(self, timestamp, device=None):
+        """Reconstruct the lock counts at a point in time
+
+        :returns: a dict of (device key, channel) to lock count
+
+        """
+        index = self._load_index()
+        position = bisect_right([entry[0] for entry in index], timestamp)
+        if position:
+            _, offset, checkpoint_offset = index[position - 1]
+            counts = self._read_checkpoint(checkpoint_offset)
+        else:
+            offset, counts = 0, {}
+        for record in self._scan(offset):
+            if record.timestamp > timestamp:
+                break
+            counts[record.device, record.channel] = record.locks
+        if device is not None:
+            counts = {key: locks for key, locks in counts.items()
+                      if key[0] == device}
+        return counts
@@ -3,24 +3,93 @@
 
 import os
 import json
+import mmap
+import time
+import fcntl
+import heapq
+import struct
 import logging
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from . consts import LOCK_COUNTERS_FILE
+from .utils import write_atomic
+
+
+# outcome of the lock rules for a channel change
+LockDecision = namedtuple('LockDecision', 'channel state owner locks applied')
+
+
+def execute(func, decisions, logger):
+    """Call func with the channel changes decided on (if any), log them"""
+    commands = {decision.channel: decision.state
+                for decision in decisions if decision.applied}
+    if commands:
+        func(commands)
+    for decision in decisions:
+        if decision.applied:
+            logger.info("Set channel {} to state {!r}.".format(
+                decision.channel, decision.state))
+        else:
+            logger.info("Channel {} unchanged (locked).".format(
+                decision.channel))
+
+
+def device_key(device):
+    """Get the namespace key of a device given by serial number or address
+
+    :returns: the serial number or a CRC32 of the address string
+
+    """
+    if isinstance(device, int):
+        return device
+    key = zlib.crc32(str(device).encode())
+    # 0 and 0xFFFFFFFF are reserved in the slot index of MmapLockCounts
+    return key if 0 < key < 0xFFFFFFFF else key ^ 1
+
+
+@contextmanager
+def locked(filename):
+    """Hold an exclusive lock on filename (using filename.lock)"""
+    directory = os.path.dirname(filename) or "."
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(filename + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 class LockCounts(object):
-    """Read/write the channel state counters from/to file"""
+    """Read/write the channel state counters from/to file
+
+    Counters of different devices are kept apart by passing a device
+    (serial number or address). Each device gets a file of its own
+    (filename.KEY), the first one adopts the counters stored without device.
+    """
     max_channels = 8
+    audit = None  # a LockAudit to record the transitions in
 
-    def __init__(self, filename=None, logger=None):
-        self.filename = filename or LOCK_COUNTERS_FILE
+    def __init__(self, filename=None, logger=None, device=None):
+        self.legacy_filename = filename or LOCK_COUNTERS_FILE
+        self.device = device
+        self.key = 0 if device is None else device_key(device)
+        self.filename = self._device_filename()
         self.logger = logger or logging.getLogger(__name__)
 
         self._counts = None
         self.modified = False
         self.load()
 
+    def _device_filename(self):
+        if self.device is None:
+            return self.legacy_filename
+        return "{}.{}".format(self.legacy_filename, device_key(self.device))
+
     def __getitem__(self, item):
         return self._counts[item]
 
@@ -28,9 +97,6 @@ class LockCounts(object):
         self._counts[key] = value
         self.modified = True
 
-    def __del__(self):
-        self.save()
-
     def __str__(self):
         return str(self._counts)
 
@@ -40,11 +106,37 @@ class LockCounts(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.save()
 
-    def load(self):
-        """Load counts from file"""
+    @contextmanager
+    def transaction(self):
+        """Locked read-modify-write of the counts
+
+        Holds an exclusive lock on the counts file (shared with other
+        processes), reloads the counts and saves them on exit.
+        """
+        with locked(self.filename):
+            self.load()
+            try:
+                yield self
+            finally:
+                self.save()
+
+    def _adopt_legacy(self):
+        """Move the counters stored without device to this device"""
+        with locked(self.legacy_filename):
+            if os.path.exists(self.legacy_filename) and \
+               not os.path.exists(self.filename):
+                self.logger.warning("Assigning lock counters to device %s",
+                                    self.device)
+                os.replace(self.legacy_filename, self.filename)
+
+    def _read(self, filename):
+        """Read a JSON counts file, all zeros if missing or corrupt"""
+        if not os.path.exists(filename):
+            self.logger.info("No state file, using all zeros")
+            return [0] * self.max_channels
         try:
             # check mod time
-            mod_time = datetime.fromtimestamp(os.path.getmtime(self.filename))
+            mod_time = datetime.fromtimestamp(os.path.getmtime(filename))
             mod_time_max = 7
             if mod_time_max > 0 and \
                datetime.now() - mod_time > timedelta(days=mod_time_max):
@@ -52,7 +144,7 @@ class LockCounts(object):
                     "State file was not modified in the last %d days.",
                     mod_time_max)
             # load counts
-            with open(self.filename, "r") as fp:
+            with open(filename, "r") as fp:
                 counts = json.load(fp)
             # check consistency
             if len(counts) < self.max_channels:
@@ -60,45 +152,403 @@ class LockCounts(object):
                 self.logger.warning("States file did not contain %d entries",
                                self.max_channels)
 
-        except (os.error, TypeError, ValueError, IOError):
-            self.logger.warning(
-                "Could not access or open state file, using all zeros")
+        except (os.error, TypeError, ValueError, IOError) as err:
+            self.logger.error(
+                "Could not read state file (%s), using all zeros", err)
             counts = [0] * self.max_channels
 
-        self._counts = counts
+        return counts
+
+    def load(self):
+        """Load counts from file"""
+        if self.device is not None and not os.path.exists(self.filename):
+            self._adopt_legacy()
+        self._counts = self._read(self.filename)
 
     def save(self, force=False):
         """Store updated channel state counts to file"""
         if not (force or self.modified):
             return
-        directory = os.path.dirname(self.filename)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(self.filename, "w") as fp:
-            json.dump(self._counts, fp)
+        # readers see either the old or the new counts
+        write_atomic(self.filename, json.dumps(self._counts).encode())
         self.modified = False
 
-    def apply(self, func, channel, state):
-        logger = self.logger
+    def hold(self, channel, state, owner=None, expires=None):
+        """Count a lock ("on") or the end of one ("auto", "off")"""
+        self[channel] += 1 if state == "on" else -1
 
-        def apply():
-            func(channel, state)
-            logger.info("Set channel {} to state {!r}.".format(channel, state))
+    def count(self, channel):
+        """Get the number of locks on a channel"""
+        return self[channel]
 
-        self[channel] += 1 if state == "on" else -1
+    def clear(self, channel):
+        """Drop all locks on a channel"""
+        self[channel] = 0
 
-        if self[channel] == 1 and state == "on":
-            apply()
-        elif self[channel] <= 0 and state == "auto":
-            apply()
+    def _decide(self, channel, state, owner=None, expires=None):
+        """Update the locks of a channel, get whether to change it"""
+        self.hold(channel, state, owner, expires)
+        count = self.count(channel)
+
+        change = False
+        if count == 1 and state == "on":
+            change = True
+        elif count <= 0 and state == "auto":
+            change = True
         elif state == "off":
-            apply()
-            self[channel] = 0
-        else:
-            logger.info("Channel {} unchanged (locked).".format(channel))
+            change = True
+            self.clear(channel)
 
         if self[channel] < 0:
             self[channel] = 0
-            logger.warning("Negative count on channel %d", channel)
+            self.logger.warning("Negative count on channel %d", channel)
+        return change
+
+    def apply_many(self, func, changes, owners=None, expires=None,
+                   source=None):
+        """Change channels unless locked, update the counters
+
+        The lock rules are evaluated for all channels first, then func is
+        called once with the channels to change (e.g. Lantop.set_states).
+
+        :param changes: dict of channel index to state
+        :param owners: id of the lock holder per channel (e.g. an event id)
+        :param expires: per channel, the time stamp after which the lock of
+                        the owner is stale
+        :param source: who requests the changes (for the audit journal)
+        :returns: a list of LockDecision, one per channel
+
+        """
+        owners, expires = owners or {}, expires or {}
+        decisions, transitions = [], []
+        for channel, state in sorted(changes.items()):
+            owner = owners.get(channel)
+            before = self.count(channel)
+            applied = self._decide(channel, state, owner,
+                                   expires.get(channel))
+            count = self.count(channel)
+            decisions.append(LockDecision(channel, state, owner, count,
+                                          applied))
+            if count != before:
+                transitions.append((self.key, channel, count - before, count,
+                                    owner or source or ""))
+        if self.audit is not None:
+            self.audit.record_many(transitions)
+
+        execute(func, decisions, self.logger)
+        self.logger.debug("Lock counters changed to {}".format(self))
+        return decisions
+
+    def apply(self, func, channel, state, owner=None, expires=None,
+              source=None):
+        """Change a channel unless locked, update the counter
+
+        :returns: whether func was called to change the channel
+
+        """
+        decision, = self.apply_many(
+            lambda commands: func(channel, state), {channel: state},
+            {channel: owner}, {channel: expires}, source)
+        return decision.applied
+
+
+class LockLeases(object):
+    """Locks held by owners (e.g. calendar events) until they expire
+
+    A lock of an owner is released by the owner only, so a repeated or a
+    missing "auto" can not shift the count. A lease that was not released
+    in time (the event was deleted, ...) is found by a heap of expiry times.
+    """
+
+    def __init__(self, filename=None, logger=None):
+        self.filename = (filename or LOCK_COUNTERS_FILE) + ".leases"
+        self.logger = logger or logging.getLogger(__name__)
+        self._leases = {}  # (device key, channel) -> {owner: expires}
+        self._heap = []  # (expires, key, channel, owner), lazily deleted
+        self.modified = False
+        self.load()
+
+    def load(self):
+        self._leases.clear()
+        del self._heap[:]
+        try:
+            with open(self.filename, "r") as fp:
+                leases = json.load(fp)
+        except FileNotFoundError:
+            leases = []
+        except (OSError, ValueError) as err:
+            self.logger.error("Could not read lease file (%s)", err)
+            leases = []
+        for key, channel, owner, expires in leases:
+            self.acquire(key, channel, owner, expires)
+        self.modified = False
+
+    def save(self, force=False):
+        if force or self.modified:
+            write_atomic(self.filename, json.dumps(self.items()).encode())
+            self.modified = False
+
+    def items(self):
+        """Get all leases as sorted (key, channel, owner, expires) lists"""
+        return sorted([key, channel, owner, expires]
+                      for (key, channel), owners in self._leases.items()
+                      for owner, expires in owners.items())
+
+    def owners(self, key, channel):
+        """Get the owners of a channel and the expiry of their lease"""
+        return self._leases.get((key, channel), {})
+
+    def count(self, key, channel, now=None):
+        """Get the number of live leases of a channel"""
+        now = time.time() if now is None else now
+        return sum(expires is None or expires > now
+                   for expires in self.owners(key, channel).values())
+
+    def acquire(self, key, channel, owner, expires=None):
+        """Lock a channel for owner (again), until expires (time stamp)"""
+        self._leases.setdefault((key, channel), {})[owner] = expires
+        if expires is not None:
+            heapq.heappush(self._heap, (expires, key, channel, owner))
+        self.modified = True
+
+    def release(self, key, channel, owner):
+        """Release the lease of owner
+
+        :returns: whether owner held a lease
+
+        """
+        owners = self._leases.get((key, channel), {})
+        if owner not in owners:
+            return False
+        del owners[owner]
+        if not owners:
+            del self._leases[key, channel]
+        self.modified = True
+        return True
+
+    def clear(self, key, channel):
+        if self._leases.pop((key, channel), None):
+            self.modified = True
+
+    def due(self, now=None):
+        """Whether leases may have expired by now (see expire)"""
+        now = time.time() if now is None else now
+        return bool(self._heap) and self._heap[0][0] <= now
+
+    def expire(self, now=None):
+        """Release the leases expired by now
+
+        :returns: a list of (key, channel, owner) tuples released
+
+        """
+        now = time.time() if now is None else now
+        released = []
+        while self._heap and self._heap[0][0] <= now:
+            expires, key, channel, owner = heapq.heappop(self._heap)
+            # skip entries of leases released or renewed in the meantime
+            if self.owners(key, channel).get(owner) == expires:
+                self.release(key, channel, owner)
+                released.append((key, channel, owner))
+        return released
+
+
+class MmapLockCounts(LockCounts):
+    """Channel state counters in a memory-mapped fixed-layout file
+
+    The file holds a header (magic, version, number of channels and of
+    slots), an index of the device key per slot and an int32 counter per
+    channel and slot. Loading only reads the header and index; counters are
+    updated in place under a file lock, no reads or rewrites of the
+    whole file. A JSON counts file is converted on first use.
+    """
+
+    MAGIC = b"LTLC"
+    VERSION = 2
+    HEADER = struct.Struct("<4sHHI")
+    KEY = struct.Struct("<I")
+    COUNTER = struct.Struct("<i")
+
+    FREE = 0xFFFFFFFF  # key of an unused slot
+    LEGACY = 0  # key of the counters stored without device
+
+    def __init__(self, filename=None, logger=None, device=None, slots=16):
+        self.slots = slots
+        self.key = self.LEGACY if device is None else device_key(device)
+        self._file = self._map = None
+        if device is not None and not self.LEGACY < self.key < self.FREE:
+            raise ValueError("Serial number {} can't be stored in the state "
+                             "file".format(self.key))
+        self._base = None  # offset of the counters of this device
+        self._in_transaction = False
+        super().__init__(filename, logger, device)
+
+    def _device_filename(self):
+        return self.legacy_filename  # all devices share one file
+
+    @property
+    def record_size(self):
+        return self.COUNTER.size * self.max_channels
+
+    def _offset(self, channel):
+        if not 0 <= channel < self.max_channels:
+            raise IndexError("Invalid channel index")
+        return self._base + self.COUNTER.size * channel
+
+    def __getitem__(self, item):
+        return self.COUNTER.unpack_from(self._map, self._offset(item))[0]
+
+    def __setitem__(self, key, value):
+        self.COUNTER.pack_into(self._map, self._offset(key), value)
+        self.modified = True
+
+    def __str__(self):
+        return str([self[channel] for channel in range(self.max_channels)])
+
+    def _create(self, slots):
+        """Write a new counts file
+
+        Keeps the counters of a JSON (or version 1) file as legacy counters.
+        """
+        keys = [self.FREE] * len(slots)
+        records = [[0] * self.max_channels for _ in slots]
+        for index, (key, counts) in enumerate(slots):
+            keys[index] = key
+            records[index][:len(counts)] = counts
+        keys += [self.FREE] * (self.slots - len(keys))
+        records += [[0] * self.max_channels] * (self.slots - len(records))
+
+        write_atomic(self.filename, self.HEADER.pack(
+            self.MAGIC, self.VERSION, self.max_channels, self.slots) +
+            b"".join(self.KEY.pack(key) for key in keys) +
+            b"".join(self.COUNTER.pack(count)
+                     for record in records for count in record))
+
+    def _read_old_format(self, header):
+        """Get the slots to keep from a JSON or version 1 file"""
+        if not os.path.exists(self.filename):
+            return []
+        if header[:4] == self.MAGIC and \
+           self.HEADER.unpack(header)[1] == 1:
+            # version 1: header with serial, then the counters
+            _, _, channels, serial = self.HEADER.unpack(header)
+            with open(self.filename, "rb") as fp:
+                fp.seek(self.HEADER.size)
+                data = fp.read(channels * self.COUNTER.size)
+            counts = [count for count, in self.COUNTER.iter_unpack(data)]
+            self.logger.warning("Converting state file to version 2")
+            return [(serial, counts)]
+        counts = self._read(self.filename)
+        self.logger.warning("Converting state file to binary format")
+        return [(self.LEGACY, counts)]
+
+    def load(self):
+        """Map the counts file (create or convert it first if required)"""
+        if self._map is not None:
+            return  # always up to date
+        with locked(self.filename):
+            try:
+                with open(self.filename, "rb") as fp:
+                    header = fp.read(self.HEADER.size)
+            except OSError:
+                header = b""
+            if header[:4] != self.MAGIC or \
+               self.HEADER.unpack(header)[1] != self.VERSION:
+                self._create(self._read_old_format(header))
+
+            self._file = open(self.filename, "r+b")
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            magic, version, channels, slots = \
+                self.HEADER.unpack_from(self._map)
+            if channels != self.max_channels:
+                raise ValueError("Unsupported state file layout")
+            self._base = self._find_slot(slots)
+
+    def _find_slot(self, slots):
+        """Get the counters offset of this device, assign a slot if new"""
+        keys = [key for key, in self.KEY.iter_unpack(
+            self._map[self.HEADER.size:self.HEADER.size +
+                      self.KEY.size * slots])]
+        if self.key in keys:
+            index = keys.index(self.key)
+        elif self.key != self.LEGACY and self.LEGACY in keys:
+            index = keys.index(self.LEGACY)
+            self.logger.warning("Assigning lock counters to device %s",
+                                self.device)
+        elif self.FREE in keys:
+            index = keys.index(self.FREE)
+        else:
+            raise ValueError("No free slot in state file")
+        if keys[index] != self.key:
+            self.KEY.pack_into(self._map,
+                               self.HEADER.size + self.KEY.size * index,
+                               self.key)
+            if keys[index] == self.FREE:
+                self._map[self._records(slots, index):
+                          self._records(slots, index) + self.record_size] = \
+                    bytes(self.record_size)
+            self._map.flush()
+        return self._records(slots, index)
+
+    def _records(self, slots, index):
+        return self.HEADER.size + self.KEY.size * slots + \
+            self.record_size * index
+
+    def save(self, force=False):
+        """Flush the mapped counters to disk"""
+        if self._map is not None and (force or self.modified):
+            self._map.flush()
+        self.modified = False
+
+    def close(self):
+        if self._map is not None:
+            self.save()
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def __del__(self):
+        self.close()
+
+    @contextmanager
+    def _locked(self):
+        """Lock the counters across processes
+
+        An flock on the descriptor of this instance: unlike POSIX (lockf)
+        locks, closing another descriptor of the file (another instance,
+        LockService compacting) does not release it.
+        """
+        if self._in_transaction:
+            # the lock doesn't nest, unlocking would end the transaction
+            yield
+            return
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self):
+        """Lock the counters, flush them on exit"""
+        with self._locked():
+            self._in_transaction = True
+            try:
+                yield self
+            finally:
+                self._in_transaction = False
+                self.save()
+
+    def apply_many(self, func, changes, owners=None, expires=None,
+                   source=None):
+        """Lock the counters, flush them once"""
+        with self._locked():
+            decisions = super().apply_many(func, changes, owners, expires,
+                                           source)
+            self.save()
+        return decisions
+
 
-        logger.debug("Lock counters changed to {}".format(self))
+BACKENDS = {
+    "json": LockCounts,
+    "mmap": MmapLockCounts,
+}
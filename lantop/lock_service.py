@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""Long-lived lock counters of the scheduler with a write-behind journal
+
+The scheduler keeps the counters of all devices in memory. Each change is
+appended to a journal of counter deltas (filename.journal), which is
+fsynced every fsync_interval seconds and compacted into the counts file(s)
+of the lock backend every compact_records changes. Other processes (the
+CLI) change counters through the control socket instead of the file.
+"""
+
+import os
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from contextlib import contextmanager
+
+from .consts import CONTROL_MODES, LOCK_COUNTERS_FILE, LOCK_SOCKET
+from .lock_audit import LockAudit
+from .lock_counts import (
+    LockCounts, LockDecision, LockLeases, device_key, execute
+)
+
+
+# device key, channel index, counter delta, new value (replay idempotently,
+# a crash during compaction must not apply the deltas twice)
+JOURNAL_RECORD = struct.Struct("<IBii")
+
+
+def _is_number(value, types=(int, float)):
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _check_channel(channel):
+    """Get a channel index of a request, ValueError if out of range"""
+    if not _is_number(channel, int) or \
+       not 0 <= channel < LockCounts.max_channels:
+        raise ValueError("Invalid channel {!r}".format(channel))
+    return channel
+
+
+class ServiceLockCounts(LockCounts):
+    """The counters of one device, as held by a LockService"""
+
+    def __init__(self, service, device):
+        self.service = service
+        self.device = device
+        self.key = device_key(device)
+        self.audit = service.audit
+        self.logger = service.logger
+        self.modified = False
+
+    def load(self):
+        pass  # always up to date
+
+    def save(self, force=False):
+        self.modified = False  # journaled on change
+
+    def __getitem__(self, item):
+        return self.service.get(self.key)[item]
+
+    def __setitem__(self, key, value):
+        self.service.update(self.key, key, value)
+
+    def __str__(self):
+        return str(self.service.get(self.key))
+
+    @contextmanager
+    def transaction(self):
+        """Hold the counters of all devices, journal changes at once"""
+        with self.service.batch():
+            yield self
+
+    def hold(self, channel, state, owner=None, expires=None):
+        """Count a lock, hold a lease if an owner is given"""
+        if owner is None:
+            return super().hold(channel, state)
+        leases = self.service.leases
+        if state == "on":
+            if expires is not None:
+                expires += self.service.lease_grace
+            leases.acquire(self.key, channel, owner, expires)
+        elif not leases.release(self.key, channel, owner):
+            self.logger.info("%r held no lock on channel %d", owner, channel)
+
+    def count(self, channel):
+        return self[channel] + self.service.leases.count(self.key, channel)
+
+    def clear(self, channel):
+        super().clear(channel)
+        self.service.leases.clear(self.key, channel)
+
+    def apply_many(self, func, changes, owners=None, expires=None,
+                   source=None):
+        with self.service.batch():
+            return super().apply_many(func, changes, owners, expires,
+                                      source)
+
+
+class LockService(object):
+    """In-memory lock counters of all devices"""
+
+    def __init__(self, filename=None, logger=None, backend=LockCounts,
+                 fsync_interval=5.0, compact_records=1000, lease_grace=3600,
+                 audit=None, **_):
+        """Load the counters, replaying a journal left behind
+
+        :param filename: counts file(s) of the backend
+        :param backend: LockCounts class to read and compact to
+        :param fsync_interval: max. seconds between journal fsyncs
+        :param compact_records: journal records before compaction
+        :param lease_grace: seconds a lease outlives its expected end
+        :param audit: record the transitions in filename.audit (or the
+                      LockAudit given)
+
+        """
+        self.filename = filename or LOCK_COUNTERS_FILE
+        self.journal_filename = self.filename + ".journal"
+        self.logger = logger or logging.getLogger(__name__)
+        self.backend = backend
+        self.fsync_interval = fsync_interval
+        self.compact_records = compact_records
+        self.lease_grace = lease_grace
+        if audit is True:
+            audit = LockAudit(self.filename + ".audit")
+        self.audit = audit or None
+
+        self.lock = threading.RLock()
+        self._counts = {}
+        self._dirty = set()  # keys changed since the last compaction
+        self._journal = None
+        self._pending = {}  # (key, channel): (delta, value) of the batch
+        self._batches = 0
+        self._records = 0
+        self._synced = time.monotonic()
+        self._server = None
+
+        # saved along with the journal fsyncs (write-behind as well)
+        self.leases = LockLeases(self.filename, self.logger)
+        self._replay()
+
+    def _seed(self, key):
+        """Read the counters of a device from the backend"""
+        counts = self.backend(self.filename, self.logger, device=key)
+        values = [counts[channel] for channel in range(counts.max_channels)]
+        if hasattr(counts, "close"):
+            counts.close()
+        return values
+
+    def _replay(self):
+        try:
+            with open(self.journal_filename, "rb") as fp:
+                data = fp.read()
+        except OSError:
+            data = b""
+        size = len(data) // JOURNAL_RECORD.size * JOURNAL_RECORD.size
+        if size != len(data):
+            self.logger.warning("Ignoring partial record in lock journal")
+        for key, channel, _, value in \
+                JOURNAL_RECORD.iter_unpack(data[:size]):
+            self.get(key)[channel] = value
+            self._dirty.add(key)
+        if size:
+            self.logger.info("Replayed %d lock counter changes",
+                             size // JOURNAL_RECORD.size)
+            self.compact()
+
+    def get(self, key):
+        """Get the list of counters of a device key"""
+        with self.lock:
+            if key not in self._counts:
+                self._counts[key] = self._seed(key)
+            return self._counts[key]
+
+    def counts(self, device):
+        """Get the counters of a device (serial number or address)"""
+        return ServiceLockCounts(self, device)
+
+    def update(self, key, channel, value):
+        """Set a counter, appending the change to the journal"""
+        with self.lock:
+            counts = self.get(key)
+            delta = value - counts[channel]
+            counts[channel] = value
+            if not delta:
+                return
+            self._dirty.add(key)
+            # one record per counter and batch
+            pending, _ = self._pending.get((key, channel), (0, None))
+            self._pending[key, channel] = (pending + delta, value)
+            if not self._batches:
+                self._write()
+
+    @contextmanager
+    def batch(self):
+        """Write the journal records of all updates at once, on exit"""
+        with self.lock:
+            self._batches += 1
+            try:
+                yield self
+            finally:
+                self._batches -= 1
+                if not self._batches:
+                    self._write()
+
+    def _write(self):
+        records = [JOURNAL_RECORD.pack(key, channel, delta, value)
+                   for (key, channel), (delta, value) in self._pending.items()
+                   if delta]
+        self._pending.clear()
+        if not records:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_filename, "ab")
+        self._journal.write(b"".join(records))
+        self._journal.flush()
+        self._records += len(records)
+        if self._records >= self.compact_records:
+            self.compact()
+        elif time.monotonic() - self._synced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Fsync the journal"""
+        with self.lock:
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+            self.leases.save()
+            self._synced = time.monotonic()
+
+    def compact(self):
+        """Write the changed counters to the backend, empty the journal"""
+        with self.lock:
+            for key in sorted(self._dirty):
+                counts = self.backend(self.filename, self.logger, device=key)
+                with counts.transaction():
+                    for channel, value in enumerate(self._counts[key]):
+                        counts[channel] = value
+                if hasattr(counts, "close"):
+                    counts.close()
+            self._dirty.clear()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self.journal_filename):
+                os.unlink(self.journal_filename)
+            self._records = 0
+            self.leases.save()
+            self._synced = time.monotonic()
+
+    def renew(self, key, channel, owner, expires):
+        """Move the expiry of a lease (if held) to expires (plus grace)
+
+        :returns: whether the lease was changed
+
+        """
+        with self.lock:
+            expires += self.lease_grace
+            if self.leases.owners(key, channel).get(owner, expires) == expires:
+                return False
+            self.leases.acquire(key, channel, owner, expires)
+            return True
+
+    def expire(self, now=None, unlock=None):
+        """Release stale leases
+
+        :param unlock: called with the (key, channel) tuples left without
+                       locks (e.g. to set them to auto); if it raises, the
+                       leases are kept, to expire again with the next call
+        :returns: a list of (key, channel) tuples left without locks
+
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            unlocked, transitions = [], []
+            expired = self.leases.expire(now)
+            for index, (key, channel, owner) in enumerate(expired):
+                self.logger.warning("Lock of %r on channel %d expired",
+                                    owner, channel)
+                # count after this one, before later ones on the channel
+                count = self.counts(key).count(channel) + sum(
+                    (k, ch) == (key, channel)
+                    for k, ch, _ in expired[index + 1:])
+                transitions.append((key, channel, -1, count,
+                                    "expired " + owner))
+                if not count and (key, channel) not in unlocked:
+                    unlocked.append((key, channel))
+            if unlock is not None and unlocked:
+                try:
+                    unlock(unlocked)
+                except Exception:
+                    for key, channel, owner in expired:
+                        self.leases.acquire(key, channel, owner, now)
+                    raise
+            if self.audit is not None:
+                self.audit.record_many(transitions)
+            return unlocked
+
+    def close(self):
+        """Stop serving and compact the journal"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self._server.server_address)
+            self._server = None
+        self.compact()
+
+    def serve(self, path=None):
+        """Answer requests on the control socket (in a daemon thread)"""
+        path = path or LOCK_SOCKET
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)  # left behind by a previous run
+
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode())
+                    except ValueError as err:
+                        # keep serving the client after a malformed line
+                        response = {"error": str(err)}
+                    else:
+                        response = service.handle(request)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def handle(self, request):
+        """Answer a control socket request (a dict)"""
+        try:
+            op = request["op"]
+            if op == "list":
+                with self.lock:
+                    return {"devices": {str(key): list(counts) for key, counts
+                                        in self._counts.items()},
+                            "leases": self.leases.items()}
+            counts = self.counts(request["device"])
+            response = {}
+            if op == "set":
+                value = request["value"]
+                if not _is_number(value, int):
+                    raise ValueError("Invalid value {!r}".format(value))
+                counts[_check_channel(request["channel"])] = value
+            elif op == "apply":
+                # changes: [channel, state, owner, expires] lists, all
+                # checked before any is applied
+                changes = {}
+                for channel, state, owner, expires in request["changes"]:
+                    if state not in CONTROL_MODES:
+                        raise ValueError("Invalid state {!r}".format(state))
+                    if not (owner is None or isinstance(owner, str)) or \
+                       not (expires is None or _is_number(expires)):
+                        raise ValueError("Invalid owner or expiry")
+                    changes[_check_channel(channel)] = (state, owner, expires)
+                response["decisions"] = counts.apply_many(
+                    lambda commands: None,
+                    {ch: change[0] for ch, change in changes.items()},
+                    {ch: change[1] for ch, change in changes.items()},
+                    {ch: change[2] for ch, change in changes.items()},
+                    request.get("source"))
+            elif op != "get":
+                raise ValueError("Unknown operation {!r}".format(op))
+            with self.lock:
+                response["counts"] = self.get(counts.key)
+                response["locks"] = [counts.count(channel) for channel
+                                     in range(counts.max_channels)]
+            return response
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            return {"error": str(err)}
+
+
+class LockClient(object):
+    """Lock counters of a device, changed through the control socket"""
+
+    def __init__(self, path=None, device=None, logger=None):
+        """Connect to the lock service
+
+        :raises OSError: if no service is listening
+
+        """
+        self.device = device
+        self.logger = logger or logging.getLogger(__name__)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path or LOCK_SOCKET)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile("rwb")
+        self._counts = self._locks = None
+
+    def _request(self, op, **args):
+        self._file.write(json.dumps(dict(args, op=op, device=self.device))
+                         .encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise OSError("Lock service closed the connection")
+        response = json.loads(line.decode())
+        if "error" in response:
+            raise ValueError(response["error"])
+        self._counts = response.get("counts", self._counts)
+        self._locks = response.get("locks", self._locks)
+        return response
+
+    def __getitem__(self, item):
+        if self._counts is None:
+            self._request("get")
+        return self._counts[item]
+
+    def __setitem__(self, key, value):
+        self._request("set", channel=key, value=value)
+
+    def count(self, channel):
+        """Get the number of locks (counted and leased) on a channel"""
+        if self._locks is None:
+            self._request("get")
+        return self._locks[channel]
+
+    def __str__(self):
+        if self._counts is None:
+            self._request("get")
+        return str(self._counts)
+
+    @contextmanager
+    def transaction(self):
+        """Each request is atomic already, re-read the counters"""
+        self._request("get")
+        yield self
+
+    def apply_many(self, func, changes, owners=None, expires=None,
+                   source=None):
+        """Let the service decide, then change the channels if required
+
+        See LockCounts.apply_many.
+
+        """
+        owners, expires = owners or {}, expires or {}
+        response = self._request("apply", source=source, changes=[
+            [channel, state, owners.get(channel), expires.get(channel)]
+            for channel, state in sorted(changes.items())])
+        decisions = [LockDecision(*decision)
+                     for decision in response["decisions"]]
+        execute(func, decisions, self.logger)
+        return decisions
+
+    def apply(self, func, channel, state, owner=None, expires=None,
+              source=None):
+        """Change a channel unless locked, see LockCounts.apply"""
+        decision, = self.apply_many(
+            lambda commands: func(channel, state), {channel: state},
+            {channel: owner}, {channel: expires}, source)
+        return decision.applied
+
+    def list(self):
+        """Get the counters of all devices (by key) and all leases"""
+        return self._request("list")
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
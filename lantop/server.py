@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""Local HTTP/JSON API for device states
+
+Each device is served through a single managed connection. Channel states
+are cached for a short time and concurrent reads share one device request.
+State changes are pushed to clients (server-sent events or long-polling)
+from a single background poller per device.
+"""
+
+import json
+import math
+import time
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+from .lantop import Lantop
+from .consts import CONTROL_MODES, TIMED_STATE_LABELS
+from .errors import LantopError, LantopTransportError
+from .history import encode_states
+from .watch import format_change_json
+
+
+logger = logging.getLogger(__name__)
+
+# longest timed state in seconds, the device takes the hours in a byte
+MAX_DURATION = 256 * 3600 - 1
+# longest long-poll in seconds, longer waits are cut to it
+MAX_WAIT = 300.0
+
+
+class HTTPError(Exception):
+    """Abort a request with an HTTP error status"""
+
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class DeviceSession(object):
+    """A single managed connection to a device with a state cache"""
+
+    def __init__(self, host, port=None, retries=0, ttl=1.0, queue_size=100,
+                 **poll_args):
+        self.address = (host,) if port is None else (host, port)
+        self.retries = retries
+        self.ttl = ttl
+        self.queue_size = queue_size
+        self.poll_args = poll_args  # for the change notification poller
+
+        self.device = Lantop()
+        # all device access happens in this one thread, one request at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._info = None
+        self._channel_names = {}
+
+        self._states = None
+        self._raw_states = None
+        self._etag = None
+        self._fetched = 0.0
+        self._pending = None  # in-flight state request
+
+        self._subscription = None  # device change notifications
+        self._subscribing = None
+        self._listeners = set()
+
+        self.stats = {"device_requests": 0, "cache_hits": 0, "coalesced": 0,
+                      "errors": 0, "listeners": 0, "dropped": 0}
+
+    def _run(self, func, *args):
+        """Call a device method in the worker thread, connect on demand"""
+        self.stats["device_requests"] += 1
+        # the poller thread uses (and reconnects) the connection too
+        with self.device.connection_lock:
+            if not self.device.tp:
+                self.device.connect(*self.address, retries=self.retries)
+            try:
+                return func(*args)
+            except LantopTransportError:
+                # reconnect with the next call, subscriptions are kept
+                self.device.disconnect()
+                self.stats["errors"] += 1
+                raise
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run,
+                                          func, *args)
+
+    def _read_states(self):
+        raw_states = self.device.get_raw_states()
+        if raw_states == self._raw_states:
+            return self._states, self._raw_states
+        return self.device.decode_states(raw_states), raw_states
+
+    def _set_states(self, states, raw_states):
+        if states is not self._states:
+            # of the labels served, states of the poller come without payload
+            mask, reasons = encode_states(states)
+            self._etag = '"{:02x}{}"'.format(mask, reasons.hex())
+        self._states, self._raw_states = states, raw_states
+        self._fetched = time.monotonic()
+
+    async def _fetch_states(self):
+        try:
+            states, raw_states = await self.call(self._read_states)
+        finally:
+            self._pending = None
+        self._set_states(states, raw_states)
+        return self._states, self._etag
+
+    async def get_states(self):
+        """Get the channel states and their ETag (cached for ttl seconds)"""
+        if self._states is not None and \
+           time.monotonic() - self._fetched < self.ttl:
+            self.stats["cache_hits"] += 1
+            return self._states, self._etag
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._fetch_states())
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(self._pending)
+
+    async def get_channel(self, channel):
+        states, etag = await self.get_states()
+        for state in states:
+            if state["index"] == channel:
+                break
+        else:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "No such channel")
+        if channel not in self._channel_names:
+            self._channel_names[channel] = \
+                await self.call(self.device.get_channel_name, channel)
+        return dict(state, name=self._channel_names[channel]), etag
+
+    async def set_state(self, channel, state, duration=None):
+        await self.call(self.device.set_state, channel, state, duration)
+        self._fetched = 0.0  # invalidate cache
+
+    async def get_info(self):
+        if self._info is None:
+            dev_type, serial = await self.call(self.device.get_info)
+            name = await self.call(self.device.get_name)
+            self._info = {"name": name, "type": dev_type, "serial": serial}
+        return self._info
+
+    async def listen(self):
+        """Get a queue receiving the lists of state changes
+
+        The first listener subscribes to the device, which starts polling
+        in the background. Full queues drop their oldest entry.
+        """
+        listener = asyncio.Queue(self.queue_size)
+        self._listeners.add(listener)
+        self.stats["listeners"] = len(self._listeners)
+        if self._subscription is None or not self._subscription.active:
+            loop = asyncio.get_running_loop()
+
+            def forward(changes):
+                loop.call_soon_threadsafe(self._notify, changes)
+            subscribe = functools.partial(
+                self.device.subscribe, forward, self.queue_size, "drop",
+                **self.poll_args)
+            if self._subscribing is None:
+                self._subscribing = asyncio.ensure_future(self.call(subscribe))
+            try:
+                self._subscription = await asyncio.shield(self._subscribing)
+            except LantopError:
+                self.unlisten(listener)
+                raise
+            finally:
+                self._subscribing = None
+        return listener
+
+    def unlisten(self, listener):
+        self._listeners.discard(listener)
+        self.stats["listeners"] = len(self._listeners)
+        if not self._listeners and self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+
+    def _notify(self, changes):
+        """Update the cache and fan the changes out (in the event loop)"""
+        if self._subscription is not None and self._subscription.states:
+            # the raw states of the poller are not known here
+            self._set_states(self._subscription.states, None)
+        for listener in self._listeners:
+            if listener.full():
+                listener.get_nowait()
+                self.stats["dropped"] += 1
+            listener.put_nowait(changes)
+
+    async def wait_for_change(self, timeout):
+        """Wait for the next state change (or timeout), get the states"""
+        listener = await self.listen()
+        try:
+            await asyncio.wait_for(listener.get(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.unlisten(listener)
+        return await self.get_states()
+
+    def close(self):
+        if self._subscription is not None:
+            self._subscription.cancel()
+        self._executor.submit(self.device.close)
+        self._executor.shutdown()
+
+
+class Server(object):
+    """Minimal HTTP/1.1 server exposing the device sessions"""
+
+    def __init__(self, sessions):
+        self.sessions = sessions  # dict: device id -> DeviceSession
+        self.started = time.time()
+        self.requests = 0
+
+    async def start(self, host="127.0.0.1", port=8080):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        """Serve requests on a (keep-alive) connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = \
+                        request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST,
+                                       {"error": "Bad request line"})
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    try:
+                        length = int(headers["content-length"])
+                        if length < 0:
+                            raise ValueError(length)
+                    except ValueError:
+                        await self.respond(writer, HTTPStatus.BAD_REQUEST,
+                                           {"error": "Bad Content-Length"})
+                        break
+                    body = await reader.readexactly(length)
+
+                keep_alive = headers.get("connection", "").lower() != \
+                    "close" and version == "HTTP/1.1"
+                target = urlsplit(target)
+                parts = [part for part in target.path.split("/") if part]
+                if method == "GET" and len(parts) == 3 and \
+                   parts[0] == "devices" and parts[2] == "events" and \
+                   parts[1] in self.sessions:
+                    await self.stream_events(self.sessions[parts[1]],
+                                             reader, writer)
+                    break
+                status, payload, extra_headers = await self.dispatch(
+                    method, target.path, headers, body,
+                    parse_qs(target.query))
+                await self.respond(writer, status, payload, extra_headers,
+                                   keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, headers=None,
+                      keep_alive=False):
+        body = b"" if payload is None else \
+            json.dumps(payload).encode() + b"\n"
+        lines = ["HTTP/1.1 {} {}".format(status.value, status.phrase),
+                 "Content-Length: {}".format(len(body)),
+                 "Connection: {}".format("keep-alive" if keep_alive
+                                         else "close")]
+        if body:
+            lines.append("Content-Type: application/json")
+        lines.extend("{}: {}".format(*item) for item in
+                     (headers or {}).items())
+        writer.write("\r\n".join(lines).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+
+    async def stream_events(self, session, reader, writer, heartbeat=15.0):
+        """Send the states, then the changes as server-sent events"""
+        self.requests += 1
+        try:
+            listener = await session.listen()
+        except LantopError as err:
+            await self.respond(writer, HTTPStatus.BAD_GATEWAY,
+                               {"error": str(err)})
+            return
+        closed = None
+        try:
+            states, _ = await session.get_states()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            writer.write(b"event: states\ndata: " +
+                         json.dumps(states).encode() + b"\n\n")
+            await writer.drain()
+            # the client is not supposed to send anything but to hang up
+            closed = asyncio.ensure_future(reader.read())
+            while True:
+                changes = asyncio.ensure_future(listener.get())
+                await asyncio.wait((changes, closed), timeout=heartbeat,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if closed.done():
+                    changes.cancel()
+                    break
+                if not changes.done():
+                    changes.cancel()
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    for change in changes.result():
+                        writer.write(b"event: change\ndata: " +
+                                     format_change_json(change).encode() +
+                                     b"\n\n")
+                await writer.drain()
+        except LantopError as err:
+            logger.error(err)
+        finally:
+            if closed is not None:
+                closed.cancel()
+            session.unlisten(listener)
+
+    async def dispatch(self, method, path, headers, body, query=None):
+        """Route a request, returns status, JSON payload and extra headers"""
+        self.requests += 1
+        query = query or {}
+        parts = [part for part in path.split("/") if part]
+        try:
+            if parts == ["devices"] and method == "GET":
+                return HTTPStatus.OK, await self.list_devices(), None
+            if parts == ["stats"] and method == "GET":
+                return HTTPStatus.OK, self.get_stats(), None
+            if len(parts) > 2 and parts[0] == "devices":
+                session = self.sessions.get(parts[1])
+                if session is None:
+                    raise HTTPError(HTTPStatus.NOT_FOUND, "No such device")
+                if parts[2:] == ["states"] and method == "GET":
+                    timeout = None
+                    if "wait" in query:
+                        try:
+                            timeout = float(query["wait"][0])
+                        except ValueError:
+                            timeout = math.nan
+                        if not 0 <= timeout < math.inf:
+                            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                                            "Invalid wait time")
+                        timeout = min(timeout, MAX_WAIT)
+                    states, etag = await session.get_states()
+                    if timeout is not None and \
+                       headers.get("if-none-match") == etag:
+                        states, etag = \
+                            await session.wait_for_change(timeout)
+                    return self.conditional(headers, states, etag)
+                if parts[2] == "channels" and len(parts) == 4:
+                    try:
+                        channel = int(parts[3])
+                    except ValueError:
+                        raise HTTPError(HTTPStatus.NOT_FOUND,
+                                        "No such channel")
+                    if method == "GET":
+                        return self.conditional(
+                            headers, *await session.get_channel(channel))
+                    if method == "PUT":
+                        return await self.put_channel(session, channel, body)
+                    raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+
+        except HTTPError as err:
+            return err.status, {"error": str(err)}, None
+        except LantopError as err:
+            logger.error(err)
+            return HTTPStatus.BAD_GATEWAY, {"error": str(err)}, None
+
+    @staticmethod
+    def conditional(headers, payload, etag):
+        if etag is not None and headers.get("if-none-match") == etag:
+            return HTTPStatus.NOT_MODIFIED, None, {"ETag": etag}
+        return HTTPStatus.OK, payload, {"ETag": etag}
+
+    async def put_channel(self, session, channel, body):
+        try:
+            request = json.loads(body.decode() or "{}")
+            state = request["state"]
+            duration = request.get("duration")
+            if not isinstance(state, str):
+                raise TypeError(state)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            'Expected {"state": ..., "duration": seconds}')
+        if duration is not None:
+            if state not in TIMED_STATE_LABELS:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid timed state")
+            if isinstance(duration, bool) or \
+               not isinstance(duration, (int, float)) or \
+               not 0 < duration <= MAX_DURATION:
+                raise HTTPError(HTTPStatus.BAD_REQUEST,
+                                "Duration must be a number of seconds "
+                                "(up to {:d})".format(MAX_DURATION))
+            duration = timedelta(seconds=duration)
+        elif state not in CONTROL_MODES:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid control mode")
+        if not 0 <= channel < 8:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "No such channel")
+
+        await session.set_state(channel, state, duration)
+        return HTTPStatus.ACCEPTED, {"index": channel, "state": state}, None
+
+    async def list_devices(self):
+        devices = []
+        for device_id, session in sorted(self.sessions.items()):
+            entry = {"id": device_id, "address": list(session.address)}
+            entry.update(await session.get_info())
+            devices.append(entry)
+        return devices
+
+    def get_stats(self):
+        return {"uptime": time.time() - self.started,
+                "requests": self.requests,
+                "devices": {device_id: session.stats for device_id, session
+                            in self.sessions.items()}}
+
+
+def serve(addresses, host="127.0.0.1", port=8080, ttl=1.0, retries=0,
+          **poll_args):
+    """Run the server until interrupted
+
+    :param addresses: list of device addresses ([host] or [host, port]),
+                      the devices get their list index as id
+    :param poll_args: passed to watch.StateWatcher for change notifications
+
+    """
+    sessions = {str(index): DeviceSession(*address, retries=retries, ttl=ttl,
+                                          **poll_args)
+                for index, address in enumerate(addresses)}
+    server = Server(sessions)
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start(host, port))
+    logger.info("Serving %d device(s) on %s:%d", len(sessions), host, port)
+    try:
+        loop.run_forever()
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        for session in sessions.values():
+            session.close()
+        loop.close()
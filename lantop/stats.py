@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Time series of channel statistics with delta/rate computation
+
+Samples of Lantop.get_channel_stats are stored column-wise: a directory
+with one flat array file per metric, appended to on each sample.
+"""
+
+import os
+import csv
+import time
+from array import array
+from collections import namedtuple
+from datetime import date, datetime
+
+from .consts import STATS_PATH
+
+
+FLAG_RESET = 0x01  # sample taken right after reset_channel_stats
+
+# typecodes of the same size on all platforms, the files are portable
+COLUMNS = (("time", "d"), ("device", "I"), ("channel", "B"),
+           ("active", "d"), ("service", "d"), ("switches", "I"),
+           ("last_reset", "q"), ("flags", "B"))
+
+StatsSample = namedtuple('StatsSample', [name for name, _ in COLUMNS])
+
+StatsDelta = namedtuple('StatsDelta', 'since until active service switches '
+                                      'reset')
+
+StatsRates = namedtuple('StatsRates', 'days active service switches '
+                                      'active_per_day switches_per_week '
+                                      'resets')
+
+
+class StatsStore(object):
+    """Columnar store for channel statistics samples"""
+
+    def __init__(self, path=None):
+        self.path = path or STATS_PATH
+
+    def _file(self, column):
+        return os.path.join(self.path, column + ".col")
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def append(self, channel, stats, device=0, timestamp=None, flags=0):
+        """Add a sample
+
+        :param channel: zero-based channel index
+        :param stats: tuple as returned by Lantop.get_channel_stats
+        :param device: device id (serial number)
+        :param timestamp: time of the reading (default: now)
+        :param flags: FLAG_* bits
+
+        """
+        active, service, switches, last_reset = stats
+        if timestamp is None:
+            timestamp = time.time()
+        elif hasattr(timestamp, "timestamp"):
+            timestamp = timestamp.timestamp()
+        values = (timestamp, device, channel, active, service, switches,
+                  last_reset.toordinal(), flags)
+
+        if not self.exists():
+            os.makedirs(self.path)
+        for (column, typecode), value in zip(COLUMNS, values):
+            with open(self._file(column), "ab") as fp:
+                array(typecode, [value]).tofile(fp)
+
+    def mark_reset(self, channel, device=0, timestamp=None):
+        """Record that the stats of a channel have been reset just now"""
+        self.append(channel, (0.0, 0.0, 0, date.today()), device, timestamp,
+                    FLAG_RESET)
+
+    def load(self):
+        """Read all columns
+
+        :returns: a dict of arrays, truncated to the same length
+
+        """
+        columns = {}
+        for column, typecode in COLUMNS:
+            values = array(typecode)
+            try:
+                with open(self._file(column), "rb") as fp:
+                    data = fp.read()
+                values.frombytes(data[:len(data) // values.itemsize *
+                                      values.itemsize])
+            except OSError:
+                pass
+            columns[column] = values
+        # a crash during append can leave columns of different length
+        length = min(len(values) for values in columns.values())
+        for column, values in columns.items():
+            del values[length:]
+        return columns
+
+    def samples(self, channel, device=None, since=None, columns=None):
+        """Get the samples of a channel (ordered by time)
+
+        :param since: datetime or time stamp of the first sample
+        :param columns: result of load, to read the files only once when
+            getting the samples of several channels
+
+        """
+        if hasattr(since, "timestamp"):
+            since = since.timestamp()
+        if columns is None:
+            columns = self.load()
+        times, devices, channels = \
+            columns["time"], columns["device"], columns["channel"]
+        selected = [i for i in range(len(times))
+                    if channels[i] == channel and
+                    (device is None or devices[i] == device) and
+                    (since is None or times[i] >= since)]
+        return [StatsSample(*(columns[name][i] for name, _ in COLUMNS))
+                for i in sorted(selected, key=times.__getitem__)]
+
+
+def delta(previous, sample):
+    """Compute the change from the previous sample of the same device
+
+    A reset is detected by a reset marker, a changed last_reset date or a
+    decreasing counter. After a reset the counters restarted from zero, so
+    the new values are the delta. The usage between the previous sample
+    and a reset marker is unknown and counted as zero.
+
+    """
+    # the date of a reset marker is a guess, don't compare against it
+    reset = bool(sample.flags & FLAG_RESET) or \
+        not previous.flags & FLAG_RESET and \
+        sample.last_reset != previous.last_reset or \
+        sample.active < previous.active or \
+        sample.service < previous.service or \
+        sample.switches < previous.switches
+    if sample.flags & FLAG_RESET:
+        values = (0.0, 0.0, 0)
+    elif reset:
+        values = (sample.active, sample.service, sample.switches)
+    else:
+        values = (sample.active - previous.active,
+                  sample.service - previous.service,
+                  sample.switches - previous.switches)
+    return StatsDelta(datetime.fromtimestamp(previous.time),
+                      datetime.fromtimestamp(sample.time),
+                      *values, reset=reset)
+
+
+def _with_previous(samples):
+    """Pair each sample with the previous one of the same device (or None)"""
+    previous = {}
+    for sample in samples:
+        yield previous.get(sample.device), sample
+        previous[sample.device] = sample
+
+
+def deltas(samples):
+    """Compute the changes between consecutive samples of each device
+
+    The counters of different devices are not compared, the changes of
+    all devices are returned in the order of the samples.
+
+    """
+    return [delta(previous, sample)
+            for previous, sample in _with_previous(samples) if previous]
+
+
+def rates(samples):
+    """Sum up the deltas and compute hours on per day, switches per week"""
+    changes = deltas(samples)
+    if not changes:
+        return None
+    span = max(change.until for change in changes) - \
+        min(change.since for change in changes)
+    days = span.total_seconds() / 86400
+    active = sum(change.active for change in changes)
+    service = sum(change.service for change in changes)
+    switches = sum(change.switches for change in changes)
+    return StatsRates(days, active, service, switches,
+                      active / days if days else 0.0,
+                      switches / days * 7 if days else 0.0,
+                      sum(change.reset for change in changes))
+
+
+def export_csv(samples, fp, header=True):
+    """Write samples and the deltas to their predecessors as CSV"""
+    writer = csv.writer(fp)
+    if header:
+        writer.writerow(("time", "device", "channel", "active", "service",
+                         "switches", "last_reset", "active_delta",
+                         "service_delta", "switches_delta", "reset"))
+    for previous, sample in _with_previous(samples):
+        change = delta(previous, sample) if previous else None
+        writer.writerow(
+            (datetime.fromtimestamp(sample.time).isoformat(), sample.device,
+             sample.channel, sample.active, sample.service, sample.switches,
+             date.fromordinal(sample.last_reset).isoformat()) +
+            ((change.active, change.service, change.switches,
+              int(change.reset)) if change else ("", "", "", "")))
+
+
+class StatsSampler(object):
+    """Read the statistics of all channels of a device into a store"""
+
+    def __init__(self, store):
+        self.store = store
+        self._channels = None
+
+    def sample(self, device, timestamp=None):
+        """Take one sample per channel"""
+        if self._channels is None:
+            self._channels = [ch["index"] for ch in device.get_states()]
+        serial = device.get_info()[1]
+        timestamp = timestamp or time.time()
+        for channel in self._channels:
+            self.store.append(channel, device.get_channel_stats(channel),
+                              serial, timestamp)
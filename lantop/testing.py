@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Fake device and Google Calendar API for the tests and benchmarks"""
+
+import json
+import copy
+import socket
+import hashlib
+import threading
+from datetime import timedelta
+from operator import itemgetter
+
+import httplib2
+from apiclient.errors import HttpError
+from dateutil.parser import parse as dateutil_parse
+
+
+class LantopEmulator(threading.Thread):
+    """Emulation of the a LANtop2 device for unit tests"""
+
+    def __init__(self, address=None, resp_dict=None):
+        """Set-up socket, start thread for listening to requests"""
+        threading.Thread.__init__(self)
+        self.running = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(address or ("localhost", 0))
+        self.socket.listen(1)
+
+        self.server_address = self.socket.getsockname()
+        self.resp_dict = resp_dict or {}
+        self.last_msg = ""
+        self.num_requests = 0
+
+    def start(self):
+        """Start server thread"""
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        """Accept connections. Send reply according to DATA dict variable"""
+        while self.running:
+            client_socket, caddr = self.socket.accept()
+            self.client_socket = client_socket
+            while self.running:
+                data = client_socket.recv(1024)
+                if not data:
+                    break
+
+                self.last_msg = data
+                self.num_requests += 1
+                header, args = data[:7], data[7:]
+                try:
+                    resp = self.resp_dict[header][0]
+                    if not isinstance(resp, bytes):
+                        resp = resp[args]
+                    client_socket.sendall(bytes([32 + len(resp)]) + resp)
+
+                except KeyError:
+                    # Unknown message...
+                    print('Unhandled message:', data)
+
+            client_socket.close()
+        self.socket.close()
+        self.running = False
+
+    def drop_connection(self):
+        """Break the connection of the client, accept a new one"""
+        self.client_socket.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        """Shutdown server thread"""
+        if self.running:
+            self.running = False
+            try:  # wake up accept
+                socket.create_connection(self.server_address).close()
+            except OSError:
+                pass
+        self.join()
+
+
+class FakeRequest(object):
+    """A request of FakeCalendarService, run by execute()"""
+
+    def __init__(self, func, kwargs):
+        self.func = func
+        self.kwargs = kwargs
+        self.headers = {}
+
+    def execute(self):
+        return self.func(headers=self.headers, **self.kwargs)
+
+
+class FakeCollection(object):
+    """A collection (events, calendarList) of FakeCalendarService"""
+
+    def __init__(self, **methods):
+        self.methods = methods
+
+    def __getattr__(self, name):
+        func = self.methods[name]
+        return lambda **kwargs: FakeRequest(func, kwargs)
+
+
+def event_time(time):
+    """Parse the start or end of an API event, a date as midnight UTC"""
+    return dateutil_parse(time.get("dateTime") or time["date"] + "T00:00Z")
+
+
+class FakeCalendarService(object):
+    """In memory stand-in for the Google Calendar API v3 service
+
+    Every change of an event gets a new version number; sync tokens are the
+    version of the last change they cover. Responses carry an ETag of the
+    request and the calendar version, If-None-Match is answered by 304.
+
+    """
+
+    def __init__(self, calendars=None):
+        """Set up calendars
+
+        :param calendars: dict of calendar name to list of event dicts as
+                          returned by the API (start and end as dateTime)
+
+        """
+        self.calendars = {}
+        self.version = 0
+        self.oldest_sync_token = 0
+        self.requests = []
+        self.failing = set()  # names of calendars answering with 500
+        for name, events in (calendars or {}).items():
+            self.calendars[name] = {}
+            for event in events:
+                self.put_event(name, event)
+
+    @staticmethod
+    def calendar_id(name):
+        return "{}@group.calendar.google.com".format(name)
+
+    def put_event(self, name, event):
+        """Add or change an event of a calendar"""
+        self.version += 1
+        self.calendars[name][event["id"]] = (self.version, event)
+
+    def cancel_event(self, name, event_id):
+        """Cancel (delete) an event of a calendar"""
+        self.version += 1
+        self.calendars[name][event_id] = (
+            self.version, {"id": event_id, "status": "cancelled"})
+
+    def expire_sync_tokens(self):
+        """Let requests with the sync tokens issued so far fail with 410"""
+        self.oldest_sync_token = self.version + 1
+
+    def calendarList(self):
+        return FakeCollection(list=self._list_calendars)
+
+    def events(self):
+        return FakeCollection(list=self._list_events)
+
+    @staticmethod
+    def check_etag(headers, *state):
+        """Get the ETag of a response, raise 304 if the client has it"""
+        etag = '"{}"'.format(hashlib.md5(repr(state).encode()).hexdigest())
+        if headers.get("If-None-Match") == etag:
+            raise HttpError(httplib2.Response({"status": 304}), b"")
+        return etag
+
+    def _list_calendars(self, headers, **kwargs):
+        self.requests.append(("calendarList", dict(kwargs, headers=headers)))
+        names = sorted(self.calendars)
+        return {"etag": self.check_etag(headers, names),
+                "items": [{"id": self.calendar_id(name), "summary": name}
+                          for name in names]}
+
+    def _list_events(self, headers, calendarId, timeMin=None, timeMax=None,
+                     maxResults=250, pageToken=None, syncToken=None,
+                     **kwargs):
+        params = dict(kwargs, calendarId=calendarId, timeMin=timeMin,
+                      timeMax=timeMax, maxResults=maxResults,
+                      pageToken=pageToken, syncToken=syncToken)
+        self.requests.append(("events", dict(params, headers=headers)))
+        name, = [name for name in self.calendars
+                 if self.calendar_id(name) == calendarId]
+        if name in self.failing:
+            raise HttpError(httplib2.Response({"status": 500}), b"Error")
+        if syncToken:
+            assert timeMin is None and timeMax is None
+            if int(syncToken) < self.oldest_sync_token:
+                raise HttpError(httplib2.Response({"status": 410}), b"Gone")
+            events = [event for version, event
+                      in sorted(self.calendars[name].values(),
+                                key=itemgetter(0))
+                      if version > int(syncToken)]
+        else:
+            start = dateutil_parse(timeMin) if timeMin else None
+            end = dateutil_parse(timeMax) if timeMax else None
+            events = sorted(
+                (event for _, event in self.calendars[name].values()
+                 if event.get("status") != "cancelled" and
+                 (start is None or event_time(event["end"]) > start) and
+                 (end is None or event_time(event["start"]) < end)),
+                key=lambda event: event_time(event["start"]))
+
+        etag = self.check_etag(
+            headers, max([0] + [version for version, _
+                                in self.calendars[name].values()]),
+            sorted(params.items()))
+        offset = int(pageToken or 0)
+        response = {"etag": etag,
+                    "items": [copy.deepcopy(event) for event
+                              in events[offset:offset + maxResults]]}
+        if offset + maxResults < len(events):
+            response["nextPageToken"] = str(offset + maxResults)
+        elif timeMax is None:
+            response["nextSyncToken"] = str(self.version)
+        return response
+
+
+def ApiEvent(index, start, hours=1):
+    """Get event dict like the API returns it"""
+    return {"id": "event{:d}".format(index),
+            "summary": "ch{:d} event {:d}".format(index % 4, index),
+            "start": {"dateTime": start.isoformat()},
+            "end": {"dateTime": (start + timedelta(hours=hours)).isoformat()},
+            "updated": "2026-01-01T00:00:00.000Z"}
+
+
+async def http_request(reader, writer, method, path, body=None, headers=()):
+    """Send a request on a keep-alive connection, get status, headers, body"""
+    lines = ["{} {} HTTP/1.1".format(method, path), "Host: test"]
+    lines.extend("{}: {}".format(*header) for header in headers)
+    data = json.dumps(body).encode() if body is not None else b""
+    lines.append("Content-Length: {}".format(len(data)))
+    writer.write("\r\n".join(lines).encode() + b"\r\n\r\n" + data)
+
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode()
+        if line == "\r\n":
+            break
+        name, _, value = line.partition(":")
+        response_headers[name.lower()] = value.strip()
+    length = int(response_headers["content-length"])
+    payload = await reader.readexactly(length)
+    return status, response_headers, json.loads(payload) if length else None
@@ -4,6 +4,8 @@
 import socket
 import logging
 import base64
+import threading
+from contextlib import contextmanager
 
 from .consts import ERROR_NAMES, DEFAULT_PORT
 from .errors import LantopTransportError
@@ -23,6 +25,7 @@ class Transport(object):
 
         """
         self._socket = None
+        self._lock = threading.RLock()  # one request (or batch) at a time
 
         try:
             # name resolution
@@ -96,10 +99,11 @@ class Transport(object):
         if channel is not None and not 0 <= channel < 8:
             raise LantopTransportError("Invalid channel index given")
 
-        # issue command
-        self._send(req_code, channel, args)
-        # get and check response
-        data = self._receive()
+        with self._lock:
+            # issue command
+            self._send(req_code, channel, args)
+            # get and check response
+            data = self._receive()
         if len(data) < len(resp_code):
             raise LantopTransportError("Invalid message")
         try:
@@ -111,6 +115,12 @@ class Transport(object):
         payload = data[len(resp_code):]
         return payload
 
+    @contextmanager
+    def batch(self):
+        """Issue several requests without others in between"""
+        with self._lock:
+            yield self
+
     def command(self, req_code, resp_code, channel=None, args=b''):
         """Issue command and check resulting error code
 
@@ -4,6 +4,7 @@ import os
 import logging
 import logging.config
 import pkgutil
+import tempfile
 
 import yamlsettings
 from pushbullet import Pushbullet
@@ -11,6 +12,29 @@ from pushbullet import Pushbullet
 from . import LANTOP_CONF_PATHS
 
 
+def write_atomic(filename, data):
+    """Replace a file by writing a temp file, fsync and rename"""
+    directory = os.path.dirname(filename) or "."
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".state")
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 def load_config():
     config = yamlsettings.yamldict.load(pkgutil.get_data(__package__, 'default.yml'))
 
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Watch channel states on a single connection and report changes"""
+
+import json
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from .errors import LantopError, LantopTransportError
+
+
+logger = logging.getLogger(__name__)
+
+
+StateChange = namedtuple('StateChange', 'time channel active reason')
+
+
+class StateWatcher(object):
+    """Poll channel states with an adaptive interval and report diffs
+
+    The interval drops to min_interval after each change and grows by the
+    backoff factor with every unchanged poll (up to max_interval). Unchanged
+    polls are detected on the raw payload, so they do not decode any states.
+    """
+
+    def __init__(self, device, min_interval=1.0, max_interval=30.0,
+                 backoff=1.5, recorder=None):
+        self.device = device
+        self.recorder = recorder  # e.g. a history.HistoryRecorder
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self.interval = min_interval
+        self.states = None  # last decoded states
+        self._raw_states = None
+
+    def poll(self, now=None):
+        """Query the device once
+
+        :param now: time stamp for the changes (default: now)
+        :returns: a list of StateChange (empty if nothing changed)
+
+        """
+        raw_states = self.device.get_raw_states()
+        now = now or datetime.now()
+        if raw_states == self._raw_states:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+            if self.recorder:
+                self.recorder.record(self.states, False, now, raw_states)
+            return []
+
+        states = self.device.decode_states(raw_states)
+        previous = {ch["index"]: ch for ch in self.states or ()}
+        changes = [StateChange(now, ch["index"], ch["active"], ch["reason"])
+                   for ch in states if previous.get(ch["index"]) != ch]
+
+        self.states, self._raw_states = states, raw_states
+        self.interval = self.min_interval
+        if self.recorder:
+            self.recorder.record(states, True, now, raw_states)
+        return changes
+
+    def __iter__(self):
+        """Poll forever and yield the non-empty lists of changes"""
+        while True:
+            changes = self.poll()
+            if changes:
+                yield changes
+            time.sleep(self.interval)
+
+
+class Subscription(object):
+    """A bounded queue of state changes fed by a StatePoller
+
+    If the queue is full, the "drop" policy discards the oldest entry,
+    "drop_new" discards the new one and "block" makes the poller wait (up to
+    block_timeout seconds, then the new entry is dropped). With a callback,
+    a thread of its own drains the queue, so slow callbacks only affect
+    their own subscription.
+    """
+
+    POLICIES = ("drop", "drop_new", "block")
+
+    def __init__(self, poller, callback=None, queue_size=100, policy="drop",
+                 block_timeout=30.0):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown policy {!r}".format(policy))
+        self.poller = poller
+        self.callback = callback
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.active = True
+
+        if callback is not None:
+            self._thread = threading.Thread(target=self._dispatch,
+                                            name="lantop-subscription",
+                                            daemon=True)
+            self._thread.start()
+
+    @property
+    def states(self):
+        """The most recent states seen by the poller"""
+        return self.poller.watcher.states
+
+    def put(self, changes):
+        """Queue a list of changes (called by the poller)"""
+        try:
+            if self.policy == "block":
+                self.queue.put(changes, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(changes)
+            return
+        except queue.Full:
+            pass
+        if self.policy == "drop":
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(changes)
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+
+    def get(self, timeout=None):
+        """Get the next list of changes
+
+        :raises queue.Empty: on timeout
+        :returns: a list of StateChange or None if cancelled
+
+        """
+        return self.queue.get(timeout=timeout)
+
+    def __iter__(self):
+        while True:
+            changes = self.get()
+            if changes is None:
+                break
+            yield changes
+
+    def _dispatch(self):
+        for changes in self:
+            try:
+                self.callback(changes)
+            except Exception:
+                logger.exception("Error in state change callback")
+
+    def cancel(self):
+        """Stop receiving changes"""
+        if not self.active:
+            return
+        self.active = False
+        self.poller.unsubscribe(self)
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class StatePoller(threading.Thread):
+    """Single background poller per device, fans changes out to subscribers
+
+    The thread runs while there are subscribers. New subscribers first get
+    the current state of all channels (if known).
+    """
+
+    def __init__(self, device, **watcher_args):
+        super().__init__(name="lantop-poller", daemon=True)
+        self.device = device
+        self.watcher = StateWatcher(device, **watcher_args)
+        self.subscribers = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def subscribe(self, *args, **kwargs):
+        subscription = Subscription(self, *args, **kwargs)
+        with self._lock:
+            if self.watcher.states:
+                now = datetime.now()
+                subscription.put([
+                    StateChange(now, ch["index"], ch["active"], ch["reason"])
+                    for ch in self.watcher.states])
+            self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self.subscribers:
+                self.subscribers.remove(subscription)
+            if not self.subscribers:
+                self._stop_event.set()
+
+    def stop(self):
+        for subscription in list(self.subscribers):
+            subscription.cancel()
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # the connection is shared with other users of the device
+                with self.device.connection_lock:
+                    if not self.device.tp:
+                        self.device.reconnect()
+                    try:
+                        changes = self.watcher.poll()
+                    except LantopTransportError:
+                        self.device.disconnect()  # reconnect next poll
+                        raise
+            except LantopTransportError as err:
+                logger.warning("Polling states failed: %s", err)
+                changes = None
+                self.watcher.interval = self.watcher.max_interval
+            except LantopError as err:
+                logger.warning("Polling states failed: %s", err)
+                changes = None
+                self.watcher.interval = self.watcher.max_interval
+            if changes:
+                with self._lock:
+                    subscribers = list(self.subscribers)
+                for subscription in subscribers:
+                    subscription.put(changes)
+            self._stop_event.wait(self.watcher.interval)
+
+
+def format_change(change):
+    """Format a state change as a line of text"""
+    return "{0.time:%Y-%m-%d %H:%M:%S}  CH {0.channel:d}  {1:3s}  {0.reason}" \
+           "".format(change, "On" if change.active else "Off")
+
+
+def format_change_json(change):
+    """Format a state change as a JSON line"""
+    return json.dumps({"time": change.time.isoformat(),
+                       "channel": change.channel,
+                       "active": change.active,
+                       "reason": change.reason})
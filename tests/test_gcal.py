@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
+import json
+import tempfile
+import functools
 import unittest
 
-from dateutil.tz import tzlocal
+from dateutil.tz import gettz, tzlocal, tzutc
+from dateutil.parser import parse as dateutil_parse
 from lantop.gcal.parser import (
-    Action, extract_actions, extract_actions_from_desc,
-    get_combined_actions, simplify_label
+    Action, ChannelMatcher, Span, combine_actions, extract_actions,
+    extract_actions_from_desc, get_combined_actions, simplify_label
 )
+from lantop.gcal.client import (
+    EventImporter, DiscoveryCache, merge_events, parse_event, parse_time
+)
+from lantop.gcal.ics import IcsSource, read_events, expand_events
+from lantop.gcal.scheduler import JobUpdater, Scheduler
+from lantop.gcal.store import EventStore, SqliteEventStore
+from lantop.gcal.timeline import compile_timeline, get_timeline_actions
+from lantop.testing import ApiEvent, FakeCalendarService
 
 NOW = datetime.now(tzlocal())
 
@@ -34,6 +47,16 @@ class EventParserTest(unittest.TestCase):
                Action(events[0]["end"], {0: "auto"}, "x ch0 adsf")]
         self.assertEqual(exp, actions)
 
+    def test_parse_event_owners(self):
+        event = Event(summary="x ch1")
+        event["id"] = "abc"
+        start, end = extract_actions([event])
+        self.assertEqual(({1: "abc"}, {1: event["end"]}),
+                         (start.owners, start.expires))
+        self.assertEqual(({1: "abc"}, {}), (end.owners, end.expires))
+        self.assertEqual({1: "ch1 x"},
+                         next(extract_actions([Event("ch1 x")])).owners)
+
     def test_parse_event_combiner(self):
         events = [Event(summary="ch0 com0"),
                   Event(summary="ch1 com1", end=NOW + timedelta(hours=3)),
@@ -47,6 +70,17 @@ class EventParserTest(unittest.TestCase):
                Action(events[1]["end"], {1: "auto"}, "ch1 com1")]
         self.assertEqual(exp, actions)
 
+    def test_combine_actions(self):
+        actions = [Action(NOW, {0: "on"}, "a", {0: "e1"}),
+                   Action(NOW, {1: "on"}, "b", {1: "e2"}),
+                   Action(NOW, {0: "auto"}, "a", {0: "e3"})]
+        combined, = combine_actions(actions)
+        self.assertEqual(Action(NOW, {0: "auto", 1: "on"}, "a + b"),
+                         combined)
+        self.assertEqual({0: "e3", 1: "e2"}, combined.owners)
+        with self.assertRaises(AttributeError):
+            combined.comment = "x"
+
     def test_simplify_comments(self):
         events = [Event(summary="ch0 com0"),
                   Event(summary="ch1 com1", end=NOW + timedelta(hours=3)),
@@ -93,5 +127,564 @@ class EventParserTest(unittest.TestCase):
         self.assertEqual([], actions)
 
 
+class ChannelMatcherTest(unittest.TestCase):
+    def test_first(self):
+        matcher = ChannelMatcher(["Ch10", "ch1", "a.b"])
+        self.assertEqual(1, matcher.first("meeting CH1"))
+        self.assertEqual(0, matcher.first("ch10 talk"))
+        self.assertEqual(2, matcher.first("room a.b"))
+        self.assertIsNone(matcher.first("room axb"))
+        # names within or overlapping others
+        self.assertEqual(0, ChannelMatcher(["Hall", "Small Hall"]).first(
+            "Small Hall meeting"))
+        self.assertEqual(0, ChannelMatcher(["bcd", "abc"]).first("abcd"))
+        self.assertEqual(1, ChannelMatcher(["hallway", "hall"]).first(
+            "hall b"))
+        self.assertIsNone(ChannelMatcher([]).first("ch1"))
+
+    def test_find_offsets(self):
+        matcher = ChannelMatcher(["ch0", "Hall"])
+        self.assertEqual([(1, 0, 0), (0, -15, 30)],
+                         list(matcher.find_offsets("hall, CH0-15+30")))
+        self.assertEqual(" + ", matcher.remove("HALL + ch0"))
+
+
+class TimelineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Action.set_defaults('ch0 ch1 ch2 ch3'.split(), '', '', '')
+
+    @staticmethod
+    def span(channel, start, end, owner):
+        return Span(channel, NOW + timedelta(hours=start),
+                    NOW + timedelta(hours=end), owner, owner)
+
+    def test_merge(self):
+        spans = [self.span(0, 2, 5, "b"), self.span(0, 0, 3, "a"),
+                 self.span(0, 5, 6, "c"),  # abutting
+                 self.span(0, 4, 4.5, "d"),  # contained
+                 self.span(0, 7, 8, "e"), self.span(1, 1, 2, "f")]
+        self.assertEqual([self.span(0, 0, 6, "a")._replace(
+                              label="a + b + d + c"),
+                          self.span(0, 7, 8, "e"), self.span(1, 1, 2, "f")],
+                         compile_timeline(spans))
+
+    def test_empty(self):
+        self.assertEqual([], compile_timeline([]))
+
+    def test_actions(self):
+        events = [Event(summary="ch0 x"),
+                  Event(summary="ch0 y", start=NOW + timedelta(hours=1),
+                        end=NOW + timedelta(hours=3)),
+                  Event(summary="ch1 z", end=NOW + timedelta(hours=3))]
+        events[0]["id"] = "x1"
+        actions = get_timeline_actions(events)
+        self.assertEqual([Action(NOW, {0: "on", 1: "on"},
+                                 "ch0 x + ch0 y + ch1 z"),
+                          Action(NOW + timedelta(hours=3),
+                                 {0: "auto", 1: "auto"},
+                                 "ch0 x + ch0 y + ch1 z")], actions)
+        self.assertEqual({0: "x1", 1: "ch1 z"}, actions[0].owners)
+        self.assertEqual({0: NOW + timedelta(hours=3),
+                          1: NOW + timedelta(hours=3)}, actions[0].expires)
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_cancel_lazily(self):
+        calls = []
+        scheduler = Scheduler(timefunc=lambda: 10, delayfunc=lambda _: None)
+        events = [scheduler.enterabs(time, 1, calls.append, (time,))
+                  for time in range(1, 5)]
+        self.assertTrue(scheduler.cancel_lazily(events[1]))
+        self.assertFalse(scheduler.cancel_lazily(events[1]))
+        self.assertEqual([1, 3, 4], [event.time for event in scheduler.queue])
+        self.assertEqual(4, len(scheduler._queue))
+        # the heap is rebuilt once most of it is cancelled
+        scheduler.cancel_lazily(events[2])
+        scheduler.cancel_lazily(events[3])
+        self.assertEqual(1, len(scheduler._queue))
+        event = scheduler.enterabs(5, 1, calls.append, (5,))
+        scheduler.run()
+        self.assertEqual([1, 5], calls)
+        self.assertTrue(scheduler.empty())
+        # events that have run are not cancelled
+        self.assertFalse(scheduler.cancel_lazily(event))
+
+
+class ParseTimeTest(unittest.TestCase):
+    def test_parse_time(self):
+        for text in ("2026-01-05T07:00:00+01:00", "2026-01-05T07:00:00-05:30",
+                     "2026-01-05T07:00:00.250Z", "2026-01-05T07:00:00z",
+                     "Jan 5 2026 07:00 +0100"):
+            parsed = parse_time(text)
+            self.assertEqual(dateutil_parse(text), parsed)
+            self.assertEqual(dateutil_parse(text).utcoffset(),
+                             parsed.utcoffset())
+        self.assertIs(parse_time("2026-01-05T07:00:00+01:00").tzinfo,
+                      parse_time("2026-02-05T07:00:00+01:00").tzinfo)
+
+    def test_lazy_times(self):
+        event = parse_event(ApiEvent(1, datetime(2026, 1, 5, tzinfo=tzutc())))
+        self.assertEqual(datetime(2026, 1, 5, 1, tzinfo=tzutc()), event["end"])
+        self.assertNotIn("updated", dict(event))
+        self.assertEqual(datetime(2026, 1, 1, tzinfo=tzutc()),
+                         event["updated"])
+        self.assertIn("updated", event)
+        with self.assertRaises(KeyError):
+            event["created"]
+
+
+def check_recurring(test, store):
+    """Sync a recurring event with exceptions into a store and expand it"""
+    start = NOW.replace(microsecond=0) + timedelta(minutes=30)
+
+    def occurrence_id(day):
+        return "daily_{:%Y%m%dT%H%M%SZ}".format(
+            (start + timedelta(days=day)).astimezone(tzutc()))
+
+    def original(day):
+        return {"dateTime": (start + timedelta(days=day)).isoformat()}
+
+    test.service.put_event("cal", dict(
+        ApiEvent(0, start), id="daily", summary="ch1 daily",
+        recurrence=["RRULE:FREQ=DAILY", "EXDATE:" + occurrence_id(1)[6:]],
+        start=dict(original(0), timeZone="UTC")))
+    importer = EventImporter(None, None, "cal", single_events=False,
+                             service=test.service)
+    test.service.put_event("cal", dict(
+        ApiEvent(1, start), id="broken", recurrence=["RRULE:FREQ=SOMETIMES"]))
+    test.assertEqual(12, importer.sync(store, NOW))
+    test.assertFalse(test.service.requests[-1][1]["singleEvents"])
+    events = store.get_events(NOW, NOW + timedelta(days=4))
+    test.assertEqual([occurrence_id(day) for day in (0, 2, 3)],
+                     [event["id"] for event in events
+                      if event["summary"] == "ch1 daily"])
+    test.assertEqual(13, len(events))
+
+    # a moved and a cancelled occurrence
+    test.service.put_event("cal", dict(
+        ApiEvent(0, start + timedelta(days=2, hours=2)),
+        id=occurrence_id(2), summary="ch1 moved", recurringEventId="daily",
+        originalStartTime=original(2)))
+    test.service.put_event("cal", {
+        "id": occurrence_id(3), "status": "cancelled",
+        "recurringEventId": "daily", "originalStartTime": original(3)})
+    test.assertEqual(2, importer.sync(store, NOW))
+    occurrences = store.recurring["daily"][1]
+    events = store.get_events(NOW + timedelta(days=1),
+                              NOW + timedelta(days=5))
+    test.assertEqual([("ch1 moved", start + timedelta(days=2, hours=2)),
+                      ("ch1 daily", start + timedelta(days=4))],
+                     [(event["summary"], event["start"])
+                      for event in events])
+    # the expansion is extended, not started over
+    test.assertIs(occurrences, store.recurring["daily"][1])
+    # the recurring events and the cancelled occurrence are left
+    store.prune(NOW + timedelta(days=3))
+    test.assertEqual(3, len(store))
+
+
+class EventImporterTest(unittest.TestCase):
+    def setUp(self):
+        events = [ApiEvent(index, NOW + timedelta(hours=index))
+                  for index in range(10)]
+        self.service = FakeCalendarService({"cal": events})
+        EventImporter.calendar_name_id_cache.clear()
+        self.importer = EventImporter(None, None, "cal", page_size=4,
+                                      service=self.service)
+
+    def test_iter_events(self):
+        def requests():
+            return [kwargs for kind, kwargs in self.service.requests
+                    if kind == "events"]
+        events = self.importer.iter_events(NOW, NOW + timedelta(days=1))
+        self.assertEqual([], requests())
+        self.assertEqual("event0", next(events)["id"])
+        self.assertEqual(1, len(requests()))  # pages are fetched lazily
+
+        events = list(events)
+        self.assertEqual(["event{:d}".format(index) for index in range(1, 10)],
+                         [event["id"] for event in events])
+        self.assertEqual(NOW + timedelta(hours=9), events[-1]["start"])
+        requests = requests()
+        self.assertEqual([None, "4", "8"],
+                         [kwargs["pageToken"] for kwargs in requests])
+        self.assertEqual([4] * 3, [kwargs["maxResults"] for kwargs in requests])
+        self.assertIn("items(id,summary,description,start,end,updated)",
+                      requests[0]["fields"])
+
+    def test_get_events(self):
+        events = self.importer.get_events(NOW + timedelta(minutes=150),
+                                          NOW + timedelta(hours=5))
+        self.assertEqual(["event2", "event3", "event4"],
+                         [event["id"] for event in events])
+
+    def test_sync(self):
+        def last_request():
+            return [kwargs for kind, kwargs in self.service.requests
+                    if kind == "events"][-1]
+        store = EventStore()
+        self.assertEqual(10, self.importer.sync(store, NOW))
+        self.assertEqual(10, len(store))
+        self.assertIsNotNone(store.sync_token)
+
+        self.service.put_event("cal", ApiEvent(3, NOW + timedelta(hours=30)))
+        self.service.cancel_event("cal", "event5")
+        self.service.cancel_event("cal", "unknown")
+        self.assertEqual(2, self.importer.sync(store, NOW))
+        self.assertEqual(store.sync_token, str(self.service.version))
+        self.assertIsNone(last_request()["timeMin"])
+        self.assertEqual(9, len(store))
+        self.assertEqual(NOW + timedelta(hours=30),
+                         store.events["event3"]["start"])
+        self.assertEqual(0, self.importer.sync(store, NOW))
+        # the same request again is answered by 304 Not Modified
+        self.assertIsNone(self.importer.sync(store, NOW))
+        self.assertIn("If-None-Match", last_request()["headers"])
+        self.assertEqual(1, self.importer.not_modified)
+
+        # an expired sync token results in a full sync
+        self.service.expire_sync_tokens()
+        self.assertEqual(9, self.importer.sync(store, NOW))
+        self.assertIsNotNone(last_request()["timeMin"])
+        self.assertEqual(["event{:d}".format(index) for index in (0, 1, 2, 4)],
+                         [event["id"] for event in store.get_events(
+                             NOW, NOW + timedelta(hours=4, minutes=30))])
+
+    def test_job_updater(self):
+        scheduler = Scheduler(timefunc=lambda: NOW - timedelta(minutes=1))
+        updater = JobUpdater({"credentials_storage_path": None,
+                              "dev_key": None, "service": self.service},
+                             "cal", {"hours": 12})
+        updater.update(scheduler, print)
+        # the "auto" of an event is combined with the "on" of the next
+        self.assertEqual(11, len(scheduler.queue))
+        before = scheduler.queue  # keeps the ids of these events unique
+        scheduled = {id(event) for event in before}
+        self.service.cancel_event("cal", "event9")
+        updater.update(scheduler, print)
+        self.assertEqual(10, len(scheduler.queue))
+        # only the changed actions are cancelled and entered again
+        self.assertEqual(9, len(scheduled & {id(event)
+                                             for event in scheduler.queue}))
+        self.assertEqual(9, len(updater.calendars[0].store))
+        # the importer is kept, the calendar was looked up once
+        self.assertEqual(1, len([kind for kind, _ in self.service.requests
+                                 if kind == "calendarList"]))
+
+        # polls without changes are skipped until half the span is over
+        queue = scheduler.queue
+        updater.update(scheduler, None)
+        updater.update(scheduler, None)
+        self.assertEqual(2, updater.skipped_polls)
+        self.assertEqual(queue, scheduler.queue)
+        scheduler.timefunc = lambda: NOW + timedelta(hours=6)
+        updater.update(scheduler, print)
+        self.assertEqual(2, updater.skipped_polls)
+        self.assertEqual(3, len(scheduler.queue))
+
+    def test_calendars(self):
+        self.service.calendars["wing"] = {}
+        self.service.put_event("wing", ApiEvent(20, NOW + timedelta(
+            minutes=30)))
+        scheduler = Scheduler(timefunc=lambda: NOW - timedelta(minutes=1))
+        updater = JobUpdater({"credentials_storage_path": None,
+                              "dev_key": None, "service": self.service},
+                             None, {"hours": 12},
+                             calendar_names=["cal", "wing"])
+        updater.update(scheduler, print)
+        self.assertEqual(12, len(scheduler.queue))
+        self.assertIn({0: "on"}, [event.argument[0]
+                                  for event in scheduler.queue])
+
+        # a failing calendar keeps its events, the others are updated
+        self.service.failing.add("wing")
+        self.service.cancel_event("cal", "event9")
+        updater.update(scheduler, print)
+        self.assertEqual(11, len(scheduler.queue))
+        self.assertEqual(1, len(updater.calendars[1].store))
+
+    def test_all_day_event(self):
+        self.service.calendars["wing"] = {}
+        tomorrow = NOW + timedelta(days=1)
+        all_day = {"id": "holiday", "summary": "ch0 on",
+                   "start": {"date": NOW.date().isoformat()},
+                   "end": {"date": tomorrow.date().isoformat()}}
+        self.service.put_event("wing", all_day)
+        self.service.put_event("wing", ApiEvent(20, NOW + timedelta(
+            minutes=30)))
+        scheduler = Scheduler(timefunc=lambda: NOW - timedelta(minutes=1))
+        updater = JobUpdater({"credentials_storage_path": None,
+                              "dev_key": None, "service": self.service},
+                             None, {"hours": 12},
+                             calendar_names=["cal", "wing"])
+        updater.update(scheduler, print)
+        self.assertEqual(12, len(scheduler.queue))
+        self.assertEqual(1, len(updater.calendars[1].store))
+
+        # a timed event changed to an all day one is removed
+        self.service.put_event("wing", dict(all_day, id="event20"))
+        updater.update(scheduler, print)
+        self.assertEqual(0, len(updater.calendars[1].store))
+        # listing events leaves them out
+        self.service.put_event("cal", all_day)
+        self.assertEqual(1, len(self.importer.get_events(
+            NOW, NOW + timedelta(minutes=30))))
+
+    def test_merge_events(self):
+        def events(*hours):
+            return [{"start": NOW + timedelta(hours=hour)} for hour in hours]
+        merged = merge_events([events(1, 4), events(), events(0, 2, 3)])
+        self.assertEqual(events(0, 1, 2, 3, 4), list(merged))
+
+    def test_calendar_list_not_modified(self):
+        # the calendar list is known since the importer was created
+        self.importer.select_calendar("cal", use_cache=False)
+        self.importer.select_calendar("cal", use_cache=False)
+        self.assertEqual(2, self.importer.not_modified)
+        self.assertEqual("cal@group.calendar.google.com",
+                         self.importer._calendar_id)
+
+    def test_calendar_cache(self):
+        EventImporter.calendar_name_id_cache.clear()
+        with tempfile.TemporaryDirectory() as path:
+            EventImporter(None, None, "cal", cache_path=path,
+                          service=self.service)
+            self.assertTrue(os.path.exists(os.path.join(path,
+                                                        "calendars.json")))
+            EventImporter.calendar_name_id_cache.clear()
+            del self.service.requests[:]
+            importer = EventImporter(None, None, "cal", cache_path=path,
+                                     service=self.service)
+            self.assertEqual([], self.service.requests)
+            self.assertEqual(1, len(importer.get_events(
+                NOW, NOW + timedelta(minutes=30))))
+
+            importer.forget_calendar("cal")
+            EventImporter(None, None, "cal", cache_path=path,
+                          service=self.service)
+            self.assertEqual("calendarList", self.service.requests[-1][0])
+
+    def test_calendar_cache_threads(self):
+        names = ["cal{:d}".format(index) for index in range(50)]
+        for name in names:
+            self.service.calendars[name] = {}
+        with tempfile.TemporaryDirectory() as path:
+            def select(name):
+                importer = EventImporter(None, None, cache_path=path,
+                                         service=self.service)
+                for _ in range(5):
+                    importer.select_calendar(name, use_cache=False)
+                    importer.forget_calendar(name)
+                importer.select_calendar(name)
+            with ThreadPoolExecutor(8) as pool:
+                list(pool.map(select, names))
+            with open(os.path.join(path, "calendars.json")) as fp:
+                self.assertLessEqual(set(names), set(json.load(fp)))
+
+    def test_discovery_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = DiscoveryCache(os.path.join(path, "discovery"), 60)
+            self.assertIsNone(cache.get("https://x/calendar/v3"))
+            cache.set("https://x/calendar/v3", '{"doc": 1}')
+            self.assertEqual('{"doc": 1}', cache.get("https://x/calendar/v3"))
+            self.assertIsNone(cache.get("https://x/drive/v3"))
+            cache.max_age = -1
+            self.assertIsNone(cache.get("https://x/calendar/v3"))
+
+    def test_unwritable_cache(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            # the caches cannot be written below a file, but work without
+            cache_path = os.path.join(fp.name, "googleapi")
+            DiscoveryCache(cache_path).set("https://x/calendar/v3", "{}")
+            importer = EventImporter(None, None, "cal",
+                                     cache_path=cache_path,
+                                     service=self.service)
+            self.assertEqual(10, len(importer.get_events(
+                NOW, NOW + timedelta(hours=12))))
+
+    def test_recurring(self):
+        check_recurring(self, EventStore())
+
+
+class SqliteEventStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "events.sqlite")
+        events = [ApiEvent(index, NOW + timedelta(hours=index))
+                  for index in range(10)]
+        self.service = FakeCalendarService({"cal": events})
+        self.importer = EventImporter(None, None, "cal", service=self.service)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_sync(self):
+        store = SqliteEventStore(self.path)
+        self.assertEqual(10, self.importer.sync(store, NOW))
+        self.service.cancel_event("cal", "event2")
+        self.assertEqual(1, self.importer.sync(store, NOW))
+        store.close()
+
+        store = SqliteEventStore(self.path)
+        self.assertEqual(9, len(store))
+        self.assertEqual(str(self.service.version), store.sync_token)
+        events = store.get_events(NOW + timedelta(minutes=30),
+                                  NOW + timedelta(hours=3, minutes=30))
+        self.assertEqual(["event0", "event1", "event3"],
+                         [event["id"] for event in events])
+        self.assertEqual(NOW + timedelta(hours=4), events[-1]["end"])
+        self.assertEqual(datetime(2026, 1, 1, tzinfo=tzutc()),
+                         events[-1]["updated"])
+        store.prune(NOW + timedelta(hours=5))
+        self.assertEqual(6, len(store))
+        store.clear()
+        self.assertEqual((0, None), (len(store), store.sync_token))
+
+    def test_recurring(self):
+        check_recurring(self, SqliteEventStore(self.path))
+        # the rules and exceptions are read back from the database
+        events = SqliteEventStore(self.path).get_events(
+            NOW + timedelta(days=3), NOW + timedelta(days=5))
+        self.assertEqual([("ch1 daily", 4)],
+                         [(event["summary"], (event["start"] - NOW).days)
+                          for event in events])
+
+    def test_startup_offline(self):
+        self.importer.sync(SqliteEventStore(self.path, "cal"), NOW)
+        scheduler = Scheduler(timefunc=lambda: NOW - timedelta(minutes=1))
+        updater = JobUpdater({"credentials_storage_path": None,
+                              "dev_key": None, "service": self.service},
+                             "cal", {"hours": 12},
+                             store=functools.partial(SqliteEventStore,
+                                                     self.path))
+        updater.schedule(scheduler, print)
+        self.assertEqual(11, len(scheduler.queue))
+
+        def unreachable():
+            raise OSError("Network is unreachable")
+        self.service.events = unreachable
+        updater.run(scheduler, print)
+        self.assertEqual(11, len(scheduler.queue))
+
+
+ICS = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:weekly
+DTSTART;TZID=Europe/Berlin:20260105T090000
+DTEND;TZID=Europe/Berlin:20260105T100000
+RRULE:FREQ=WEEKLY;COUNT=10
+EXDATE;TZID=Europe/Berlin:20260119T090000
+SUMMARY:ch1 weekly\\, on
+ e hour
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly
+RECURRENCE-ID;TZID=Europe/Berlin:20260126T090000
+DTSTART;TZID=Europe/Berlin:20260126T100000
+DTEND;TZID=Europe/Berlin:20260126T110000
+SUMMARY:ch1 moved
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly
+RECURRENCE-ID;TZID=Europe/Berlin:20260202T090000
+DTSTART;TZID=Europe/Berlin:20260202T090000
+STATUS:CANCELLED
+END:VEVENT
+BEGIN:VEVENT
+UID:single
+DTSTART:20260107T120000Z
+DURATION:PT2H
+SUMMARY:ch2 single
+END:VEVENT
+BEGIN:VEVENT
+UID:allday
+DTSTART;VALUE=DATE:20260108
+SUMMARY:ch3 all day
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class IcsSourceTest(unittest.TestCase):
+    start = datetime(2026, 1, 1, tzinfo=tzutc())
+    end = datetime(2026, 2, 10, tzinfo=tzutc())
+
+    @classmethod
+    def setUpClass(cls):
+        Action.set_defaults('ch0 ch1 ch2 ch3'.split(), '', '', '')
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "cal.ics")
+        with open(self.path, "w") as fp:
+            fp.write(ICS)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_expand_events(self):
+        events = expand_events(read_events(self.path), self.start, self.end)
+        self.assertEqual(["weekly_20260105T080000Z", "single",
+                          "weekly_20260112T080000Z", "weekly_20260126T080000Z",
+                          "weekly_20260209T080000Z"],
+                         [event["id"] for event in events])
+        self.assertEqual("ch1 weekly, one hour", events[0]["summary"])
+        self.assertEqual(datetime(2026, 1, 5, 9, tzinfo=gettz("Europe/Berlin")),
+                         events[0]["start"])
+        self.assertEqual(timedelta(hours=2),
+                         events[1]["end"] - events[1]["start"])
+        self.assertEqual(("ch1 moved", 10), (events[3]["summary"],
+                                            events[3]["start"].hour))
+
+    def test_sync(self):
+        source = IcsSource(self.tmp.name)
+        store = EventStore()
+        end = datetime(2026, 1, 20, tzinfo=tzutc())
+        self.assertEqual(4, source.sync(store, self.start, end))
+        self.assertEqual(None, source.sync(store, self.start, end))
+        # changed files are read again
+        with open(self.path, "a") as fp:
+            fp.write(ICS.replace("UID:single", "UID:other"))
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual(5, source.sync(store, self.start, end))
+        # with the week expanded ahead
+        self.assertEqual(["other", "single", "weekly_20260105T080000Z",
+                          "weekly_20260112T080000Z", "weekly_20260126T080000Z"],
+                         sorted(store.events))
+
+    def test_job_updater(self):
+        scheduler = Scheduler(timefunc=lambda: self.start)
+        updater = JobUpdater(None, "cal", {"days": 10},
+                             ics_paths=[self.path])
+        updater.update(scheduler, print)
+        self.assertEqual([self.path],
+                         [calendar.name for calendar in updater.calendars])
+        # "on" and "auto" of the first weekly and the single event
+        self.assertEqual(4, len(scheduler.queue))
+
+    def test_broken_file(self):
+        broken = os.path.join(self.tmp.name, "broken.ics")
+        with open(broken, "w") as fp:
+            fp.write(ICS.replace("UID:single", "UID:other").replace(
+                "DTSTART:20260107T120000Z", "DTSTART:20260107T1X0000Z")
+                .replace("FREQ=WEEKLY", "FREQ=SOMETIMES"))
+        # the recurring and the single event are skipped
+        self.assertEqual(["weekly", "weekly", "allday"],
+                         [event.uid for event in read_events(broken)])
+
+        scheduler = Scheduler(timefunc=lambda: self.start)
+        updater = JobUpdater(None, "cal", {"days": 10},
+                             ics_paths=[broken, self.path, self.tmp.name])
+
+        def unreadable():
+            raise ValueError("unreadable")
+        updater.calendars[2].make_source = unreadable
+        updater.update(scheduler, print)
+        # the events of the good file are scheduled
+        self.assertEqual(4, len(scheduler.queue))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Tests for the channel state history log"""
+
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from lantop.history import HistoryLog, HistoryRecorder, encode_states
+
+T0 = 1450000000.0
+
+
+def states(*active):
+    return [{"active": bool(on), "reason": "Hand" if on else "Auto",
+             "index": i} for i, on in enumerate(active)]
+
+
+class HistoryLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = HistoryLog(self.tmp.name, segment_records=1000)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_encode_states(self):
+        mask, reasons = encode_states(states(1, 0, 1))
+        self.assertEqual(0b101, mask)
+        self.assertEqual(b'\x07\x00\x07\x00\x00\x00\x00\x00', reasons)
+        # the codes of labels used more than once are taken from the payload
+        mask, reasons = encode_states(states(0, 1), b'\x02\x8f\x00\x00')
+        self.assertEqual(0b10, mask)
+        self.assertEqual(b'\x02\x0f\x00\x00\x00\x00\x00\x00', reasons)
+
+    def test_records(self):
+        for i in range(10):
+            self.log.append(states(i % 2), device=7, timestamp=T0 + i)
+        records = list(self.log.records(T0 + 3, T0 + 6))
+        self.assertEqual([T0 + 3, T0 + 4, T0 + 5],
+                         [r.timestamp for r in records])
+        self.assertEqual([1, 0, 1], [r.mask for r in records])
+        self.assertEqual([], list(self.log.records(device=8)))
+
+    def test_segments_and_index(self):
+        for i in range(2500):
+            self.log.append(states(i % 3 == 0), timestamp=T0 + 10 * i)
+        segments = [n for n in os.listdir(self.tmp.name) if n.endswith('.seg')]
+        self.assertEqual(3, len(segments))
+        records = list(self.log.records(T0 + 10 * 1995, T0 + 10 * 2005))
+        self.assertEqual(10, len(records))
+        self.assertEqual(T0 + 10 * 1995, records[0].timestamp)
+        self.assertEqual(T0 + 10 * 999,
+                         self.log.last_before(T0 + 10 * 1000 - 1).timestamp)
+
+    def test_reopen_continues_segment(self):
+        self.log.append(states(1), timestamp=T0)
+        log = HistoryLog(self.tmp.name, segment_records=1000)
+        log.append(states(0), timestamp=T0 + 1)
+        self.assertEqual(2, len(list(log.records())))
+
+    def test_on_intervals(self):
+        for offset, active in ((0, 0), (100, 1), (200, 1), (300, 0),
+                               (400, 1)):
+            self.log.append(states(0, active), timestamp=T0 + offset)
+        intervals = self.log.on_intervals(1, T0 + 150, T0 + 450)
+        self.assertEqual(
+            [(datetime.fromtimestamp(T0 + 150), datetime.fromtimestamp(T0 + 300)),
+             (datetime.fromtimestamp(T0 + 400), datetime.fromtimestamp(T0 + 450))],
+            intervals)
+        self.assertAlmostEqual(0.5, self.log.duty_cycle(1, T0, T0 + 400))
+        self.assertEqual(0.0, self.log.duty_cycle(0, T0, T0 + 400))
+
+    def test_on_intervals_devices(self):
+        # device 2 was on before the range, device 1 records in between
+        self.log.append(states(1), device=2, timestamp=T0)
+        for offset, active in ((100, 0), (200, 1), (300, 0)):
+            self.log.append(states(active), device=1, timestamp=T0 + offset)
+        self.log.append(states(0), device=2, timestamp=T0 + 250)
+
+        def seconds(intervals):
+            return [((since - datetime.fromtimestamp(T0)).total_seconds(),
+                     (until - datetime.fromtimestamp(T0)).total_seconds())
+                    for since, until in intervals]
+        self.assertEqual([(50, 250)], seconds(self.log.on_intervals(
+            0, T0 + 50, T0 + 400, device=2)))
+        self.assertEqual([(200, 300)], seconds(self.log.on_intervals(
+            0, T0 + 50, T0 + 400, device=1)))
+        # on while any device was on
+        self.assertEqual([(50, 300)], seconds(self.log.on_intervals(
+            0, T0 + 50, T0 + 400)))
+        self.assertEqual([(50, 90)], seconds(self.log.on_intervals(
+            0, T0 + 50, T0 + 90)))
+
+    def test_on_intervals_max_gap(self):
+        self.log.max_gap = 60
+        self.log.append(states(1), timestamp=T0)
+        self.log.append(states(1), timestamp=T0 + 100)
+        self.assertAlmostEqual(0.6, self.log.duty_cycle(0, T0, T0 + 200))
+
+    def test_recorder_heartbeat(self):
+        recorder = HistoryRecorder(self.log, device=1, heartbeat=60)
+        recorder.record(states(1), True, T0)
+        recorder.record(states(1), False, T0 + 30)
+        recorder.record(states(1), False, T0 + 60)
+        self.assertEqual([T0, T0 + 60],
+                         [r.timestamp for r in self.log.records(device=1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
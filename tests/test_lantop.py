@@ -6,8 +6,8 @@ import unittest
 from datetime import datetime, timedelta
 
 from lantop.lantop import Lantop, Transport, LantopError
+from lantop.testing import LantopEmulator
 
-from .helpers import LantopEmulator
 from .data import TEST_DATA
 
 
@@ -126,6 +126,19 @@ class LantopTest(unittest.TestCase):
         self.assertEqual(TEST_DATA[b'T04614B'][1] + b'0003',
                          self.server.last_msg)
 
+    def test_set_states(self):
+        requests = self.server.num_requests
+        self.lt.set_states({2: 'off', 0: 'auto'})
+        self.assertEqual(requests + 2, self.server.num_requests)
+        self.assertEqual(TEST_DATA[b'T04614B'][1] + b'0201',
+                         self.server.last_msg)
+
+    def test_set_states_wrong(self):
+        requests = self.server.num_requests
+        with self.assertRaises(LantopError):
+            self.lt.set_states({0: 'on', 1: 'foo'})
+        self.assertEqual(requests, self.server.num_requests)
+
     def test_set_state_wrong(self):
         with self.assertRaises(LantopError) as cm:
             self.lt.set_state(3, 'foo')
@@ -8,8 +8,9 @@ import types
 import unittest
 
 import lantop.cli
+from lantop.testing import LantopEmulator
 
-from .helpers import LantopEmulator, nostdout
+from .helpers import nostdout
 from .data import TEST_DATA
 
 
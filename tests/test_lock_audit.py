@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Tests for the lock count audit journal"""
+
+import os
+import logging
+import tempfile
+import unittest
+
+from lantop.lock_audit import LockAudit, RECORD, CHECKPOINT_STRIDE
+from lantop.lock_counts import LockCounts
+from lantop.lock_service import LockService
+
+logging.getLogger('lantop.lock_counts').setLevel(logging.ERROR)
+logging.getLogger('lantop.lock_service').setLevel(logging.ERROR)
+
+
+def nop(*args):
+    pass
+
+
+class LockAuditTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "audit")
+        self.audit = LockAudit(self.filename)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fill(self, count):
+        """Add count transitions on channel 0 (and 1), 10 seconds apart"""
+        for i in range(count):
+            self.audit.record_many([(7, 0, 1 if i % 3 else -1, i, "ev")] +
+                                   ([(7, 1, 1, i, "cli")] if i == 5 else []),
+                                   timestamp=1000.0 + 10 * i)
+
+    def test_record(self):
+        self.audit.record(7, 2, 1, 1, "a-very-long-event-id-to-be-truncated",
+                          timestamp=5.0)
+        record, = self.audit.records()
+        self.assertEqual((5.0, 7, 2, 1, 1, "a-very-long-event-id-to-"),
+                         record)
+        self.assertEqual(RECORD.size, os.path.getsize(self.filename))
+
+    def test_counts_at(self):
+        self.fill(1000)
+        self.assertEqual({}, self.audit.counts_at(999.0))
+        self.assertEqual({(7, 0): 0}, self.audit.counts_at(1000.0))
+        self.assertEqual({(7, 0): 4}, self.audit.counts_at(1045.0))
+        self.assertEqual({(7, 0): 5, (7, 1): 5},
+                         self.audit.counts_at(1055.0))
+        self.assertEqual({(7, 0): 500, (7, 1): 5},
+                         self.audit.counts_at(6000.0))
+        self.assertEqual({}, self.audit.counts_at(6000.0, device=8))
+        self.assertEqual(999, self.audit.counts_at(1e10)[7, 0])
+
+    def test_seek(self):
+        self.fill(1000)
+        index = self.audit._load_index()
+        self.assertEqual(3, len(index))
+        scanned = []
+        scan = self.audit._scan
+
+        def counting_scan(start=0, end=None):
+            for record in scan(start, end):
+                scanned.append(record)
+                yield record
+        self.audit._scan = counting_scan
+
+        self.assertEqual({(7, 0): 900, (7, 1): 5},
+                         self.audit.counts_at(1000.0 + 10 * 900))
+        self.assertLessEqual(len(scanned), CHECKPOINT_STRIDE)
+        del scanned[:]
+        records = list(self.audit.records(1000.0 + 10 * 990,
+                                          1000.0 + 10 * 995))
+        self.assertEqual(list(range(990, 995)),
+                         [record.locks for record in records])
+        self.assertLessEqual(len(scanned), CHECKPOINT_STRIDE)
+
+    def test_partial_record(self):
+        self.audit.record(1, 0, 1, 1, timestamp=1.0)
+        with open(self.filename, "ab") as fp:
+            fp.write(b"\x00" * 5)
+        self.audit.record(1, 0, 1, 2, timestamp=2.0)
+        self.assertEqual([1, 2], [record.locks
+                                  for record in self.audit.records()])
+
+    def test_apply(self):
+        locks = LockCounts(os.path.join(self.tmp.name, "state"), device=3)
+        locks.audit = self.audit
+        locks.apply_many(nop, {0: "on", 1: "auto", 2: "on"}, source="cli")
+        locks.apply(nop, 0, "on", source="cli")
+        locks.apply(nop, 0, "off", source="cli")
+        self.assertEqual([(3, 0, 1, 1), (3, 2, 1, 1), (3, 0, 1, 2),
+                          (3, 0, -2, 0)],
+                         [record[1:5] for record in self.audit.records()])
+
+    def test_service(self):
+        service = LockService(os.path.join(self.tmp.name, "state"),
+                              lease_grace=0, audit=self.audit)
+        service.counts(3).apply(nop, 1, "on", "event1", 1.0e10)
+        service.counts(3).apply(nop, 1, "on", "event2", 1.0e10)
+        service.expire(now=2.0e10)
+        self.assertEqual([(1, 1, "event1"), (1, 2, "event2"),
+                          (-1, 1, "expired event1"),
+                          (-1, 0, "expired event2")],
+                         [record[3:] for record in self.audit.records()])
+
+
+if __name__ == '__main__':
+    unittest.main()
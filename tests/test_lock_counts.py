@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Tests for the lock counters"""
+
+import os
+import fcntl
+import logging
+import tempfile
+import unittest
+import multiprocessing
+
+from lantop.lock_counts import (
+    LockCounts, LockDecision, LockLeases, MmapLockCounts
+)
+
+logging.getLogger('lantop.lock_counts').setLevel(logging.ERROR)
+
+
+def nop(channel, state):
+    pass
+
+
+def apply_many_times(filename, channel, count):
+    for _ in range(count):
+        with LockCounts(filename).transaction() as locks:
+            locks.apply(nop, channel, "on")
+
+
+def apply_mmap(filename, channel, count):
+    locks = MmapLockCounts(filename)
+    for _ in range(count):
+        locks.apply(nop, channel, "on")
+    locks.close()
+
+
+class LockCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "state")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_apply(self):
+        calls = []
+        with LockCounts(self.filename).transaction() as locks:
+            for state in ("on", "on", "auto", "auto", "auto"):
+                locks.apply(lambda *args: calls.append(args), 1, state)
+        self.assertEqual([(1, "on"), (1, "auto"), (1, "auto")], calls)
+        self.assertEqual(0, LockCounts(self.filename)[1])
+
+    def test_apply_many(self):
+        calls = []
+        with LockCounts(self.filename).transaction() as locks:
+            locks[2] = 1
+            decisions = locks.apply_many(calls.append,
+                                         {0: "on", 2: "on", 3: "off"})
+        self.assertEqual([{0: "on", 3: "off"}], calls)
+        self.assertEqual([LockDecision(0, "on", None, 1, True),
+                          LockDecision(2, "on", None, 2, False),
+                          LockDecision(3, "off", None, 0, True)], decisions)
+        self.assertFalse(LockCounts(self.filename).apply_many(
+            calls.append, {2: "auto"})[0].applied)
+        self.assertEqual(1, len(calls))
+
+    def test_save_atomic(self):
+        with LockCounts(self.filename).transaction() as locks:
+            locks[2] = 3
+        self.assertEqual([0, 0, 3, 0, 0, 0, 0, 0],
+                         [LockCounts(self.filename)[i] for i in range(8)])
+        self.assertEqual(["state", "state.lock"],
+                         sorted(os.listdir(self.tmp.name)))
+
+    def test_corrupt_file(self):
+        with open(self.filename, "w") as fp:
+            fp.write("[1, 2")
+        self.assertEqual(0, LockCounts(self.filename)[0])
+
+    def test_devices(self):
+        with LockCounts(self.filename, device=1).transaction() as locks:
+            locks[0] = 2
+        self.assertEqual(2, LockCounts(self.filename, device=1)[0])
+        self.assertEqual(0, LockCounts(self.filename, device=2)[0])
+
+    def test_adopt_legacy(self):
+        with LockCounts(self.filename).transaction() as locks:
+            locks[1] = 3
+        self.assertEqual(3, LockCounts(self.filename, device=5)[1])
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(0, LockCounts(self.filename, device=6)[1])
+
+    def test_concurrent_transactions(self):
+        workers, count = 200, 5
+        processes = [multiprocessing.Process(
+            target=apply_many_times, args=(self.filename, i % 2, count))
+            for i in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        locks = LockCounts(self.filename)
+        self.assertEqual(workers * count // 2, locks[0])
+        self.assertEqual(workers * count // 2, locks[1])
+
+
+class LockLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "state")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_acquire_release(self):
+        leases = LockLeases(self.filename)
+        leases.acquire(1, 0, "a", 100.0)
+        leases.acquire(1, 0, "a", 200.0)  # renewed, still one lease
+        leases.acquire(1, 0, "b")
+        self.assertEqual(2, leases.count(1, 0, now=150.0))
+        self.assertEqual(1, leases.count(1, 0, now=250.0))
+        self.assertTrue(leases.release(1, 0, "b"))
+        self.assertFalse(leases.release(1, 0, "b"))
+        self.assertEqual(0, leases.count(2, 0))
+
+    def test_expire(self):
+        leases = LockLeases(self.filename)
+        leases.acquire(1, 0, "a", 100.0)
+        leases.acquire(1, 0, "a", 200.0)
+        leases.acquire(1, 2, "b", 150.0)
+        leases.acquire(1, 3, "c", 120.0)
+        leases.release(1, 3, "c")
+        self.assertEqual([], leases.expire(now=110.0))
+        self.assertEqual([(1, 2, "b")], leases.expire(now=160.0))
+        self.assertEqual([(1, 0, "a")], leases.expire(now=300.0))
+        self.assertEqual([], leases.items())
+
+    def test_save(self):
+        leases = LockLeases(self.filename)
+        leases.acquire(3, 1, "a", 100.0)
+        leases.acquire(3, 1, "b")
+        leases.save()
+        leases = LockLeases(self.filename)
+        self.assertEqual([[3, 1, "a", 100.0], [3, 1, "b", None]],
+                         leases.items())
+        self.assertEqual([(3, 1, "a")], leases.expire(now=100.0))
+
+
+class MmapLockCountsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "state")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_layout(self):
+        locks = MmapLockCounts(self.filename, device=1234, slots=4)
+        locks[3] = 5
+        locks[7] = -1
+        locks.close()
+        with open(self.filename, "rb") as fp:
+            data = fp.read()
+        self.assertEqual(b"LTLC\x02\x00\x08\x00\x04\x00\x00\x00", data[:12])
+        self.assertEqual(b"\xd2\x04\x00\x00" + b"\xff" * 12, data[12:28])
+        self.assertEqual(12 + 4 * 4 + 4 * 8 * 4, len(data))
+        self.assertEqual(b"\x05\x00\x00\x00", data[40:44])
+        self.assertEqual(5, MmapLockCounts(self.filename, device=1234)[3])
+
+    def test_devices(self):
+        first = MmapLockCounts(self.filename, device=1)
+        second = MmapLockCounts(self.filename, device="10.0.0.2")
+        first.apply(nop, 0, "on")
+        self.assertEqual(1, first[0])
+        self.assertEqual(0, second[0])
+        first.close()
+        second.close()
+
+    def test_reserved_keys(self):
+        for serial in (0, 0xFFFFFFFF, 1 << 32):
+            with self.assertRaises(ValueError):
+                MmapLockCounts(self.filename, device=serial)
+        first = MmapLockCounts(self.filename, device=1)
+        first[0] = 3
+        first.close()
+        self.assertEqual(3, MmapLockCounts(self.filename, device=1)[0])
+
+    def test_adopt_legacy(self):
+        locks = MmapLockCounts(self.filename)
+        locks[2] = 4
+        locks.close()
+        self.assertEqual(4, MmapLockCounts(self.filename, device=7)[2])
+        self.assertEqual(0, MmapLockCounts(self.filename, device=8)[2])
+
+    def test_migrate_version_1(self):
+        with open(self.filename, "wb") as fp:
+            fp.write(b"LTLC\x01\x00\x08\x00\xd2\x04\x00\x00" +
+                     b"\x03\x00\x00\x00" * 8)
+        self.assertEqual(3, MmapLockCounts(self.filename, device=1234)[5])
+
+    def test_migrate_json(self):
+        with open(self.filename, "w") as fp:
+            fp.write("[1, 2, 3, 4, 5, 6, 7, 8]")
+        locks = MmapLockCounts(self.filename)
+        self.assertEqual(list(range(1, 9)), [locks[i] for i in range(8)])
+        locks.apply(nop, 0, "auto")
+        locks.close()
+        self.assertEqual(0, MmapLockCounts(self.filename)[0])
+
+    def test_apply_many(self):
+        calls = []
+        locks = MmapLockCounts(self.filename)
+        decisions = locks.apply_many(calls.append, {1: "on", 5: "auto"})
+        self.assertEqual([{1: "on", 5: "auto"}], calls)
+        self.assertEqual([1, 0], [decision.locks for decision in decisions])
+        self.assertEqual(1, MmapLockCounts(self.filename)[1])
+
+    def test_transaction_apply(self):
+        locks = MmapLockCounts(self.filename)
+        with locks.transaction():
+            locks.apply(nop, 1, "on")
+            locks.apply(nop, 1, "on")
+        self.assertEqual(2, MmapLockCounts(self.filename)[1])
+
+    def test_lock_kept_when_other_closed(self):
+        locks = MmapLockCounts(self.filename)
+        with locks.transaction():
+            MmapLockCounts(self.filename, device=2).close()
+            with open(self.filename, "rb") as fp:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        locks.close()
+
+    def test_concurrent_apply(self):
+        workers, count = 100, 10
+        processes = [multiprocessing.Process(
+            target=apply_mmap, args=(self.filename, i % 2, count))
+            for i in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        locks = MmapLockCounts(self.filename)
+        self.assertEqual(workers * count // 2, locks[0])
+        self.assertEqual(workers * count // 2, locks[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Tests for the lock counter service"""
+
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import unittest
+
+from lantop.errors import LantopTransportError
+from lantop.lock_counts import LockCounts, MmapLockCounts
+from lantop.lock_service import LockService, LockClient, JOURNAL_RECORD
+
+logging.getLogger('lantop.lock_counts').setLevel(logging.ERROR)
+logging.getLogger('lantop.lock_service').setLevel(logging.ERROR)
+
+
+def nop(channel, state):
+    pass
+
+
+class LockServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "state")
+        self.journal = self.filename + ".journal"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_journal(self):
+        service = LockService(self.filename, compact_records=100)
+        counts = service.counts(42)
+        self.assertTrue(counts.apply(nop, 1, "on"))
+        self.assertFalse(counts.apply(nop, 1, "on"))
+        self.assertEqual(2 * JOURNAL_RECORD.size, os.path.getsize(self.journal))
+        self.assertFalse(os.path.exists(self.filename + ".42"))
+
+        # a new service replays and compacts the journal
+        service = LockService(self.filename)
+        self.assertEqual(2, service.counts(42)[1])
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(2, LockCounts(self.filename, device=42)[1])
+
+    def test_apply_many(self):
+        calls = []
+        service = LockService(self.filename, compact_records=100)
+        decisions = service.counts(42).apply_many(
+            calls.append, {0: "on", 1: "on", 2: "auto"}, {1: "event"})
+        self.assertEqual([{0: "on", 1: "on", 2: "auto"}], calls)
+        self.assertEqual([True] * 3, [decision.applied
+                                      for decision in decisions])
+        self.assertEqual(JOURNAL_RECORD.size, os.path.getsize(self.journal))
+
+    def test_partial_record(self):
+        service = LockService(self.filename)
+        service.counts(1)[0] = 3
+        with open(self.journal, "ab") as fp:
+            fp.write(b"\x01\x00")
+        self.assertEqual(3, LockService(self.filename).counts(1)[0])
+
+    def test_compact(self):
+        service = LockService(self.filename, compact_records=3)
+        counts = service.counts(7)
+        for _ in range(3):
+            counts.apply(nop, 2, "on")
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(3, LockCounts(self.filename, device=7)[2])
+        counts.apply(nop, 2, "off")
+        service.close()
+        self.assertEqual(0, LockCounts(self.filename, device=7)[2])
+
+    def test_seed_from_backend(self):
+        locks = MmapLockCounts(self.filename)
+        locks[4] = 2
+        locks.close()
+        service = LockService(self.filename, backend=MmapLockCounts)
+        self.assertFalse(service.counts(9).apply(nop, 4, "auto"))
+        service.close()
+        self.assertEqual(1, MmapLockCounts(self.filename, device=9)[4])
+
+    def test_leases(self):
+        now = time.time()
+        service = LockService(self.filename, lease_grace=10)
+        counts = service.counts(3)
+        self.assertTrue(counts.apply(nop, 0, "on", "event1", now + 100))
+        self.assertFalse(counts.apply(nop, 0, "on", "event2", now + 200))
+        self.assertFalse(counts.apply(nop, 0, "on"))  # from the CLI
+        self.assertEqual(3, counts.count(0))
+        self.assertEqual(1, counts[0])
+        # repeated "auto" of an event does not release other locks
+        self.assertFalse(counts.apply(nop, 0, "auto", "event1"))
+        self.assertFalse(counts.apply(nop, 0, "auto", "event1"))
+        self.assertFalse(counts.apply(nop, 0, "auto"))
+        self.assertEqual(1, counts.count(0))
+        self.assertEqual([[3, 0, "event2", now + 210]],
+                         service.leases.items())
+
+        service.close()
+        service = LockService(self.filename)
+        self.assertEqual([[3, 0, "event2", now + 210]],
+                         service.leases.items())
+        self.assertEqual([], service.expire(now=now + 205))
+        self.assertEqual([(3, 0)], service.expire(now=now + 215))
+        self.assertEqual(0, service.counts(3).count(0))
+
+    def test_renew(self):
+        now = time.time()
+        service = LockService(self.filename, lease_grace=10)
+        service.counts(3).apply(nop, 0, "on", "event1", now + 100)
+        self.assertFalse(service.renew(3, 0, "event1", now + 100))
+        self.assertFalse(service.renew(3, 0, "event2", now + 200))
+        self.assertTrue(service.renew(3, 0, "event1", now + 200))
+        self.assertEqual([], service.expire(now=now + 150))
+        self.assertEqual([(3, 0)], service.expire(now=now + 250))
+
+    def test_expire_unlock_failed(self):
+        now = time.time()
+        service = LockService(self.filename, lease_grace=0)
+        service.counts(3).apply(nop, 0, "on", "event1", now + 100)
+        self.assertFalse(service.leases.due(now + 50))
+        self.assertTrue(service.leases.due(now + 150))
+
+        def unlock(unlocked):
+            raise LantopTransportError("unreachable")
+        with self.assertRaises(LantopTransportError):
+            service.expire(now + 150, unlock)
+        # kept, to be set to auto with the next try
+        self.assertEqual(1, service.counts(3).count(0))
+        unlocked = []
+        self.assertEqual([(3, 0)], service.expire(now + 160, unlocked.extend))
+        self.assertEqual([(3, 0)], unlocked)
+        self.assertEqual(0, service.counts(3).count(0))
+
+    def test_expire_locked(self):
+        now = time.time()
+        service = LockService(self.filename, lease_grace=0)
+        counts = service.counts(3)
+        counts.apply(nop, 1, "on", "event1", now + 100)
+        counts.apply(nop, 1, "on")
+        self.assertEqual([], service.expire(now=now + 150))
+        self.assertEqual(1, counts.count(1))
+
+    def test_off(self):
+        service = LockService(self.filename)
+        counts = service.counts(3)
+        counts.apply(nop, 1, "on", "event1", 100.0)
+        counts.apply(nop, 1, "on")
+        self.assertTrue(counts.apply(nop, 1, "off"))
+        self.assertEqual(0, counts.count(1))
+        self.assertEqual([], service.leases.items())
+
+    def test_control_socket(self):
+        path = os.path.join(self.tmp.name, "locks.sock")
+        service = LockService(self.filename)
+        service.serve(path)
+        try:
+            calls = []
+            client = LockClient(path, 5)
+            self.assertTrue(client.apply(
+                lambda *args: calls.append(args), 0, "on"))
+            self.assertFalse(client.apply(
+                lambda *args: calls.append(args), 0, "on"))
+            client[3] = 4
+            now = time.time()
+            self.assertTrue(client.apply(nop, 2, "on", "event", now))
+            self.assertEqual(1, client.count(2))
+            decisions = client.apply_many(calls.append, {0: "auto", 1: "on"})
+            self.assertEqual([(0, "auto", None, 1, False),
+                              (1, "on", None, 1, True)], decisions)
+            self.assertEqual({1: "on"}, calls.pop())
+            self.assertEqual([[5, 2, "event", now + 3600]],
+                             client.list()["leases"])
+            self.assertEqual([(0, "on")], calls)
+            self.assertEqual(1, service.counts(5)[0])
+            self.assertEqual(4, client[3])
+            client.close()
+        finally:
+            service.close()
+        with self.assertRaises(OSError):
+            LockClient(path, 5)
+
+    def test_control_socket_malformed(self):
+        path = os.path.join(self.tmp.name, "locks.sock")
+        service = LockService(self.filename)
+        service.serve(path)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+                with sock.makefile("rwb") as fp:
+                    for line in (b"{bad\n", b"\xff\n", b"[1]\n"):
+                        fp.write(line)
+                        fp.flush()
+                        self.assertIn("error", json.loads(fp.readline()))
+                    fp.write(b'{"op": "list"}\n')
+                    fp.flush()
+                    self.assertEqual([], json.loads(fp.readline())["leases"])
+        finally:
+            service.close()
+
+    def test_invalid_requests(self):
+        service = LockService(self.filename)
+        for request in (
+                {"op": "set", "device": 5, "channel": -1, "value": 1},
+                {"op": "set", "device": 5, "channel": 8, "value": 1},
+                {"op": "set", "device": 5, "channel": True, "value": 1},
+                {"op": "set", "device": 5, "channel": 1, "value": "1"},
+                {"op": "apply", "device": 5,
+                 "changes": [[0, "on", None, None], [-1, "on", None, None]]},
+                {"op": "apply", "device": 5,
+                 "changes": [[0, "on", None, None], [1, "of", None, None]]},
+                {"op": "apply", "device": 5,
+                 "changes": [[0, "on", None, None], [1, "on", 3, None]]},
+                {"op": "apply", "device": 5,
+                 "changes": [[0, "on", None, None], [1, "on"]]}):
+            self.assertIn("error", service.handle(request))
+        # nothing was applied
+        self.assertEqual([0] * 8, service.handle(
+            {"op": "get", "device": 5})["locks"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Tests for the HTTP/JSON API server"""
+
+import json
+import asyncio
+import unittest
+
+from lantop.errors import LantopTransportError
+from lantop.server import DeviceSession, Server
+from lantop.testing import LantopEmulator, http_request
+
+from .data import TEST_DATA
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = LantopEmulator(resp_dict=TEST_DATA)
+        self.emulator.start()
+        self.session = DeviceSession(*self.emulator.server_address, ttl=60)
+        self.server = Server({"0": self.session})
+        self.loop = asyncio.new_event_loop()
+        self.listener = self.loop.run_until_complete(
+            self.server.start("127.0.0.1", 0))
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+        self.session.close()
+        self.loop.close()
+        self.emulator.stop()
+
+    def run_client(self, coroutine_func):
+        async def client():
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", self.port)
+            try:
+                return await coroutine_func(reader, writer)
+            finally:
+                writer.close()
+        return self.loop.run_until_complete(client())
+
+    def test_states_and_etag(self):
+        async def requests(reader, writer):
+            first = await http_request(reader, writer, "GET",
+                                       "/devices/0/states")
+            second = await http_request(
+                reader, writer, "GET", "/devices/0/states",
+                headers=[("If-None-Match", first[1]["etag"])])
+            return first, second
+        (status, headers, states), (status2, _, body2) = \
+            self.run_client(requests)
+        self.assertEqual(200, status)
+        self.assertEqual(TEST_DATA[b'T02624B'][1], states)
+        self.assertEqual(304, status2)
+        self.assertIsNone(body2)
+
+    def test_channel(self):
+        async def requests(reader, writer):
+            get = await http_request(reader, writer, "GET",
+                                     "/devices/0/channels/0")
+            put = await http_request(reader, writer, "PUT",
+                                     "/devices/0/channels/3", {"state": "on"})
+            bad = await http_request(reader, writer, "PUT",
+                                     "/devices/0/channels/3", {"state": "x"})
+            missing = await http_request(reader, writer, "GET",
+                                         "/devices/1/states")
+            return get, put, bad, missing
+        get, put, bad, missing = self.run_client(requests)
+        self.assertEqual(200, get[0])
+        self.assertEqual(TEST_DATA[b'T03624E'][1], get[2]["name"])
+        self.assertTrue(get[2]["active"])
+        self.assertEqual(202, put[0])
+        self.assertEqual(TEST_DATA[b'T04614B'][1] + b'0302',
+                         self.emulator.last_msg)
+        self.assertEqual(400, bad[0])
+        self.assertEqual(404, missing[0])
+
+    def test_invalid_put(self):
+        async def requests(reader, writer):
+            statuses = []
+            for body in ({"state": "on", "duration": "x"},
+                         {"state": "on", "duration": -60},
+                         {"state": "on", "duration": 10 ** 9},
+                         {"state": "on", "duration": True},
+                         {"state": ["on"]}):
+                status, _, _ = await http_request(
+                    reader, writer, "PUT", "/devices/0/channels/3", body)
+                statuses.append(status)
+            return statuses
+        self.assertEqual([400] * 5, self.run_client(requests))
+        self.assertEqual(0, self.emulator.num_requests)
+
+    def test_bad_content_length(self):
+        async def request(reader, writer):
+            writer.write(b"PUT /devices/0/channels/3 HTTP/1.1\r\n"
+                         b"Content-Length: x\r\n\r\n")
+            return (await reader.readline()).split()[1]
+        self.assertEqual(b"400", self.run_client(request))
+
+    def test_devices_and_stats(self):
+        async def requests(reader, writer):
+            return (await http_request(reader, writer, "GET", "/devices"),
+                    await http_request(reader, writer, "GET", "/stats"))
+        devices, stats = self.run_client(requests)
+        self.assertEqual("0", devices[2][0]["id"])
+        self.assertEqual(TEST_DATA[b'T02624C'][1][1], devices[2][0]["serial"])
+        self.assertEqual(2, stats[2]["requests"])
+
+    def test_coalescing(self):
+        async def requests(reader, writer):
+            return [await http_request(reader, writer, "GET",
+                                       "/devices/0/states")
+                    for _ in range(50)]
+
+        async def clients():
+            connections = [await asyncio.open_connection("127.0.0.1",
+                                                         self.port)
+                           for _ in range(8)]
+            results = await asyncio.gather(*(requests(*connection)
+                                             for connection in connections))
+            for _, writer in connections:
+                writer.close()
+            return results
+
+        results = self.loop.run_until_complete(clients())
+        self.assertEqual(400, sum(len(result) for result in results))
+        self.assertTrue(all(status == 200 for result in results
+                            for status, _, _ in result))
+        # get_info and get_states once
+        self.assertEqual(2, self.emulator.num_requests)
+
+
+    def test_long_poll_timeout(self):
+        async def requests(reader, writer):
+            first = await http_request(reader, writer, "GET",
+                                       "/devices/0/states")
+            return await http_request(
+                reader, writer, "GET", "/devices/0/states?wait=0.1",
+                headers=[("If-None-Match", first[1]["etag"])])
+        status, _, _ = self.run_client(requests)
+        self.assertEqual(304, status)
+
+    def test_invalid_wait(self):
+        async def requests(reader, writer):
+            return [(await http_request(
+                reader, writer, "GET", "/devices/0/states?wait=" + wait,
+                headers=[("If-None-Match", '"x"')]))[0]
+                for wait in ("nan", "inf", "-1", "x", "0")]
+        self.assertEqual([400, 400, 400, 400, 200], self.run_client(requests))
+
+    def test_events(self):
+        async def events(reader, writer):
+            writer.write(b"GET /devices/0/events HTTP/1.1\r\n\r\n")
+            lines = []
+            while len([line for line in lines if line == b"\n"]) < 2:
+                lines.append(await reader.readline())
+            return lines
+        self.session.poll_args = {"min_interval": 0.01}
+        lines = self.run_client(events)
+        self.assertEqual(b"HTTP/1.1 200 OK\r\n", lines[0])
+        self.assertIn(b"event: states\n", lines)
+        self.assertIn(b"event: change\n", lines)
+        # the first listener started the poller, the last one stops it
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(0, self.session.stats["listeners"])
+
+    def test_events_after_transport_error(self):
+        self.session.poll_args = {"min_interval": 0.01, "max_interval": 0.02}
+        resp_dict = self.emulator.resp_dict = dict(TEST_DATA)
+
+        async def changes():
+            listener = await self.session.listen()
+            first = await asyncio.wait_for(listener.get(), 5)
+            self.emulator.drop_connection()
+            try:  # unless the poller reconnected already
+                await self.session.call(self.session.device.get_info)
+            except LantopTransportError:
+                pass
+            # channel 1 turned on
+            resp_dict[b'T02624B'] = (b'626B8C8209020202020200000015',)
+            second = await asyncio.wait_for(listener.get(), 5)
+            self.session.unlisten(listener)
+            # a new listener subscribes again after the device was closed
+            await self.session.call(self.session.device.close)
+            listener = await self.session.listen()
+            third = await asyncio.wait_for(listener.get(), 5)
+            self.session.unlisten(listener)
+            return first, second, third
+        first, second, third = self.loop.run_until_complete(changes())
+        self.assertEqual(4, len(first))
+        self.assertEqual([(1, True)], [(change.channel, change.active)
+                                       for change in second])
+        self.assertEqual(4, len(third))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Tests for the channel statistics time series"""
+
+import io
+import os
+import tempfile
+import unittest
+from datetime import date
+
+from lantop.lantop import Lantop
+from lantop.stats import StatsStore, StatsSampler, deltas, rates, export_csv
+from lantop.testing import LantopEmulator
+
+from .data import TEST_DATA
+
+DAY = 86400.0
+T0 = 1450000000.0
+
+
+class StatsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = StatsStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_samples(self):
+        self.store.append(1, (1.0, 2.0, 3, date(2015, 1, 1)), 5, T0)
+        self.store.append(0, (4.0, 5.0, 6, date(2015, 1, 1)), 5, T0)
+        samples = self.store.samples(1)
+        self.assertEqual(1, len(samples))
+        self.assertEqual((T0, 5, 1, 1.0, 2.0, 3), samples[0][:6])
+        self.assertEqual(date(2015, 1, 1).toordinal(), samples[0].last_reset)
+        self.assertEqual([], self.store.samples(1, device=6))
+        self.assertEqual([], self.store.samples(1, since=T0 + 1))
+        self.assertEqual(2 * 8, os.path.getsize(
+            os.path.join(self.tmp.name, "last_reset.col")))
+
+    def test_deltas_and_resets(self):
+        reset = date(2015, 1, 1)
+        self.store.append(0, (10.0, 20.0, 100, reset), 0, T0)
+        self.store.append(0, (15.0, 21.0, 110, reset), 0, T0 + DAY)
+        self.store.mark_reset(0, 0, T0 + DAY + 1)
+        self.store.append(0, (2.0, 3.0, 4, date(2015, 1, 2)), 0, T0 + 2 * DAY)
+        # reset without marker
+        self.store.append(0, (1.0, 1.0, 2, date(2015, 1, 3)), 0, T0 + 3 * DAY)
+
+        changes = deltas(self.store.samples(0))
+        self.assertEqual([(5.0, 1.0, 10), (0.0, 0.0, 0), (2.0, 3.0, 4),
+                          (1.0, 1.0, 2)],
+                         [change[2:5] for change in changes])
+        self.assertEqual([False, True, False, True],
+                         [change.reset for change in changes])
+
+        usage = rates(self.store.samples(0))
+        self.assertAlmostEqual(3.0, usage.days)
+        self.assertAlmostEqual(8.0 / 3, usage.active_per_day)
+        self.assertAlmostEqual(16.0 / 3 * 7, usage.switches_per_week)
+        self.assertEqual(2, usage.resets)
+
+    def test_deltas_of_devices(self):
+        reset = date(2015, 1, 1)
+        self.store.append(0, (10.0, 20.0, 100, reset), 5, T0)
+        self.store.append(0, (500.0, 600.0, 7000, reset), 6, T0 + 1)
+        self.store.append(0, (12.0, 21.0, 103, reset), 5, T0 + DAY)
+        self.store.append(0, (501.0, 602.0, 7004, reset), 6, T0 + DAY + 1)
+        columns = self.store.load()
+        changes = deltas(self.store.samples(0, columns=columns))
+        self.assertEqual([(2.0, 1.0, 3), (1.0, 2.0, 4)],
+                         [change[2:5] for change in changes])
+        self.assertEqual([False, False], [change.reset for change in changes])
+        self.assertEqual([], self.store.samples(1, columns=columns))
+        out = io.StringIO()
+        export_csv(self.store.samples(0, device=6, columns=columns), out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[2].endswith(",1.0,2.0,4,0"))
+
+    def test_export(self):
+        self.store.append(0, (10.0, 20.0, 100, date(2015, 1, 1)), 0, T0)
+        self.store.append(0, (11.0, 20.0, 101, date(2015, 1, 1)), 0, T0 + 60)
+        out = io.StringIO()
+        export_csv(self.store.samples(0), out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[2].endswith(",1.0,0.0,1,0"))
+
+
+class StatsSamplerTest(unittest.TestCase):
+
+    def test_sample(self):
+        server = LantopEmulator(resp_dict=TEST_DATA)
+        server.start()
+        with tempfile.TemporaryDirectory() as path:
+            store = StatsStore(path)
+            with Lantop(*server.server_address) as device:
+                StatsSampler(store).sample(device, T0)
+            for channel in range(4):
+                samples = store.samples(channel)
+                self.assertEqual(1, len(samples))
+                self.assertEqual(TEST_DATA[b'T02624C'][1][1],
+                                 samples[0].device)
+                self.assertEqual(65819, samples[0].switches)
+        server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Tests for the state watcher"""
+
+import json
+import queue
+import types
+import unittest
+from datetime import datetime
+
+from lantop.lantop import Lantop
+from lantop.watch import (
+    StateWatcher, Subscription, format_change, format_change_json
+)
+from lantop.testing import LantopEmulator
+
+from .data import TEST_DATA
+
+
+class StateWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LantopEmulator(resp_dict=TEST_DATA)
+        self.server.start()
+        self.lt = Lantop(*self.server.server_address)
+        self.watcher = StateWatcher(self.lt, min_interval=1.0,
+                                    max_interval=3.0, backoff=2.0)
+
+    def tearDown(self):
+        self.lt.close()
+        self.server.stop()
+
+    def test_first_poll_reports_all(self):
+        changes = self.watcher.poll()
+        self.assertEqual([0, 1, 2, 3], [c.channel for c in changes])
+        self.assertTrue(changes[0].active)
+        self.assertEqual('Timer int', changes[2].reason)
+        self.assertEqual(1.0, self.watcher.interval)
+
+    def test_unchanged_poll(self):
+        self.watcher.poll()
+        states = self.watcher.states
+        self.assertEqual([], self.watcher.poll())
+        self.assertIs(states, self.watcher.states)
+        self.assertEqual(2.0, self.watcher.interval)
+        self.watcher.poll()
+        self.assertEqual(3.0, self.watcher.interval)
+
+    def test_format(self):
+        change = self.watcher.poll(now=datetime(2016, 1, 2, 3, 4, 5))[0]
+        self.assertEqual('2016-01-02 03:04:05  CH 0  On   Dauer int',
+                         format_change(change))
+        self.assertEqual({'time': '2016-01-02T03:04:05', 'channel': 0,
+                          'active': True, 'reason': 'Dauer int'},
+                         json.loads(format_change_json(change)))
+
+
+class SubscriptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = types.SimpleNamespace(unsubscribe=lambda s: None)
+
+    def test_drop_oldest(self):
+        subscription = Subscription(self.poller, queue_size=2)
+        for changes in ([1], [2], [3]):
+            subscription.put(changes)
+        self.assertEqual(1, subscription.dropped)
+        self.assertEqual([2], subscription.get(timeout=0))
+        self.assertEqual([3], subscription.get(timeout=0))
+
+    def test_drop_new(self):
+        subscription = Subscription(self.poller, queue_size=1,
+                                    policy="drop_new")
+        subscription.put([1])
+        subscription.put([2])
+        self.assertEqual([1], subscription.get(timeout=0))
+        self.assertEqual(1, subscription.dropped)
+
+    def test_block(self):
+        subscription = Subscription(self.poller, queue_size=1,
+                                    policy="block", block_timeout=0.01)
+        subscription.put([1])
+        subscription.put([2])
+        self.assertEqual(1, subscription.dropped)
+
+    def test_cancel(self):
+        subscription = Subscription(self.poller)
+        subscription.put([1])
+        subscription.cancel()
+        self.assertEqual([[1]], list(subscription))
+
+
+class LantopSubscribeTest(unittest.TestCase):
+
+    def test_subscribe(self):
+        server = LantopEmulator(resp_dict=TEST_DATA)
+        server.start()
+        received = queue.Queue()
+        with Lantop(*server.server_address) as lt:
+            first = lt.subscribe(received.put, min_interval=0.01)
+            changes = received.get(timeout=2)
+            self.assertEqual([0, 1, 2, 3], [c.channel for c in changes])
+            # later subscribers start with a snapshot, same poller
+            second = lt.subscribe()
+            self.assertEqual(4, len(second.get(timeout=0)))
+            self.assertIs(first.poller, second.poller)
+            requests = server.num_requests
+            first.cancel()
+            second.cancel()
+            first.poller.join(2)
+            self.assertFalse(first.poller.is_alive())
+            self.assertLessEqual(server.num_requests, requests + 1)
+        server.stop()
+
+
+    def test_shared_connection(self):
+        server = LantopEmulator(resp_dict=dict(TEST_DATA))
+        server.start()
+        received = queue.Queue()
+        lt = Lantop(*server.server_address)
+        try:
+            subscription = lt.subscribe(received.put, min_interval=0.01,
+                                        max_interval=0.01)
+            received.get(timeout=2)
+            # connecting again keeps the poller and its subscriptions
+            lt.connect(*server.server_address)
+            self.assertTrue(subscription.active)
+            for _ in range(20):
+                with lt.connection_lock:
+                    lt.disconnect()
+                    lt.connect(*server.server_address)
+                    self.assertEqual("TR 644 top2 RC", lt.get_info()[0])
+            # channel 1 turned on
+            server.resp_dict[b'T02624B'] = (b'626B8C8209020202020200000015',)
+            changes = received.get(timeout=2)
+            self.assertEqual([(1, True)], [(change.channel, change.active)
+                                           for change in changes])
+        finally:
+            lt.close()
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()